@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Офлайн‑бенчмарк: прогоняет шаблоны и схемы через провайдеров из scripts/run.py
+против локального заменителя API (scripts/mock_server.py), без платных вызовов.
+
+    python scripts/bench.py run prompts/banking/complaint_triage.md \\
+        --schema banking/schemas/complaint_schema.json -n 500 -c 16 --stream \\
+        --latency lognormal:300,0.5 --error-rate 0.02 --save bench/baselines/complaint.json
+
+Отчёт: p50/p95/p99 задержки (и ttft при --stream), запросов в секунду, доля ошибок,
+доля валидных по схеме ответов, CPU и память клиента на запрос. С --baseline
+результат сравнивается с сохранённым, регрессия сверх допуска — код выхода 1.
+"""
+import json, math, os, platform, resource, subprocess, sys, time, tracemalloc, typing as T
+from concurrent.futures import ThreadPoolExecutor
+import typer
+from rich import print
+
+import run as cli
+from llm_transport import StreamTimer
+from prompt_templates import load_template
+
+app = typer.Typer(add_help_option=True)
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Значения переменных по умолчанию для шаблонов репозитория
+SAMPLE_VARS = {
+    "complaint": "С карты дважды списали 1 500 ₽ за одну покупку, поддержка не отвечает.",
+    "text": "Получатель ООО «Ромашка», р/с 40702810900000000001, БИК 044525225, ИНН 7707083893.",
+    "passages": "[doc-1] Перевыпуск карты бесплатен при утере.\n[doc-2] Срок изготовления — 5 дней.",
+    "question": "Сколько стоит перевыпуск карты?",
+    "q": "Какой процент годовых по вкладу «Надёжный»?",
+    "task": "Кратко объясни, что такое овердрафт.",
+    "topic": "история Kubernetes",
+}
+
+def percentile(values: T.Sequence[float], q: float) -> T.Optional[float]:
+    """Перцентиль методом ближайшего ранга."""
+    if not values:
+        return None
+    s = sorted(values)
+    k = max(0, min(len(s) - 1, math.ceil(q / 100 * len(s)) - 1))
+    return s[k]
+
+def start_mock(latency: str, error_rate: float, invalid_rate: float, token_delay_ms: float):
+    """Заменитель API в отдельном процессе — чтобы его CPU не попадал в замер клиента."""
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "mock_server.py"), "--port", "0",
+         "--latency", latency, "--error-rate", str(error_rate),
+         "--invalid-rate", str(invalid_rate), "--token-delay-ms", str(token_delay_ms)],
+        stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline().strip()
+    if not line.startswith("READY "):
+        proc.kill()
+        raise RuntimeError(f"mock_server не запустился: {line!r}")
+    return proc, line.split(" ", 1)[1]
+
+def point_provider_env(provider: str, base: str):
+    if provider == "openai":
+        os.environ["OPENAI_API_BASE"] = f"{base}/v1"
+        os.environ.setdefault("OPENAI_API_KEY", "bench")
+    else:
+        os.environ["GIGACHAT_OAUTH_URL"] = f"{base}/api/v2/oauth"
+        os.environ["GIGACHAT_API_BASE"] = f"{base}/api/v1"
+        os.environ.setdefault("GIGACHAT_CLIENT_ID", "bench")
+        os.environ.setdefault("GIGACHAT_AUTH_KEY", "bench")
+
+def load_rows(vars_file: T.Optional[str], variables: T.Sequence[str], n: int) -> T.List[dict]:
+    if vars_file:
+        rows = [row for _, row in cli.iter_jsonl(vars_file)]
+        return [rows[i % len(rows)] for i in range(n)]
+    # номер в значении делает промпты уникальными
+    return [{v: f"{SAMPLE_VARS.get(v, 'Тестовое значение')} #{i}" for v in variables} for i in range(n)]
+
+def summarize(records: T.List[dict], wall: float, cpu: float, rss_kb: int,
+              alloc_peak: T.Optional[int], schema: T.Optional[str]) -> dict:
+    n = len(records)
+    ok = [r for r in records if r["ok"]]
+    lat = [r["latency"] for r in ok]
+    ttft = [r["ttft"] for r in ok if r.get("ttft") is not None]
+    ms = lambda v: None if v is None else round(v * 1000, 1)
+    m = {
+        "requests": n,
+        "rps": round(n / wall, 2) if wall else None,
+        "error_rate": round(1 - len(ok) / n, 4) if n else None,
+        "latency_ms": {"p50": ms(percentile(lat, 50)), "p95": ms(percentile(lat, 95)), "p99": ms(percentile(lat, 99))},
+        "cpu_ms_per_req": round(cpu / n * 1000, 3) if n else None,
+        "rss_peak_mb": round(rss_kb / 1024, 1),
+    }
+    if ttft:
+        m["ttft_ms"] = {"p50": ms(percentile(ttft, 50)), "p95": ms(percentile(ttft, 95)), "p99": ms(percentile(ttft, 99))}
+    if schema:
+        m["schema_valid_rate"] = round(sum(1 for r in ok if r.get("valid")) / len(ok), 4) if ok else 0.0
+    if alloc_peak is not None:
+        m["alloc_peak_kb_per_req"] = round(alloc_peak / 1024 / n, 2) if n else None
+    return m
+
+# (метрика, направление: +1 — больше хуже, -1 — меньше хуже)
+REGRESSION_KEYS = [("latency_ms.p50", 1), ("latency_ms.p95", 1), ("latency_ms.p99", 1),
+                   ("ttft_ms.p95", 1), ("cpu_ms_per_req", 1), ("rps", -1),
+                   ("error_rate", 1), ("schema_valid_rate", -1)]
+
+def _get(d: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(d, dict) or part not in d:
+            return None
+        d = d[part]
+    return d
+
+def compare_metrics(current: dict, baseline: dict, tolerance: float) -> T.List[str]:
+    """Список регрессий: метрика хуже базовой более чем на `tolerance` (доля)."""
+    out = []
+    for key, sign in REGRESSION_KEYS:
+        cur, base = _get(current, key), _get(baseline, key)
+        if cur is None or base is None:
+            continue
+        worse = cur > base * (1 + tolerance) if sign > 0 else cur < base * (1 - tolerance)
+        # Доли около нуля сравниваем в абсолютных пунктах
+        if key in ("error_rate", "schema_valid_rate"):
+            worse = (cur - base) * sign > tolerance / 10
+        if worse:
+            out.append(f"{key}: {base} → {cur}")
+    return out
+
+@app.command("run")
+def run_bench(prompt_file: str,
+              schema: str = typer.Option(None, help="JSON Schema для проверки ответов"),
+              provider: str = typer.Option("openai", help="openai | gigachat"),
+              requests_n: int = typer.Option(200, "--requests", "-n", min=1),
+              concurrency: int = typer.Option(8, "--concurrency", "-c", min=1),
+              stream: bool = typer.Option(False, "--stream", help="Потоковые вызовы (замер ttft)"),
+              vars_file: str = typer.Option(None, help="JSONL с переменными (иначе — примеры)"),
+              latency: str = typer.Option("lognormal:200,0.4", help="Распределение задержки сервера"),
+              error_rate: float = typer.Option(0.0, help="Доля ответов 429/503"),
+              invalid_rate: float = typer.Option(0.0, help="Доля ответов, нарушающих схему"),
+              token_delay_ms: float = typer.Option(5.0, help="Пауза между SSE‑фрагментами"),
+              trace_memory: bool = typer.Option(False, help="tracemalloc: пик аллокаций на запрос (медленнее)"),
+              save: str = typer.Option(None, help="Сохранить результат (JSON) как базовый"),
+              baseline: str = typer.Option(None, help="Сравнить с сохранённым результатом"),
+              tolerance: float = typer.Option(0.10, help="Допустимое ухудшение, доля")):
+    """Нагрузочный прогон шаблона через локальный заменитель API."""
+    proc, base = start_mock(latency, error_rate, invalid_rate, token_delay_ms)
+    try:
+        point_provider_env(provider, base)
+        p = cli.get_provider(provider)
+        tpl = load_template(prompt_file)
+        rows = load_rows(vars_file, tpl.variables, requests_n)
+
+        def one(row: dict) -> dict:
+            prompt = tpl.render(row)
+            timer = StreamTimer()
+            rec = {"ok": True}
+            try:
+                if stream:
+                    out, aborted = cli.consume_stream(timer.wrap(p.stream_chat(prompt)), schema=schema)
+                    rec["ttft"] = timer.ttft
+                else:
+                    out, aborted = p.chat(prompt), None
+                rec["latency"] = time.perf_counter() - timer.started
+                if schema:
+                    rec["valid"] = False if aborted else cli.check_schema(out, schema)[0]
+            except Exception as e:
+                rec.update(ok=False, error=f"{type(e).__name__}: {e}")
+            return rec
+
+        if trace_memory: tracemalloc.start()
+        cpu0, t0 = time.process_time(), time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            records = list(pool.map(one, rows))
+        wall, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+        alloc_peak = None
+        if trace_memory:
+            alloc_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+    metrics = summarize(records, wall, cpu, rss_kb, alloc_peak, schema)
+    result = {
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"prompt_file": prompt_file, "schema": schema, "provider": provider,
+                   "requests": requests_n, "concurrency": concurrency, "stream": stream,
+                   "latency": latency, "error_rate": error_rate, "invalid_rate": invalid_rate},
+        "env": {"python": platform.python_version(), "machine": platform.machine()},
+        "metrics": metrics,
+    }
+    print(metrics)
+    errors = [r["error"] for r in records if not r["ok"]]
+    if errors:
+        print(f"[yellow]Ошибок: {len(errors)}; первая:[/yellow] {errors[0]}")
+    if save:
+        os.makedirs(os.path.dirname(save) or ".", exist_ok=True)
+        with open(save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"[bold]Сохранено:[/bold] {save}")
+    if baseline:
+        with open(baseline, "r", encoding="utf-8") as f:
+            regressions = compare_metrics(metrics, json.load(f)["metrics"], tolerance)
+        if regressions:
+            print("[bold red]Регрессии относительно базового прогона:[/bold red]")
+            for line in regressions: print(" -", line)
+            raise typer.Exit(1)
+        print("[bold cyan]Регрессий нет[/bold cyan]")
+
+@app.command("compare")
+def compare(current: str, baseline: str, tolerance: float = typer.Option(0.10)):
+    """Сравнить два сохранённых результата."""
+    with open(current, "r", encoding="utf-8") as f: cur = json.load(f)["metrics"]
+    with open(baseline, "r", encoding="utf-8") as f: base = json.load(f)["metrics"]
+    regressions = compare_metrics(cur, base, tolerance)
+    for line in regressions: print(" -", line)
+    if regressions:
+        raise typer.Exit(1)
+    print("[bold cyan]Регрессий нет[/bold cyan]")
+
+if __name__ == "__main__":
+    app()
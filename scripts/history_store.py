@@ -0,0 +1,222 @@
+"""
+История прогонов (SQLite), общая для Streamlit и CLI (`chat`, `batch`).
+
+Запись только добавляется. Короткие поля (время, провайдер, шаблон, схема, валидность,
+тайминги) лежат в `runs` с индексами под фильтры истории; промпт, ответ и переменные —
+в `run_payloads` и читаются по одной записи, когда их открыли. Страницы выбираются по
+ключу (id < курсора), поэтому их стоимость не растёт с размером истории.
+Экспорт и импорт — потоковые, JSONL (импорт понимает и прежний JSON‑список из UI).
+"""
+import json, os, sqlite3, threading, time, typing as T
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PATH = os.path.join(ROOT, ".cache", "history.sqlite")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts TEXT NOT NULL,
+    created REAL NOT NULL,
+    source TEXT NOT NULL,
+    provider TEXT,
+    model TEXT,
+    temperature REAL,
+    template TEXT,
+    schema TEXT,
+    valid INTEGER,
+    cached INTEGER,
+    ttft REAL,
+    elapsed REAL,
+    meta TEXT
+);
+CREATE TABLE IF NOT EXISTS run_payloads (
+    run_id INTEGER PRIMARY KEY,
+    variables TEXT,
+    compiled TEXT,
+    response TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_created ON runs(created);
+CREATE INDEX IF NOT EXISTS runs_template ON runs(template);
+CREATE INDEX IF NOT EXISTS runs_schema ON runs(schema);
+CREATE INDEX IF NOT EXISTS runs_valid ON runs(valid);
+"""
+
+# Поля записи истории, которые хранятся в колонках; остальное уходит в meta (JSON)
+_COLUMNS = ("ts", "provider", "model", "temperature", "template", "schema", "valid", "cached", "ttft", "elapsed")
+_PAYLOAD = ("variables", "compiled", "response")
+
+def _parse_ts(ts: T.Optional[str]) -> float:
+    try:
+        return time.mktime(time.strptime(ts, "%Y-%m-%dT%H:%M:%S"))
+    except (TypeError, ValueError):
+        return time.time()
+
+def _bool(v) -> T.Optional[int]:
+    return None if v is None else int(bool(v))
+
+class HistoryStore:
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _insert(self, conn: sqlite3.Connection, entry: dict, source: str) -> int:
+        ts = entry.get("ts") or time.strftime("%Y-%m-%dT%H:%M:%S")
+        meta = {k: v for k, v in entry.items() if k not in _COLUMNS and k not in _PAYLOAD and k not in ("id", "source")}
+        cur = conn.execute(
+            "INSERT INTO runs(ts, created, source, provider, model, temperature, template, schema, valid, cached, ttft, elapsed, meta)"
+            " VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            (ts, _parse_ts(ts) if entry.get("ts") else time.time(), entry.get("source") or source,
+             entry.get("provider"), entry.get("model"), entry.get("temperature"), entry.get("template"),
+             entry.get("schema"), _bool(entry.get("valid")), _bool(entry.get("cached")),
+             entry.get("ttft"), entry.get("elapsed"),
+             json.dumps(meta, ensure_ascii=False) if meta else None))
+        run_id = cur.lastrowid
+        conn.execute("INSERT INTO run_payloads(run_id, variables, compiled, response) VALUES (?,?,?,?)",
+                     (run_id, json.dumps(entry.get("variables") or {}, ensure_ascii=False),
+                      entry.get("compiled"), entry.get("response")))
+        return run_id
+
+    def add(self, entry: dict, source: str = "ui") -> int:
+        """Добавляет запись (в формате истории UI); возвращает её id."""
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            return self._insert(conn, entry, source)
+
+    def add_many(self, entries: T.Iterable[dict], source: str = "import", batch: int = 1000) -> int:
+        """Пакетная вставка транзакциями по `batch` записей; возвращает число записей."""
+        conn, n = self._conn(), 0
+        it = iter(entries)
+        while True:
+            with conn:
+                conn.execute("BEGIN")
+                k = 0
+                for entry in it:
+                    self._insert(conn, entry, source)
+                    k += 1
+                    if k == batch:
+                        break
+            n += k
+            if k < batch:
+                return n
+
+    @staticmethod
+    def _where(template: T.Optional[str] = None, schema: T.Optional[str] = None,
+               valid: T.Optional[bool] = None, source: T.Optional[str] = None,
+               since: T.Optional[float] = None, until: T.Optional[float] = None) -> T.Tuple[str, list]:
+        """Условие фильтра. `valid`: True/False; "unknown" — записи без проверки схемы."""
+        cond, args = [], []
+        if template: cond.append("template=?"); args.append(template)
+        if schema: cond.append("schema=?"); args.append(schema)
+        if valid == "unknown": cond.append("valid IS NULL")
+        elif valid is not None: cond.append("valid=?"); args.append(int(bool(valid)))
+        if source: cond.append("source=?"); args.append(source)
+        if since is not None: cond.append("created>=?"); args.append(since)
+        if until is not None: cond.append("created<?"); args.append(until)
+        return (" WHERE " + " AND ".join(cond)) if cond else "", args
+
+    def page(self, before: T.Optional[int] = None, limit: int = 20, **filters) -> T.List[dict]:
+        """Записи от новых к старым, с id < `before`; без промпта и ответа."""
+        where, args = self._where(**filters)
+        if before is not None:
+            where += (" AND " if where else " WHERE ") + "id<?"
+            args.append(before)
+        cur = self._conn().execute(
+            "SELECT id, ts, source, provider, model, temperature, template, schema, valid, cached, ttft, elapsed, meta"
+            f" FROM runs{where} ORDER BY id DESC LIMIT ?", args + [limit])
+        return [self._row(r) for r in cur]
+
+    @staticmethod
+    def _row(r) -> dict:
+        row = {"id": r[0], "ts": r[1], "source": r[2], "provider": r[3], "model": r[4], "temperature": r[5],
+               "template": r[6], "schema": r[7], "valid": None if r[8] is None else bool(r[8]),
+               "cached": None if r[9] is None else bool(r[9]), "ttft": r[10], "elapsed": r[11]}
+        if r[12]:
+            row.update(json.loads(r[12]))
+        return row
+
+    def count(self, **filters) -> int:
+        where, args = self._where(**filters)
+        return self._conn().execute(f"SELECT COUNT(*) FROM runs{where}", args).fetchone()[0]
+
+    def payload(self, run_id: int) -> dict:
+        """Переменные, скомпилированный промпт и ответ одной записи."""
+        r = self._conn().execute("SELECT variables, compiled, response FROM run_payloads WHERE run_id=?",
+                                 (run_id,)).fetchone()
+        if r is None:
+            return {"variables": {}, "compiled": None, "response": None}
+        return {"variables": json.loads(r[0] or "{}"), "compiled": r[1], "response": r[2]}
+
+    def distinct(self, column: str) -> T.List[str]:
+        """Значения для фильтров (по индексу, без чтения строк)."""
+        if column not in ("template", "schema", "source"):
+            raise ValueError(column)
+        return [r[0] for r in self._conn().execute(
+            f"SELECT DISTINCT {column} FROM runs WHERE {column} IS NOT NULL ORDER BY {column}")]
+
+    def iter_export(self, **filters) -> T.Iterator[str]:
+        """Строки JSONL (с переносом) от старых к новым; читаются порциями."""
+        where, args = self._where(**filters)
+        cur = self._conn().execute(
+            "SELECT r.id, r.ts, r.source, r.provider, r.model, r.temperature, r.template, r.schema, r.valid,"
+            " r.cached, r.ttft, r.elapsed, r.meta, p.variables, p.compiled, p.response"
+            f" FROM runs r LEFT JOIN run_payloads p ON p.run_id=r.id{where} ORDER BY r.id",
+            args)
+        while True:
+            rows = cur.fetchmany(500)
+            if not rows:
+                return
+            for r in rows:
+                rec = self._row(r[:13])
+                rec.update(variables=json.loads(r[13] or "{}"), compiled=r[14], response=r[15])
+                yield json.dumps(rec, ensure_ascii=False) + "\n"
+
+    def import_stream(self, f: T.TextIO) -> int:
+        """
+        Импорт из текстового потока: JSONL (по записи на строку) читается построчно,
+        прежний экспорт UI (JSON‑список) — целиком. id из файла не сохраняются.
+        """
+        head = f.read(1)
+        while head and head.isspace():
+            head = f.read(1)
+        if head == "[":
+            return self.add_many(reversed(json.loads(head + f.read())))  # в экспорте UI новые — первыми
+        def entries():
+            first = True
+            for line in f:
+                if first:
+                    line, first = head + line, False
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        return self.add_many(entries())
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM run_payloads")
+            conn.execute("DELETE FROM runs")
+
+_default: T.Optional[HistoryStore] = None
+_default_lock = threading.Lock()
+
+def get_history() -> HistoryStore:
+    """Общее для процесса хранилище; путь переопределяется переменной HISTORY_DB_PATH."""
+    global _default
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = HistoryStore(os.environ.get("HISTORY_DB_PATH") or DEFAULT_PATH)
+    return _default
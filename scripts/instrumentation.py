@@ -0,0 +1,197 @@
+"""
+Инструментирование вызовов модели: фазы (спаны), токены из `usage`, повторы, попадания в кеш.
+
+Трасса открывается на один прогон шаблона (`with trace(template=..., model=...)`) и видна
+нижним слоям через contextvars: транспорт, кеш OAuth‑токена, кеш ответов и проверка
+схемы отмечают свои фазы, ничего не зная о вызывающем коде. Вне трассы отметка стоит
+одного чтения contextvar.
+
+Фазы: `oauth` — получение токена, `http` — запрос до заголовков ответа (с повторами),
+`backoff` — паузы между повторами, `stream` — чтение потокового ответа, `cache` — поиск
+в кеше ответов, `retrieval` — поиск пассажей, `extract_json` и `validate` — разбор ответа
+и проверка по схеме.
+
+Завершённые трассы агрегируются по (шаблон, модель) в `metrics`; экспорт — JSON lines и
+текстовый формат Prometheus. Если задан LLM_TRACE_LOG, каждая трасса дописывается в этот
+JSONL — по нему `run.py metrics` строит ту же сводку для прогонов из CLI.
+"""
+import contextlib, contextvars, json, os, threading, time, typing as T
+
+COUNTERS = ("cache_hits", "retries", "hedges", "fallbacks", "prompt_tokens", "completion_tokens")
+BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Trace:
+    """
+    Один прогон: метки, суммарное время по фазам и счётчики. Под замком: попытки
+    маршрутизатора (хеджирование, резерв) пишут в трассу из потоков его пула одновременно.
+    """
+    def __init__(self, **labels):
+        self.labels = labels
+        self.spans: T.Dict[str, float] = {}
+        self.counters: T.Dict[str, int] = {}
+        self.started = time.perf_counter()
+        self.total: T.Optional[float] = None
+        self.error: T.Optional[str] = None
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def incr(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self) -> dict:
+        total = self.total if self.total is not None else time.perf_counter() - self.started
+        with self._lock:
+            spans, counters = dict(self.spans), dict(self.counters)
+        return {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), **self.labels, "total": round(total, 4),
+                "error": self.error, "spans": {k: round(v, 4) for k, v in spans.items()},
+                **counters}
+
+_current: contextvars.ContextVar[T.Optional[Trace]] = contextvars.ContextVar("llm_trace", default=None)
+
+def current() -> T.Optional[Trace]:
+    return _current.get()
+
+def add_span(name: str, seconds: float):
+    tr = _current.get()
+    if tr is not None:
+        tr.add_span(name, seconds)
+
+def incr(name: str, n: int = 1):
+    tr = _current.get()
+    if tr is not None:
+        tr.incr(name, n)
+
+@contextlib.contextmanager
+def span(name: str):
+    tr = _current.get()
+    if tr is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        tr.add_span(name, time.perf_counter() - t0)
+
+def record_usage(usage: T.Optional[dict]):
+    """Токены из блока `usage` ответа chat completions."""
+    tr = _current.get()
+    if tr is None or not usage:
+        return
+    tr.incr("prompt_tokens", int(usage.get("prompt_tokens") or 0))
+    tr.incr("completion_tokens", int(usage.get("completion_tokens") or 0))
+
+class Metrics:
+    """Агрегаты трасс по (шаблон, модель); потокобезопасно, живёт до конца процесса."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series: T.Dict[T.Tuple[str, str], dict] = {}
+
+    def observe(self, rec: dict):
+        key = (rec.get("template") or "", rec.get("model") or "")
+        total = rec.get("total") or 0.0
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = {"requests": 0, "errors": 0, **{c: 0 for c in COUNTERS},
+                                         "seconds_sum": 0.0, "seconds_max": 0.0,
+                                         "buckets": [0] * len(BUCKETS), "spans": {}}
+            s["requests"] += 1
+            s["errors"] += 1 if rec.get("error") else 0
+            for c in COUNTERS:
+                s[c] += int(rec.get(c) or 0)
+            s["seconds_sum"] += total
+            s["seconds_max"] = max(s["seconds_max"], total)
+            for i, le in enumerate(BUCKETS):
+                if total <= le:
+                    s["buckets"][i] += 1
+            for name, sec in (rec.get("spans") or {}).items():
+                cnt_sum = s["spans"].setdefault(name, [0, 0.0])
+                cnt_sum[0] += 1
+                cnt_sum[1] += sec
+
+    def snapshot(self) -> T.List[dict]:
+        """Строка на (шаблон, модель): счётчики, среднее/максимум времени, среднее по фазам."""
+        with self._lock:
+            items = [(k, dict(v, spans={n: list(cs) for n, cs in v["spans"].items()})) for k, v in self._series.items()]
+        rows = []
+        for (template, model), s in sorted(items):
+            n = s["requests"]
+            rows.append({"template": template, "model": model, "requests": n, "errors": s["errors"],
+                         **{c: s[c] for c in COUNTERS},
+                         "avg_seconds": round(s["seconds_sum"] / n, 4) if n else None,
+                         "max_seconds": round(s["seconds_max"], 4),
+                         "spans_avg": {name: round(sec / cnt, 4) for name, (cnt, sec) in sorted(s["spans"].items())}})
+        return rows
+
+    def iter_jsonl(self) -> T.Iterator[str]:
+        for row in self.snapshot():
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+
+    def to_prometheus(self) -> str:
+        with self._lock:
+            items = sorted((k, dict(v, spans=dict(v["spans"]))) for k, v in self._series.items())
+        out: T.List[str] = []
+        def labels(template: str, model: str, **extra) -> str:
+            pairs = {"template": template, "model": model, **extra}
+            return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in pairs.items()) + "}"
+        counters = [("llm_requests_total", "requests", "Прогоны шаблона"),
+                    ("llm_errors_total", "errors", "Прогоны, завершившиеся ошибкой"),
+                    ("llm_cache_hits_total", "cache_hits", "Ответы из кеша"),
+                    ("llm_retries_total", "retries", "Повторы HTTP‑запросов"),
+                    ("llm_hedges_total", "hedges", "Хеджирующие запросы к следующему бэкенду (router.py)"),
+                    ("llm_fallbacks_total", "fallbacks", "Переходы к резервному бэкенду после ошибки (router.py)"),
+                    ("llm_prompt_tokens_total", "prompt_tokens", "Токены промпта (usage)"),
+                    ("llm_completion_tokens_total", "completion_tokens", "Токены ответа (usage)")]
+        for name, field, help_text in counters:
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            out += [f"{name}{labels(t, m)} {s[field]}" for (t, m), s in items]
+        name = "llm_request_duration_seconds"
+        out += [f"# HELP {name} Полное время прогона", f"# TYPE {name} histogram"]
+        for (t, m), s in items:
+            for le, cnt in zip(BUCKETS, s["buckets"]):
+                out.append(f"{name}_bucket{labels(t, m, le=repr(le))} {cnt}")
+            out.append(f"{name}_bucket{labels(t, m, le='+Inf')} {s['requests']}")
+            out.append(f"{name}_sum{labels(t, m)} {s['seconds_sum']:.6f}")
+            out.append(f"{name}_count{labels(t, m)} {s['requests']}")
+        name = "llm_phase_duration_seconds"
+        out += [f"# HELP {name} Время по фазам прогона", f"# TYPE {name} summary"]
+        for (t, m), s in items:
+            for phase, (cnt, sec) in sorted(s["spans"].items()):
+                out.append(f"{name}_sum{labels(t, m, phase=phase)} {sec:.6f}")
+                out.append(f"{name}_count{labels(t, m, phase=phase)} {cnt}")
+        return "\n".join(out) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+metrics = Metrics()
+_log_lock = threading.Lock()
+
+@contextlib.contextmanager
+def trace(**labels) -> T.Iterator[Trace]:
+    """Трасса прогона; по выходу попадает в `metrics` и (при LLM_TRACE_LOG) в JSONL."""
+    tr = Trace(**labels)
+    token = _current.set(tr)
+    try:
+        yield tr
+    except BaseException as e:
+        tr.error = type(e).__name__
+        raise
+    finally:
+        tr.total = time.perf_counter() - tr.started
+        _current.reset(token)
+        rec = tr.as_dict()
+        metrics.observe(rec)
+        path = os.environ.get("LLM_TRACE_LOG")
+        if path:
+            with _log_lock, open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
@@ -0,0 +1,223 @@
+"""
+Общий HTTP‑транспорт для провайдеров (CLI и Streamlit):
+- один пул keep‑alive соединений на процесс (без TLS‑рукопожатия на каждый запрос);
+- потокобезопасный кеш OAuth‑токена с упреждающим обновлением по `expires_at`;
+- ограниченные повторы на 429/5xx и сетевых ошибках с джиттером и учётом `Retry-After`;
+- разбор потоковых ответов (SSE) chat completions и замер time‑to‑first‑token.
+Фазы `http`, `backoff`, `oauth`, `stream`, число повторов и `usage` попадают в текущую
+трассу (instrumentation.py), если она открыта.
+"""
+import json, random, threading, time, typing as T
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from instrumentation import add_span, incr, record_usage, span
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+class RetryAfterTooLong(requests.HTTPError):
+    """Сервер просит подождать дольше `backoff_cap`: повторять раньше срока бессмысленно."""
+    def __init__(self, r: requests.Response, retry_after: float, cap: float):
+        self.retry_after = retry_after
+        super().__init__(f"HTTP {r.status_code}: Retry-After {retry_after:.0f} с больше предела {cap:.0f} с", response=r)
+
+_session: T.Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+def get_session(pool_maxsize: int = 64) -> requests.Session:
+    """Общая для процесса сессия с пулом соединений (создаётся лениво один раз)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _session = s
+    return _session
+
+def retry_after_seconds(r: requests.Response) -> T.Optional[float]:
+    """Значение заголовка Retry-After в секундах (число или HTTP‑дата), либо None."""
+    raw = r.headers.get("Retry-After")
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(raw).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 20.0) -> float:
+    """Экспоненциальная задержка с полным джиттером: U(0, min(cap, base·2^attempt))."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+class Transport:
+    """POST через общий пул с ограниченным числом повторов."""
+    def __init__(self, max_retries: int = 3, backoff_base: float = 0.5, backoff_cap: float = 20.0,
+                 session: T.Optional[requests.Session] = None):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.session = session or get_session()
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """
+        Как `requests.post`, но с повторами. Последний ответ (в т.ч. 429/5xx) возвращается как есть.
+        Пауза — ровно `Retry-After`, если сервер его прислал; если он дольше `backoff_cap` —
+        RetryAfterTooLong сразу, без повтора раньше срока.
+        """
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            if attempt: incr("retries")
+            try:
+                with span("http"):
+                    r = self.session.post(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if last: raise
+                with span("backoff"):
+                    time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_cap))
+                continue
+            if r.status_code not in RETRY_STATUSES or last:
+                return r
+            delay = retry_after_seconds(r)
+            if delay is None:
+                delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap)
+            elif delay > self.backoff_cap:
+                r.close()
+                raise RetryAfterTooLong(r, delay, self.backoff_cap)
+            r.close()
+            with span("backoff"):
+                time.sleep(delay)
+        raise AssertionError("unreachable")
+
+class TokenCache:
+    """
+    Кеш OAuth‑токена. `fetch()` возвращает (токен, expires_at в секундах epoch или None).
+    Токен обновляется заранее — за `skew` секунд до истечения; при одновременном
+    обращении из многих потоков запрос за новым токеном делает только один.
+    """
+    def __init__(self, fetch: T.Callable[[], T.Tuple[str, T.Optional[float]]],
+                 skew: float = 60.0, default_ttl: float = 25 * 60):
+        self._fetch = fetch
+        self.skew = skew
+        self.default_ttl = default_ttl
+        self._token: T.Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def _fresh(self) -> bool:
+        return self._token is not None and time.time() < self._expires_at - self.skew
+
+    def get(self) -> str:
+        if self._fresh():
+            return self._token
+        with self._lock:
+            if not self._fresh():
+                with span("oauth"):
+                    token, expires_at = self._fetch()
+                self._token = token
+                self._expires_at = expires_at or (time.time() + self.default_ttl)
+            return self._token
+
+    def invalidate(self, token: T.Optional[str] = None):
+        """Сбросить токен (например, после 401). Если передан `token`, сбрасывается
+        только он — чтобы не выбросить уже обновлённый другим потоком."""
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0.0
+
+def parse_expires_at(value) -> T.Optional[float]:
+    """`expires_at` из ответа OAuth GigaChat приходит в миллисекундах epoch."""
+    if value is None:
+        return None
+    value = float(value)
+    return value / 1000.0 if value > 1e11 else value
+
+def _iter_body(r: requests.Response, size: int = 1 << 16) -> T.Iterator[bytes]:
+    """Тело ответа кусками по мере прихода: всё, что уже пришло, но не больше `size` байт."""
+    if r.headers.get("Transfer-Encoding", "").lower() == "chunked":
+        return r.iter_content(chunk_size=None)  # кусок на chunk сервера
+    read1 = getattr(r.raw, "read1", None)
+    if read1 is None:  # urllib3 < 2.3: read(size) ждал бы полного буфера — читаем мелко
+        return r.iter_content(chunk_size=1)
+    # Content-Length или тело до закрытия соединения: read1 не ждёт, пока наберётся `size`
+    return iter(lambda: read1(size, decode_content=True), b"")
+
+def _iter_lines(r: requests.Response) -> T.Iterator[bytes]:
+    buf = b""
+    for chunk in _iter_body(r):
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if buf:
+        yield buf.rstrip(b"\r")
+
+def iter_sse_data(r: requests.Response) -> T.Iterator[str]:
+    """
+    Поля `data:` событий SSE по мере поступления. После `[DONE]` поток дочитывается
+    до конца без выдачи событий — иначе соединение не вернётся в пул keep‑alive.
+    """
+    data: T.List[str] = []
+    done = False
+    for line in _iter_lines(r):
+        line = line.decode("utf-8")
+        if not line:
+            # пустая строка — конец события
+            if data:
+                payload = "\n".join(data)
+                data = []
+                if payload.strip() == "[DONE]":
+                    done = True
+                elif not done:
+                    yield payload
+            continue
+        if line.startswith("data:"):
+            data.append(line[5:].lstrip(" "))
+    if data and not done and "\n".join(data).strip() != "[DONE]":
+        yield "\n".join(data)
+
+def iter_chat_deltas(r: requests.Response) -> T.Iterator[str]:
+    """
+    Текстовые фрагменты потокового chat completion (формат OpenAI, его же использует GigaChat).
+    Ответ закрывается при выходе из генератора — в т.ч. при досрочной остановке потребителем.
+    """
+    t0 = time.perf_counter()
+    try:
+        with r:
+            for payload in iter_sse_data(r):
+                event = json.loads(payload)
+                record_usage(event.get("usage"))  # приходит в последнем событии, если сервер его шлёт
+                for choice in event.get("choices") or ():
+                    piece = (choice.get("delta") or {}).get("content")
+                    if piece:
+                        yield piece
+    finally:
+        add_span("stream", time.perf_counter() - t0)
+
+class StreamTimer:
+    """Замер времени до первого фрагмента (ttft) и полного времени потокового вызова."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.ttft: T.Optional[float] = None
+        self.total: T.Optional[float] = None
+
+    def wrap(self, chunks: T.Iterable[str]) -> T.Iterator[str]:
+        try:
+            for chunk in chunks:
+                if self.ttft is None:
+                    self.ttft = time.perf_counter() - self.started
+                yield chunk
+        finally:
+            self.total = time.perf_counter() - self.started
+            close = getattr(chunks, "close", None)
+            if close: close()  # досрочный выход потребителя обрывает и исходный поток
+
+    def as_dict(self) -> dict:
+        r3 = lambda v: None if v is None else round(v, 3)
+        return {"ttft": r3(self.ttft), "total": r3(self.total)}
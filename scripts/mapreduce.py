@@ -0,0 +1,269 @@
+"""
+Извлечение по большим документам: map‑reduce с потоковым чтением и контрольной точкой.
+
+- Файл читается блоками и режется на чанки по границам абзацев (иначе — предложений)
+  с перекрытием: следующий чанк начинается с последних предложений предыдущего, чтобы
+  реквизит на стыке попал в чанк целиком. В памяти — текущий буфер и окно чанков в работе.
+- Map: шаблон извлечения (`extract_requisites.md`, `complaint_triage.md`) выполняется на
+  чанках параллельно; частичный результат проверяется по схеме без `required` — в чанке
+  может быть только часть полей.
+- Каждый чанк дописывается в контрольную точку (JSONL); повторный запуск по тому же файлу
+  и параметрам пропускает готовые чанки. Reduce читает частичные результаты оттуда же,
+  построчно.
+- Reduce: списки — объединение без дублей; прочие поля — большинство голосов, при равенстве
+  побеждает значение из более раннего чанка. Соседние чанки видят общее перекрытие, поэтому
+  одно значение из пары соседних считается одним голосом: серия из k соседних чанков — ⌈k/2⌉.
+  Итог проверяется по полной схеме.
+"""
+import hashlib, json, os, re, typing as T
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from schema_validation import compile_validator, error_message, validate_output
+from self_consistency import normalize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHECKPOINT_DIR = os.environ.get("EXTRACT_CHECKPOINT_DIR") or os.path.join(ROOT, ".cache", "extract")
+
+_SCHEMA_REF_RE = re.compile(r"banking/schemas/[\w.-]+\.json")
+_SENTENCE_END_RE = re.compile(r"[.!?…;](?=\s)|\n")
+_PARAGRAPH_RE = re.compile(r"\n[ \t]*\r?\n")  # файл читается с newline="" — переводы строк как в файле
+
+class Chunk(T.NamedTuple):
+    index: int
+    start: int       # смещение в символах от начала файла
+    text: str
+    end_byte: int    # смещение конца чанка в байтах — для прогресса
+
+def schema_from_template(text: str) -> T.Optional[str]:
+    """Путь схемы, упомянутой в шаблоне (`Верни JSON по схеме: banking/schemas/...`)."""
+    m = _SCHEMA_REF_RE.search(text)
+    return m.group(0) if m else None
+
+def _cut(buf: str, lo: int, hi: int) -> int:
+    """Где закончить чанк в buf[lo:hi]: после последнего абзаца, иначе предложения, иначе hi."""
+    end = -1
+    for m in _PARAGRAPH_RE.finditer(buf, lo, hi):
+        end = m.end()
+    if end != -1:
+        return end
+    for m in _SENTENCE_END_RE.finditer(buf, lo, hi):
+        end = m.end()
+    return end if end != -1 else hi
+
+def _overlap_start(buf: str, cut: int, overlap: int) -> int:
+    """Начало следующего чанка: первая граница предложения в последних `overlap` символах."""
+    if overlap <= 0:
+        return cut
+    m = _SENTENCE_END_RE.search(buf, max(0, cut - overlap), cut)
+    if m is None or m.end() >= cut:
+        return cut  # предложение длиннее перекрытия — стык без перекрытия
+    start = m.end()
+    while start < cut and buf[start].isspace():
+        start += 1
+    return start
+
+def iter_chunks(f: T.TextIO, max_chars: int = 6000, overlap: int = 600, block: int = 1 << 16) -> T.Iterator[Chunk]:
+    """
+    Чанки не длиннее `max_chars` из текстового потока; файл целиком не читается.
+    `end_byte` точен, если файл открыт с newline="" (иначе '\r' из CRLF теряются при чтении).
+    """
+    if overlap >= max_chars // 2:
+        raise ValueError("перекрытие должно быть меньше половины чанка")
+    buf, base, base_byte, index, covered, eof = "", 0, 0, 0, 0, False
+    while True:
+        while not eof and len(buf) <= max_chars:
+            data = f.read(block)
+            if data:
+                buf += data
+            else:
+                eof = True
+        if eof and len(buf) <= max_chars:
+            if base + len(buf) > covered and buf.strip():  # после перекрытия есть новый текст
+                yield Chunk(index, base, buf, base_byte + len(buf.encode("utf-8")))
+            return
+        cut = _cut(buf, max_chars // 2, max_chars)
+        yield Chunk(index, base, buf[:cut], base_byte + len(buf[:cut].encode("utf-8")))
+        index, covered = index + 1, base + cut
+        start = _overlap_start(buf, cut, overlap)
+        base_byte += len(buf[:start].encode("utf-8"))
+        buf, base = buf[start:], base + start
+
+def relax_schema(schema: dict) -> dict:
+    """Схема частичного результата: те же поля и ограничения, но без обязательных."""
+    return {k: v for k, v in schema.items() if k != "required"}
+
+def _votes(chunks: T.Iterable[int]) -> int:
+    """Голоса за значение: в каждой серии соседних чанков k → ⌈k/2⌉ (пара соседних — один голос)."""
+    votes, run, prev = 0, 0, None
+    for c in sorted(chunks):
+        run = run + 1 if prev is not None and c == prev + 1 else 1
+        votes += run % 2
+        prev = c
+    return votes
+
+class Reducer:
+    """Слияние частичных объектов; порядок поступления не важен — решает номер чанка."""
+    def __init__(self, schema: dict, overlapping: bool = True):
+        """`overlapping` — чанки нарезаны с перекрытием: соседние не голосуют дважды."""
+        props = schema.get("properties") or {}
+        self.array_fields = {k for k, sub in props.items() if sub.get("type") == "array"}
+        self.overlapping = overlapping
+        self.votes: T.Dict[str, T.Dict[T.Hashable, list]] = {}  # поле → значение → [чанки, первый чанк, значение]
+        self.items: T.Dict[str, T.Dict[T.Hashable, list]] = {}  # поле‑список → элемент → [первый чанк, значение]
+        self.merged = 0
+
+    def add(self, chunk: int, obj: dict):
+        self.merged += 1
+        for field, value in obj.items():
+            if field in self.array_fields and isinstance(value, list):
+                seen = self.items.setdefault(field, {})
+                for item in value:
+                    slot = seen.setdefault(normalize(item), [chunk, item])
+                    if chunk < slot[0]: slot[:] = [chunk, item]
+                continue
+            if value is None or value == "":
+                continue
+            slot = self.votes.setdefault(field, {}).setdefault(normalize(value), [set(), chunk, value])
+            slot[0].add(chunk)
+            if chunk < slot[1]: slot[1:] = [chunk, value]
+
+    def _ranked(self, options: T.Dict[T.Hashable, list]) -> T.List[T.Tuple[int, int, T.Any]]:
+        """(голоса, первый чанк, значение) по убыванию голосов, при равенстве — по чанку."""
+        count = _votes if self.overlapping else len
+        return sorted(((count(s[0]), s[1], s[2]) for s in options.values()), key=lambda r: (-r[0], r[1]))
+
+    def result(self) -> dict:
+        out = {}
+        for field, options in self.votes.items():
+            out[field] = self._ranked(options)[0][2]
+        for field, seen in self.items.items():
+            out[field] = [v for _, v in sorted(seen.values(), key=lambda s: s[0])]
+        return out
+
+    def conflicts(self) -> T.Dict[str, T.List[dict]]:
+        """Поля, где чанки дали разные значения: варианты с числом голосов."""
+        return {field: [{"value": value, "votes": votes, "first_chunk": first}
+                        for votes, first, value in self._ranked(options)]
+                for field, options in self.votes.items() if len(options) > 1}
+
+def default_checkpoint(input_path: str, template_path: str) -> str:
+    key = hashlib.sha1(f"{os.path.abspath(input_path)}\n{os.path.abspath(template_path)}".encode("utf-8")).hexdigest()[:12]
+    return os.path.join(CHECKPOINT_DIR, f"{os.path.basename(input_path)}.{key}.jsonl")
+
+def _read_checkpoint(path: str, header: dict) -> T.Optional[T.Set[int]]:
+    """Номера готовых чанков или None, если точки нет или она от другого файла/параметров."""
+    if not os.path.exists(path):
+        return None
+    done = set()
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            if json.loads(f.readline()).get("header") != header:
+                return None
+        except ValueError:
+            return None
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # обрезанная последняя строка после прерывания
+            if rec.get("ok"):
+                done.add(rec["chunk"])
+    return done
+
+class ExtractResult:
+    def __init__(self):
+        self.result: T.Optional[dict] = None
+        self.error: T.Optional[str] = None  # ошибка проверки итога по полной схеме
+        self.conflicts: T.Dict[str, T.List[dict]] = {}
+        self.stats = {"chunks": 0, "skipped": 0, "ok": 0, "failed": 0, "invalid": 0, "merged": 0}
+
+    def as_dict(self) -> dict:
+        return {"result": self.result, "error": self.error, "conflicts": self.conflicts, **self.stats}
+
+def run_extract(call: T.Callable[[str], str], tpl, input_path: str, text_var: str, schema: dict,
+                values: T.Optional[T.Mapping[str, str]] = None, checkpoint: T.Optional[str] = None,
+                template_id: str = "", concurrency: int = 4, max_chars: int = 6000, overlap: int = 600,
+                on_progress: T.Optional[T.Callable[[dict, float], None]] = None) -> ExtractResult:
+    """
+    `call(prompt) → ответ` — один запрос к модели (кеш, лимиты и трассы — на стороне вызывающего).
+    `template_id` — только для имени контрольной точки по умолчанию.
+    `on_progress(stats, доля файла)` вызывается после каждого чанка; доля — до конца
+    последнего чанка, перед которым все готовы, поэтому она не убывает.
+    """
+    st = os.stat(input_path)
+    digest = lambda obj: hashlib.sha1(json.dumps(obj, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+    # шаблон — по содержимому: правка файла под тем же путём делает точку недействительной
+    header = {"input": os.path.abspath(input_path), "size": st.st_size, "mtime": st.st_mtime,
+              "template": digest([tpl.text, dict(values or {})]), "schema": digest(schema),
+              "max_chars": max_chars, "overlap": overlap}
+    checkpoint = checkpoint or default_checkpoint(input_path, template_id or "template")
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint)), exist_ok=True)
+    done = _read_checkpoint(checkpoint, header)
+    if done is None:
+        done = set()
+        with open(checkpoint, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"header": header}, ensure_ascii=False) + "\n")
+    partial = compile_validator(relax_schema(schema))
+    res = ExtractResult()
+    stats = res.stats
+
+    def map_chunk(chunk: Chunk) -> dict:
+        rec = {"chunk": chunk.index, "start": chunk.start, "chars": len(chunk.text)}
+        try:
+            out = call(tpl.render({**(values or {}), text_var: chunk.text}))
+        except Exception as e:
+            return {**rec, "ok": False, "error": f"{type(e).__name__}: {e}"}
+        obj, err = validate_output(out, partial)
+        if err is not None:
+            return {**rec, "ok": True, "valid": False, "schema_error": err, "response": out[:500]}
+        return {**rec, "ok": True, "valid": True, "partial": obj}
+
+    ends: T.Dict[int, int] = {}  # готовые чанки после первого незавершённого → конец в байтах
+    covered = {"next": 0, "bytes": 0}
+
+    def report(chunk: Chunk):
+        ends[chunk.index] = chunk.end_byte
+        while covered["next"] in ends:
+            covered["bytes"] = ends.pop(covered["next"])
+            covered["next"] += 1
+        if on_progress: on_progress(stats, min(1.0, covered["bytes"] / (st.st_size or 1)))
+
+    with open(checkpoint, "a", encoding="utf-8") as ckpt, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        def finish(fut, chunk: Chunk):
+            rec = fut.result()
+            ckpt.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            ckpt.flush()
+            stats["ok" if rec["ok"] else "failed"] += 1
+            if rec.get("valid") is False: stats["invalid"] += 1
+            report(chunk)
+
+        pending: T.Dict[T.Any, Chunk] = {}
+        with open(input_path, "r", encoding="utf-8", newline="") as f:
+            for chunk in iter_chunks(f, max_chars, overlap):
+                stats["chunks"] += 1
+                if chunk.index in done:
+                    stats["skipped"] += 1
+                    report(chunk)
+                    continue
+                pending[pool.submit(map_chunk, chunk)] = chunk
+                # ограниченное окно чанков в работе — память не зависит от размера файла
+                if len(pending) >= concurrency * 2:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in finished: finish(fut, pending.pop(fut))
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished: finish(fut, pending.pop(fut))
+
+    reducer = Reducer(schema, overlapping=overlap > 0)
+    with open(checkpoint, "r", encoding="utf-8") as f:
+        next(f)
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if rec.get("valid") and isinstance(rec.get("partial"), dict):
+                reducer.add(rec["chunk"], rec["partial"])
+    stats["merged"] = reducer.merged
+    res.result, res.conflicts = reducer.result(), reducer.conflicts()
+    res.error = error_message(compile_validator(schema), res.result)
+    return res
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Локальный заменитель LLM‑API для бенчмарков и отладки без платных вызовов.
+
+Протоколы:
+- POST .../chat/completions — OpenAI‑совместимый (обычный и `stream: true`, SSE);
+- POST .../oauth — выдача токена GigaChat (`access_token`, `expires_at` в мс).
+  Для GigaChat‑клиента: GIGACHAT_OAUTH_URL=<base>/api/v2/oauth, GIGACHAT_API_BASE=<base>/api/v1.
+
+Задержки, доля ошибок и доля невалидных ответов настраиваются; ответы для банковских
+шаблонов подбираются по имени схемы, упомянутой в промпте, для ReAct — по сценарию
+REACT_SCRIPT. GET /stats — счётчики запросов.
+
+    python scripts/mock_server.py --port 8000 --latency lognormal:300,0.5 --error-rate 0.02
+"""
+import json, math, random, sys, threading, time, uuid, typing as T
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import typer
+
+CANNED = {
+    "complaint_schema.json": {"category": "card", "severity": "medium",
+                              "summary": "Клиент сообщает о двойном списании по карте.",
+                              "actions": ["Проверить операции", "Открыть претензию"]},
+    "requisites_schema.json": {"account": "40702810900000000001", "bik": "044525225",
+                               "inn": "7707083893", "kpp": "773601001", "recipient": "ООО «Ромашка»"},
+    "card_reissue_schema.json": {"card_last4": "1234", "reason": "lost", "urgent": True},
+}
+# Нарушения контракта для доли невалидных ответов
+BROKEN = {
+    "complaint_schema.json": {"category": "billing", "severity": "medium", "summary": "—"},
+    "requisites_schema.json": {"account": "40702810900000000001"},
+    "card_reissue_schema.json": {"card_last4": "12", "reason": "lost"},
+}
+DEFAULT_TEXT = "Это ответ тестового сервера. Источник: [doc-1]."
+# Сценарий ReAct по числу уже полученных OBSERVATION; после ACTION — «выдуманное»
+# наблюдение, которое исполнитель должен отрезать, оборвав генерацию
+REACT_SCRIPT = [
+    "THOUGHT: нужно найти правила в документах.\nACTION: SEARCH(релевантность источников)\nOBSERVATION: выдумано моделью\n",
+    "THOUGHT: посчитаю итог.\nACTION(CALC, 1 500 * (2 + 1))\nOBSERVATION: 42\n",
+    "THOUGHT: данных достаточно.\nFINAL_ANSWER: 4500 ₽, см. [doc-1].",
+]
+
+def parse_latency(spec: str) -> T.Callable[[], float]:
+    """
+    Распределение задержки в секундах по спецификации (значения — в мс):
+    `fixed:200`, `uniform:100,400`, `lognormal:<медиана>,<sigma>`.
+    """
+    kind, _, args = spec.partition(":")
+    nums = [float(x) for x in args.split(",") if x]
+    if kind == "fixed":
+        return lambda: nums[0] / 1000
+    if kind == "uniform":
+        return lambda: random.uniform(nums[0], nums[1]) / 1000
+    if kind == "lognormal":
+        mu, sigma = math.log(nums[0]), (nums[1] if len(nums) > 1 else 0.5)
+        return lambda: random.lognormvariate(mu, sigma) / 1000
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+class MockConfig:
+    def __init__(self, latency: str = "fixed:50", error_rate: float = 0.0, invalid_rate: float = 0.0,
+                 token_delay_ms: float = 5.0, chunk_chars: int = 8, token_ttl: float = 1800.0):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.invalid_rate = invalid_rate
+        self.token_delay = token_delay_ms / 1000
+        self.chunk_chars = max(1, chunk_chars)
+        self.token_ttl = token_ttl
+        self.tokens: T.Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.counters = {"chat": 0, "oauth": 0, "errors": 0, "unauthorized": 0}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+def answer_for(prompt: str, cfg: MockConfig) -> str:
+    if "FINAL_ANSWER" in prompt:
+        return REACT_SCRIPT[min(prompt.count("\nOBSERVATION:"), len(REACT_SCRIPT) - 1)]
+    for schema, obj in CANNED.items():
+        if schema in prompt:
+            if random.random() < cfg.invalid_rate:
+                obj = BROKEN[schema]
+            return json.dumps(obj, ensure_ascii=False)
+    return DEFAULT_TEXT
+
+def make_handler(cfg: MockConfig):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep‑alive, как у настоящих API
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, status: int, obj: dict, headers: T.Optional[dict] = None):
+            body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _chunk(self, data: bytes):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/stats":
+                with cfg.lock:
+                    return self._json(200, dict(cfg.counters))
+            self._json(404, {"error": "not found"})
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path.endswith("/oauth"):
+                return self._oauth()
+            if self.path.endswith("/chat/completions"):
+                return self._chat(json.loads(raw or b"{}"))
+            self._json(404, {"error": "not found"})
+
+        def _oauth(self):
+            cfg.count("oauth")
+            token = "mock-" + uuid.uuid4().hex
+            expires = time.time() + cfg.token_ttl
+            with cfg.lock:
+                cfg.tokens[token] = expires
+            self._json(200, {"access_token": token, "expires_at": int(expires * 1000)})
+
+        def _authorized(self) -> bool:
+            auth = self.headers.get("Authorization", "")
+            token = auth[len("Bearer "):] if auth.startswith("Bearer ") else ""
+            if not token.startswith("mock-"):
+                return True  # OpenAI‑совместимый клиент с произвольным ключом
+            with cfg.lock:
+                return cfg.tokens.get(token, 0) > time.time()
+
+        def _chat(self, body: dict):
+            cfg.count("chat")
+            if not self._authorized():
+                cfg.count("unauthorized")
+                return self._json(401, {"error": "token expired"})
+            time.sleep(cfg.latency())
+            if random.random() < cfg.error_rate:
+                cfg.count("errors")
+                if random.random() < 0.5:
+                    return self._json(429, {"error": "rate limited"}, {"Retry-After": "0.05"})
+                return self._json(503, {"error": "unavailable"})
+            prompt = "".join(str(m.get("content", "")) for m in body.get("messages", []))
+            answer = answer_for(prompt, cfg)
+            usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(answer) // 4,
+                     "total_tokens": len(prompt) // 4 + len(answer) // 4}
+            if not body.get("stream"):
+                return self._json(200, {"id": uuid.uuid4().hex, "object": "chat.completion",
+                                        "model": body.get("model"), "usage": usage,
+                                        "choices": [{"index": 0, "finish_reason": "stop",
+                                                     "message": {"role": "assistant", "content": answer}}]})
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for i in range(0, len(answer), cfg.chunk_chars):
+                    event = {"choices": [{"index": 0, "delta": {"content": answer[i:i + cfg.chunk_chars]}}]}
+                    self._chunk(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n")
+                    time.sleep(cfg.token_delay)
+                final = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+                self._chunk(b"data: " + json.dumps(final).encode("utf-8") + b"\n\n")
+                self._chunk(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True  # клиент оборвал генерацию
+    return Handler
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл соединение (оборванный стрим, завершение бенчмарка) — это не ошибка
+        if isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            return
+        super().handle_error(request, client_address)
+
+def start_server(cfg: MockConfig, host: str = "127.0.0.1", port: int = 0):
+    """Запускает сервер в фоновом потоке; возвращает (server, base_url)."""
+    server = MockHTTPServer((host, port), make_handler(cfg))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def main(host: str = typer.Option("127.0.0.1"),
+         port: int = typer.Option(8000, help="0 — любой свободный порт"),
+         latency: str = typer.Option("fixed:50", help="fixed:<мс> | uniform:<мс>,<мс> | lognormal:<медиана мс>,<sigma>"),
+         error_rate: float = typer.Option(0.0, help="Доля ответов 429/503"),
+         invalid_rate: float = typer.Option(0.0, help="Доля ответов, нарушающих схему"),
+         token_delay_ms: float = typer.Option(5.0, help="Пауза между SSE‑фрагментами"),
+         chunk_chars: int = typer.Option(8, help="Символов в одном SSE‑фрагменте"),
+         token_ttl: float = typer.Option(1800.0, help="Время жизни OAuth‑токена, с")):
+    """Запуск заменителя OpenAI‑совместимого API и OAuth GigaChat."""
+    cfg = MockConfig(latency, error_rate, invalid_rate, token_delay_ms, chunk_chars, token_ttl)
+    server, base = start_server(cfg, host, port)
+    # Первая строка stdout — адрес; по ней бенчмарк узнаёт выбранный порт
+    sys.stdout.write(f"READY {base}\n")
+    sys.stdout.flush()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,93 @@
+"""
+Шаблоны промптов: разбор один раз, подстановка за один проход.
+
+Синтаксис совпадает с str.format для наших markdown‑шаблонов:
+`{name}` — переменная, `{{` и `}}` — экранированные фигурные скобки.
+Прочие одиночные скобки (например, JSON без экранирования) остаются как есть.
+"""
+import functools, os, re, threading, typing as T
+
+_TOKEN_RE = re.compile(r"\{\{|\}\}|\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+class MissingVariables(KeyError):
+    """В строгом режиме не переданы значения для переменных шаблона."""
+
+class CompiledTemplate:
+    """Шаблон, разобранный на литералы и слоты. `parts`: str — литерал, int — индекс переменной."""
+    __slots__ = ("parts", "variables", "text")
+
+    def __init__(self, parts: T.Tuple[T.Union[str, int], ...], variables: T.Tuple[str, ...], text: str = ""):
+        self.parts = parts
+        self.variables = variables
+        self.text = text  # исходный текст шаблона
+
+    def check(self, values: T.Mapping[str, T.Any]) -> T.Tuple[T.List[str], T.List[str]]:
+        """(отсутствующие переменные, лишние значения)."""
+        missing = [v for v in self.variables if v not in values]
+        extra = sorted(k for k in values if k not in self.variables)
+        return missing, extra
+
+    def render(self, values: T.Mapping[str, T.Any], strict: bool = False) -> str:
+        """
+        Подстановка за один проход. Без `strict` незаполненные переменные
+        остаются в тексте как `{name}`; со `strict` — MissingVariables.
+        """
+        filled = []
+        for name in self.variables:
+            if name in values:
+                filled.append(str(values[name]))
+            elif strict:
+                raise MissingVariables(", ".join(v for v in self.variables if v not in values))
+            else:
+                filled.append("{" + name + "}")
+        return "".join(p if isinstance(p, str) else filled[p] for p in self.parts)
+
+def compile_template(text: str) -> CompiledTemplate:
+    parts: T.List[T.Union[str, int]] = []
+    index: T.Dict[str, int] = {}
+    buf: T.List[str] = []
+    pos = 0
+    for m in _TOKEN_RE.finditer(text):
+        buf.append(text[pos:m.start()])
+        pos = m.end()
+        name = m.group(1)
+        if name is None:
+            buf.append(m.group(0)[0])  # {{ -> {, }} -> }
+            continue
+        if buf:
+            parts.append("".join(buf))
+            buf = []
+        parts.append(index.setdefault(name, len(index)))
+    buf.append(text[pos:])
+    tail = "".join(buf)
+    if tail:
+        parts.append(tail)
+    return CompiledTemplate(tuple(parts), tuple(index), text)
+
+@functools.lru_cache(maxsize=256)
+def compile_text(text: str) -> CompiledTemplate:
+    """Компиляция текста шаблона с кешем (для шаблонов не из файлов, например загруженных в UI)."""
+    return compile_template(text)
+
+class TemplateRegistry:
+    """Скомпилированные шаблоны по пути; файл перечитывается только при смене mtime."""
+    def __init__(self):
+        self._items: T.Dict[str, T.Tuple[float, CompiledTemplate]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> CompiledTemplate:
+        key = os.path.abspath(path)
+        mtime = os.stat(key).st_mtime
+        item = self._items.get(key)
+        if item is not None and item[0] == mtime:
+            return item[1]
+        with open(key, "r", encoding="utf-8") as f:
+            tpl = compile_template(f.read())
+        with self._lock:
+            self._items[key] = (mtime, tpl)
+        return tpl
+
+registry = TemplateRegistry()
+
+def load_template(path: str) -> CompiledTemplate:
+    return registry.get(path)
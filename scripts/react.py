@@ -0,0 +1,258 @@
+"""
+Исполнитель ReAct (prompts/patterns/06_react.md): THOUGHT → ACTION → OBSERVATION → … → FINAL_ANSWER.
+
+Ответ модели читается потоком; как только в нём появилась законченная строка ACTION,
+генерация обрывается (модель не успевает «придумать» OBSERVATION), действие выполняется
+встроенным инструментом, а результат дописывается в стенограмму как OBSERVATION.
+Результаты инструментов мемоизируются в общем кеше ответов — между шагами и запусками.
+
+Поддерживаемые записи действия: `ACTION: SEARCH(запрос)`, `ACTION(CALC, 2*(3+4))`,
+`ACTION: SEARCH: запрос` (до конца строки).
+"""
+import ast, glob, math, operator, os, re, typing as T
+from response_cache import get_cache
+from retrieval import DEFAULT_INDEX, open_index, tokenize
+
+_ACTION_RE = re.compile(r"ACTION\s*:?\s*(\()?\s*([A-Za-z_]+)\s*([(,:])")
+_FINAL_RE = re.compile(r"FINAL[_ ]ANSWER\s*:?\s*", re.I)
+
+def approx_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+_QUOTES = {'"': '"', "'": "'", "«": "»"}
+
+def _balanced_close(text: str, start: int, depth: int = 1) -> int:
+    """
+    Позиция закрывающей скобки, уравновешивающей `depth` открытых до `start`, либо -1.
+    Кавычка открывает строку, только если стоит сразу после `(` или `,` — апостроф
+    внутри слова (Sberbank's) и «…» посреди текста скобки не прячут.
+    """
+    quote, prev = None, text[start - 1] if start else ""
+    for i in range(start, len(text)):
+        ch = text[i]
+        if quote:
+            if ch == quote: quote = None
+        elif ch in _QUOTES and prev in ("(", ","):
+            quote = _QUOTES[ch]
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+        if not ch.isspace(): prev = ch
+    return -1
+
+def _unquote(args: str) -> str:
+    """Снимает только парные внешние кавычки: `«Премиум»` → `Премиум`, `тариф «Премиум»` — как есть."""
+    if len(args) >= 2 and _QUOTES.get(args[0]) == args[-1]:
+        return args[1:-1].strip()
+    return args
+
+def find_action(text: str) -> T.Optional[T.Tuple[str, str, int]]:
+    """Первое законченное действие в тексте: (имя, аргументы, позиция конца) или None."""
+    for m in _ACTION_RE.finditer(text):
+        outer, name, sep = m.group(1), m.group(2).upper(), m.group(3)
+        if sep == ":":
+            nl = text.find("\n", m.end())
+            if nl == -1:
+                return None  # строка ещё не закончилась
+            args, end = text[m.end():nl], nl
+        else:
+            # ACTION: NAME(args) — глубина 1; ACTION(NAME, args) — закрывает внешняя скобка
+            close = _balanced_close(text, m.end(), depth=1)
+            if close == -1:
+                return None
+            args, end = text[m.end():close], close + 1
+            if outer and sep == "(":
+                outer_close = _balanced_close(text, end, depth=1)
+                if outer_close == -1:
+                    return None
+                end = outer_close + 1
+        return name, _unquote(args.strip()), end
+    return None
+
+def find_final(text: str) -> T.Optional[str]:
+    m = _FINAL_RE.search(text)
+    return text[m.end():].strip() if m else None
+
+# ---------------- Инструменты ----------------
+
+_BIN_OPS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+            ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+            ast.Pow: operator.pow}
+_UNARY_OPS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+_FUNCS = {"abs": abs, "round": round, "min": min, "max": max, "sqrt": math.sqrt, "log": math.log, "exp": math.exp}
+_CONSTS = {"pi": math.pi, "e": math.e}
+
+def safe_calc(expr: str) -> str:
+    """Арифметика без eval: числа, + - * / // % **, скобки и несколько функций."""
+    expr = expr.replace("^", "**").replace("×", "*").replace("÷", "/")
+    expr = re.sub(r"(?<=\d)\s(?=\d{3}\b)", "", expr)  # 1 500 000 → 1500000
+    # 5% → 0.05; «17 % 5» с операндом справа — остаток от деления
+    expr = re.sub(r"(\d+(?:\.\d+)?)\s*%(?!\s*[\w(.])", r"(\1/100)", expr)
+    def ev(node):
+        if isinstance(node, ast.Expression):
+            return ev(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return node.value
+        if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+            left, right = ev(node.left), ev(node.right)
+            if isinstance(node.op, ast.Pow) and (abs(right) > 64 or abs(left) > 1e6):
+                raise ValueError("слишком большая степень")
+            return _BIN_OPS[type(node.op)](left, right)
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+            return _UNARY_OPS[type(node.op)](ev(node.operand))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCS and not node.keywords:
+            return _FUNCS[node.func.id](*[ev(a) for a in node.args])
+        if isinstance(node, ast.Name) and node.id in _CONSTS:
+            return _CONSTS[node.id]
+        raise ValueError(f"недопустимое выражение: {ast.dump(node)[:60]}")
+    if len(expr) > 200:
+        raise ValueError("слишком длинное выражение")
+    value = ev(ast.parse(expr.strip(), mode="eval"))
+    if isinstance(value, float):
+        value = round(value, 10)
+        if value.is_integer(): value = int(value)
+    return str(value)
+
+safe_calc.memo_key = lambda: "CALC"  # пространство имён в кеше результатов инструментов
+
+class LocalCorpus:
+    """
+    Простой поиск по абзацам .md/.txt в каталогах: пересечение слов с весом по редкости.
+    Используется, пока индекс BM25 (run.py index build) не построен.
+    """
+    def __init__(self, dirs: T.Sequence[str]):
+        self.dirs = list(dirs)
+        self.passages: T.List[T.Tuple[str, str, T.Set[str]]] = []
+        files = sorted(f for d in self.dirs for ext in ("md", "txt")
+                       for f in glob.glob(os.path.join(d, "**", f"*.{ext}"), recursive=True))
+        for path in files:
+            with open(path, "r", encoding="utf-8") as f:
+                paras = [p.strip() for p in re.split(r"\n\s*\n", f.read()) if p.strip()]
+            for i, para in enumerate(paras):
+                self.passages.append((f"{os.path.relpath(path)}#{i}", para, self._terms(para)))
+        self.fingerprint = f"{len(files)}:{max((os.stat(f).st_mtime for f in files), default=0):.0f}"
+        df: T.Dict[str, int] = {}
+        for _, _, terms in self.passages:
+            for t in terms: df[t] = df.get(t, 0) + 1
+        n = len(self.passages) or 1
+        self.idf = {t: math.log(1 + n / c) for t, c in df.items()}
+
+    @staticmethod
+    def _terms(text: str) -> T.Set[str]:
+        return set(tokenize(text))
+
+    def search(self, query: str, k: int = 3) -> T.List[T.Tuple[str, str]]:
+        q = self._terms(query)
+        scored = sorted(((sum(self.idf.get(t, 0) for t in q & terms), pid, text)
+                         for pid, text, terms in self.passages), reverse=True)
+        return [(pid, text) for score, pid, text in scored[:k] if score > 0]
+
+def format_hits(hits: T.Sequence[T.Tuple[str, str]], limit: int = 600) -> str:
+    if not hits:
+        return "ничего не найдено"
+    return "\n".join(f"[{pid}] {text[:limit]}" for pid, text in hits)
+
+def default_tools(corpus_dirs: T.Sequence[str] = ("banking",),
+                  index_path: str = DEFAULT_INDEX) -> T.Dict[str, T.Callable[[str], str]]:
+    """SEARCH — по индексу BM25, если он построен, иначе по абзацам `corpus_dirs`; CALC."""
+    index = open_index(index_path)
+    if index is not None:
+        def search(query: str) -> str:
+            return format_hits([(pid, text) for pid, _, text in index.search(query, k=3)])
+        search.memo_key = lambda: f"SEARCH:bm25:{index.build}"
+        return {"SEARCH": search, "CALC": safe_calc}
+    corpus: T.List[LocalCorpus] = []  # строится лениво, при первом SEARCH
+    def search(query: str) -> str:
+        if not corpus: corpus.append(LocalCorpus(corpus_dirs))
+        return format_hits(corpus[0].search(query))
+    def fingerprint() -> str:
+        if not corpus: corpus.append(LocalCorpus(corpus_dirs))
+        return corpus[0].fingerprint
+    # отпечаток корпуса (или сборки индекса) в ключе: правка документов делает старые результаты поиска недействительными
+    search.memo_key = lambda: f"SEARCH:{','.join(corpus_dirs)}:{fingerprint()}"
+    return {"SEARCH": search, "CALC": safe_calc}
+
+# ---------------- Цикл ----------------
+
+class ReActResult:
+    def __init__(self):
+        self.answer: T.Optional[str] = None
+        self.steps: T.List[dict] = []
+        self.transcript = ""
+        self.stop_reason = ""
+        self.completion_tokens = 0
+
+    def as_dict(self) -> dict:
+        return {"answer": self.answer, "stop_reason": self.stop_reason,
+                "completion_tokens": self.completion_tokens, "steps": self.steps}
+
+def run_tool(tools: T.Dict[str, T.Callable[[str], str]], name: str, args: str,
+             memo: bool = True) -> T.Tuple[str, bool]:
+    """(наблюдение, из_кеша). Ошибка инструмента тоже становится наблюдением."""
+    tool = tools.get(name)
+    if tool is None:
+        return f"ошибка: неизвестное действие {name}; доступны {', '.join(tools)}", False
+    cache, key = get_cache(), None
+    if memo and hasattr(tool, "memo_key"):
+        key = "tool:" + tool.memo_key()
+        hit = cache.get(key, "", 0.0, args)
+        if hit is not None:
+            return hit, True
+    try:
+        out = tool(args)
+    except Exception as e:
+        return f"ошибка: {e}", False
+    if key:
+        cache.put(key, "", 0.0, args, out)
+    return out, False
+
+def run_react(provider, base_prompt: str, tools: T.Optional[T.Dict[str, T.Callable[[str], str]]] = None,
+              max_steps: int = 6, max_tokens: int = 2000, temperature: float = 0.0,
+              on_text: T.Optional[T.Callable[[str], None]] = None) -> ReActResult:
+    """
+    Выполняет цикл ReAct. `on_text` получает фрагменты стенограммы по мере появления
+    (ответ модели и OBSERVATION) — для живого вывода в консоль или UI.
+    """
+    tools = tools if tools is not None else default_tools()
+    res = ReActResult()
+    emit = on_text or (lambda _: None)
+    for step in range(max_steps):
+        chunks = provider.stream_chat(base_prompt + "\n" + res.transcript, temperature=temperature)
+        text, action = "", None
+        try:
+            for piece in chunks:
+                text += piece
+                action = find_action(text)
+                # хвост фрагмента после ACTION не показываем — он будет отброшен
+                emit(piece[:len(piece) - (len(text) - action[2])] if action else piece)
+                if action or res.completion_tokens + approx_tokens(text) > max_tokens:
+                    break
+        finally:
+            chunks.close()  # на ACTION обрываем генерацию
+        res.completion_tokens += approx_tokens(text)
+        if action:
+            name, args, end = action
+            text = text[:end]
+            observation, cached = run_tool(tools, name, args)
+            res.steps.append({"step": step + 1, "action": name, "args": args,
+                              "observation": observation, "cached": cached})
+            obs = f"\nOBSERVATION: {observation}\n"
+            emit(obs)
+            res.transcript += text + obs
+            if res.completion_tokens > max_tokens:
+                res.stop_reason = "max_tokens"
+                return res
+            continue
+        res.transcript += text
+        final = find_final(text)
+        if res.completion_tokens > max_tokens and final is None:
+            res.stop_reason = "max_tokens"
+        else:
+            res.answer = final if final is not None else text.strip()
+            res.stop_reason = "final_answer" if final is not None else "no_action"
+        return res
+    res.stop_reason = "max_steps"
+    return res
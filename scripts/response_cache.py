@@ -0,0 +1,166 @@
+"""
+Постоянный кеш ответов модели (SQLite), общий для CLI и Streamlit.
+
+Ключ — sha256 от (провайдер, модель, температура, скомпилированный промпт).
+Кешируются только детерминированные вызовы (temperature == 0): ответ при
+temperature > 0 — это выборка, и повторять её из кеша нельзя.
+Вытеснение — LRU по времени последнего обращения (лимит записей) и по возрасту.
+"""
+import hashlib, os, sqlite3, threading, time, typing as T
+from instrumentation import incr, span
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PATH = os.path.join(ROOT, ".cache", "responses.sqlite")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    provider TEXT NOT NULL,
+    model TEXT NOT NULL,
+    temperature REAL NOT NULL,
+    response TEXT NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed);
+"""
+
+def cache_key(provider: str, model: str, temperature: float, prompt: str) -> str:
+    h = hashlib.sha256()
+    for part in (provider, model, repr(float(temperature)), prompt):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+class ResponseCache:
+    def __init__(self, path: str = DEFAULT_PATH, max_entries: int = 50_000,
+                 max_age: float = 30 * 24 * 3600, evict_every: int = 200):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        # Отдельное соединение на поток; WAL позволяет читать параллельно с записью
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def cacheable(temperature: float) -> bool:
+        return float(temperature) == 0.0
+
+    def get(self, provider: str, model: str, temperature: float, prompt: str) -> T.Optional[str]:
+        key = cache_key(provider, model, temperature, prompt)
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute("SELECT response, created FROM responses WHERE key=?", (key,)).fetchone()
+        if row is not None and now - row[1] > self.max_age:
+            conn.execute("DELETE FROM responses WHERE key=?", (key,))
+            row = None
+        with self._lock:
+            if row is None: self.misses += 1
+            else: self.hits += 1
+        if row is None:
+            return None
+        conn.execute("UPDATE responses SET accessed=?, hits=hits+1 WHERE key=?", (now, key))
+        return row[0]
+
+    def put(self, provider: str, model: str, temperature: float, prompt: str, response: str):
+        key = cache_key(provider, model, temperature, prompt)
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO responses(key, provider, model, temperature, response, created, accessed)"
+            " VALUES (?,?,?,?,?,?,?)", (key, provider, model, float(temperature), response, now, now))
+        with self._lock:
+            self._puts += 1
+            due = self._puts % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def evict(self) -> int:
+        """Удаляет устаревшие записи и самые давно использованные сверх лимита."""
+        conn = self._conn()
+        removed = conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,)).rowcount
+        over = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+        if over > 0:
+            removed += conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                (over,)).rowcount
+        return removed
+
+    def clear(self):
+        self._conn().execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        entries, total_hits = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM responses").fetchone()
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return {"path": self.path, "entries": entries, "size_bytes": size,
+                "hits": self.hits, "misses": self.misses, "hits_total": total_hits}
+
+    def chat(self, provider, prompt: str, temperature: float = 0.0,
+             bypass: bool = False, **kwargs) -> T.Tuple[str, bool]:
+        """
+        Вызов `provider.chat` через кеш. Возвращает (ответ, попадание_в_кеш).
+        При `bypass` кеш не читается, но свежий ответ в него записывается.
+        """
+        use = self.cacheable(temperature)
+        if use and not bypass:
+            with span("cache"):
+                hit = self.get(provider.name, provider.model, temperature, prompt)
+            if hit is not None:
+                incr("cache_hits")
+                return hit, True
+        out = provider.chat(prompt, temperature=temperature, **kwargs)
+        if use:
+            self.put(provider.name, provider.model, temperature, prompt, out)
+        return out, False
+
+    def stream_chat(self, provider, prompt: str, temperature: float = 0.0,
+                    bypass: bool = False) -> T.Tuple[T.Iterator[str], bool]:
+        """
+        Потоковый вариант `chat`: (итератор фрагментов, попадание_в_кеш).
+        Попадание отдаётся одним фрагментом; свежий ответ сохраняется, только если
+        поток дочитан до конца (оборванная генерация в кеш не попадает).
+        """
+        use = self.cacheable(temperature)
+        if use and not bypass:
+            with span("cache"):
+                hit = self.get(provider.name, provider.model, temperature, prompt)
+            if hit is not None:
+                incr("cache_hits")
+                return iter((hit,)), True
+        return self._stream_and_store(provider, prompt, temperature, use), False
+
+    def _stream_and_store(self, provider, prompt: str, temperature: float, store: bool) -> T.Iterator[str]:
+        parts = []
+        for chunk in provider.stream_chat(prompt, temperature=temperature):
+            parts.append(chunk)
+            yield chunk
+        if store:
+            self.put(provider.name, provider.model, temperature, prompt, "".join(parts))
+
+_default: T.Optional[ResponseCache] = None
+_default_lock = threading.Lock()
+
+def get_cache() -> ResponseCache:
+    """Общий для процесса кеш; путь переопределяется переменной RESPONSE_CACHE_PATH."""
+    global _default
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = ResponseCache(os.environ.get("RESPONSE_CACHE_PATH") or DEFAULT_PATH)
+    return _default
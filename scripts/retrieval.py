@@ -0,0 +1,312 @@
+"""
+Постоянный индекс BM25 по каталогу документов (.md/.txt) — для `{passages}` в шаблонах.
+
+Документы режутся на пассажи по абзацам; id пассажа — `<путь относительно каталога>#<номер>`.
+Токенизация русская: нижний регистр, ё → е, стоп‑слова, лёгкий стемминг по окончаниям.
+
+Формат (каталог индекса, по умолчанию .cache/index или RETRIEVAL_INDEX_PATH):
+- header.json — параметры, список файлов (mtime, размер, sha1, диапазон пассажей),
+  словарь `термин → [смещение, df]` и ids пассажей;
+- postings.<build>.u32 — пары (пассаж, tf) подряд по терминам;
+- doclen.<build>.u32, text.<build>.bin + textoff.<build>.u64 — длины и тексты пассажей.
+Файлы данных открываются через mmap; header.json заменяется атомарно последним,
+поэтому читатель никогда не видит наполовину записанный индекс.
+
+Переиндексация инкрементальная: заново читаются только изменённые файлы (mtime/размер,
+затем sha1), постинги неизменённых переносятся из старого индекса; если ничего не
+изменилось, индекс не переписывается.
+"""
+import functools, glob, hashlib, heapq, json, math, mmap, os, re, sys, time, uuid, typing as T
+from array import array
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_INDEX = os.environ.get("RETRIEVAL_INDEX_PATH") or os.path.join(ROOT, ".cache", "index")
+FORMAT_VERSION = 1
+
+_WORD_RE = re.compile(r"\w+", re.U)
+_CYR_RE = re.compile(r"[а-я]")
+_STOP = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне
+было вот от меня еще нет о из ему теперь когда даже ну ли если уже или ни быть был него до вас
+там потом себя ей может они тут где есть надо ней для мы тебя их чем была сам чтобы без чего
+раз тоже себе под будет ж тогда кто этот того потому этого какой ним здесь этом один мой тем
+нее были куда всех можно при об хоть после над больше тот через эти нас про всего них какая
+много эту моя свою этой перед том такой им более всегда между это
+""".split())
+_SUFFIXES = sorted("""
+иями ями ами ией иям иях ость ости остью ние ния нию нием ниями ниях
+ого его ому ему ыми ими ее ие ые ое ей ий ый ой ем им ым ом их ых ую юю ая яя ою ею
+ать ять ить еть уть ться тся ешь ишь ете ите ет ит ут ют ат ят ла ло ли на но ны
+ам ям ах ях ов ев ью ья ию ия ам ы и а я о е у ю ь
+""".split(), key=len, reverse=True)
+
+@functools.lru_cache(maxsize=100_000)
+def stem(word: str) -> str:
+    """Лёгкий стемминг: отрезает самое длинное окончание, оставляя основу не короче 3 букв."""
+    if len(word) <= 4 or not _CYR_RE.search(word):
+        return word
+    for suf in _SUFFIXES:
+        if word.endswith(suf) and len(word) - len(suf) >= 3:
+            return word[:-len(suf)]
+    return word
+
+def tokenize(text: str) -> T.List[str]:
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    return [stem(w) for w in words if w not in _STOP and (len(w) > 1 or w.isdigit())]
+
+def split_passages(text: str, max_chars: int = 1200) -> T.List[str]:
+    """Абзацы документа; заголовок приклеивается к следующему абзацу, длинные абзацы режутся по строкам."""
+    out, heading = [], ""
+    for para in re.split(r"\n\s*\n", text):
+        para = para.strip()
+        if not para:
+            continue
+        if para.startswith("#") and "\n" not in para:
+            heading = (heading + "\n" + para) if heading else para
+            continue
+        if heading:
+            para, heading = heading + "\n" + para, ""
+        while len(para) > max_chars:
+            cut = para.rfind("\n", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            out.append(para[:cut].strip())
+            para = para[cut:].strip()
+        if para:
+            out.append(para)
+    if heading:
+        out.append(heading)
+    return out
+
+def _sha1(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _list_files(docs_dir: str, exts: T.Sequence[str]) -> T.List[str]:
+    return sorted({os.path.relpath(f, docs_dir) for ext in exts
+                   for f in glob.glob(os.path.join(docs_dir, "**", f"*.{ext}"), recursive=True)})
+
+def _mmap_array(path: str, typecode: str):
+    """Только для чтения, без копирования; пустой файл — пустой массив (mmap его не открывает)."""
+    if os.path.getsize(path) == 0:
+        return array(typecode)
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mm).cast(typecode) if typecode != "B" else mm
+
+class BM25Index:
+    """Индекс, открытый для чтения. Поиск — по mmap‑постингам, без загрузки их в память."""
+    def __init__(self, path: str = DEFAULT_INDEX):
+        self.path = path
+        with open(os.path.join(path, "header.json"), "r", encoding="utf-8") as f:
+            h = json.load(f)
+        if h.get("version") != FORMAT_VERSION or h.get("byteorder") != sys.byteorder:
+            raise ValueError(f"Индекс {path} в несовместимом формате — пересоберите его (index build --full)")
+        self.header = h
+        self.build = h["build"]
+        self.k1, self.b = h["k1"], h["b"]
+        self.docs_dir = h["docs_dir"]
+        self.files: T.Dict[str, dict] = h["files"]
+        self.terms: T.Dict[str, T.List[int]] = h["terms"]
+        self.ids: T.List[str] = h["ids"]
+        self.n = len(self.ids)
+        self.avgdl = h["avgdl"] or 1.0
+        data = lambda name: os.path.join(path, name.format(build=self.build))
+        self.postings = _mmap_array(data("postings.{build}.u32"), "I")
+        self.doclen = _mmap_array(data("doclen.{build}.u32"), "I")
+        self.textoff = _mmap_array(data("textoff.{build}.u64"), "Q")
+        self.text = _mmap_array(data("text.{build}.bin"), "B")
+
+    def passage(self, doc: int) -> str:
+        return bytes(self.text[self.textoff[doc]:self.textoff[doc + 1]]).decode("utf-8")
+
+    def iter_postings(self, term: str) -> T.Iterator[T.Tuple[int, int]]:
+        entry = self.terms.get(term)
+        if not entry:
+            return
+        off, df = entry
+        post = self.postings[2 * off:2 * (off + df)]
+        for j in range(0, len(post), 2):
+            yield post[j], post[j + 1]
+
+    def search(self, query: str, k: int = 4) -> T.List[T.Tuple[str, float, str]]:
+        """Top‑k пассажей: (id, оценка BM25, текст)."""
+        scores: T.Dict[int, float] = {}
+        k1, b, avgdl, doclen = self.k1, self.b, self.avgdl, self.doclen
+        for term, qtf in Counter(tokenize(query)).items():
+            entry = self.terms.get(term)
+            if not entry:
+                continue
+            df = entry[1]
+            idf = qtf * math.log(1 + (self.n - df + 0.5) / (df + 0.5))
+            for doc, tf in self.iter_postings(term):
+                norm = k1 * (1 - b + b * doclen[doc] / avgdl)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self.ids[doc], round(score, 4), self.passage(doc)) for doc, score in top]
+
+_open_indexes: T.Dict[str, T.Tuple[float, BM25Index]] = {}
+
+def open_index(path: str = DEFAULT_INDEX) -> T.Optional[BM25Index]:
+    """Индекс из каталога (None, если не построен); переоткрывается только после пересборки."""
+    key = os.path.abspath(path)
+    try:
+        mtime = os.stat(os.path.join(key, "header.json")).st_mtime
+    except FileNotFoundError:
+        return None
+    item = _open_indexes.get(key)
+    if item is None or item[0] != mtime:
+        item = (mtime, BM25Index(key))
+        _open_indexes[key] = item
+    return item[1]
+
+def _write_array(path: str, arr: array):
+    with open(path, "wb") as f:
+        arr.tofile(f)
+
+def build_index(docs_dir: str, path: str = DEFAULT_INDEX, exts: T.Sequence[str] = ("md", "txt"),
+                full: bool = False, k1: float = 1.5, b: float = 0.75) -> dict:
+    """Строит или обновляет индекс. Возвращает статистику: сколько файлов перечитано и перенесено."""
+    t0 = time.perf_counter()
+    docs_dir = os.path.abspath(docs_dir)
+    old = None
+    if not full:
+        try:
+            old = open_index(path)
+        except ValueError:
+            old = None
+        if old is not None and (old.docs_dir != docs_dir or (old.k1, old.b) != (k1, b)):
+            old = None
+    stats = {"files": 0, "reindexed": 0, "reused": 0, "removed": 0}
+    files: T.Dict[str, dict] = {}
+    plan: T.List[T.Tuple[str, T.Optional[dict], T.Optional[T.List[str]]]] = []  # (файл, старый, новые пассажи)
+    for rel in _list_files(docs_dir, exts):
+        full_path = os.path.join(docs_dir, rel)
+        st = os.stat(full_path)
+        meta = {"mtime": st.st_mtime, "size": st.st_size}
+        prev = old.files.get(rel) if old else None
+        if prev and prev["mtime"] == meta["mtime"] and prev["size"] == meta["size"]:
+            meta["sha1"] = prev["sha1"]
+        else:
+            meta["sha1"] = _sha1(full_path)
+            if not (prev and prev["sha1"] == meta["sha1"]):
+                prev = None
+        if prev is None:
+            with open(full_path, "r", encoding="utf-8") as f:
+                plan.append((rel, None, split_passages(f.read())))
+        else:
+            plan.append((rel, prev, None))
+        files[rel] = meta
+    stats["files"] = len(files)
+    stats["reindexed"] = sum(1 for _, prev, _ in plan if prev is None)
+    stats["reused"] = len(plan) - stats["reindexed"]
+    stats["removed"] = len(set(old.files) - set(files)) if old else 0
+    if old is not None and not stats["reindexed"] and not stats["removed"]:
+        if any(files[r]["mtime"] != old.files[r]["mtime"] for r in files):
+            _write_header(path, dict(old.header, files={r: dict(old.files[r], **files[r]) for r in files}))
+        stats.update(passages=old.n, terms=len(old.terms), seconds=round(time.perf_counter() - t0, 3), changed=False)
+        return stats
+
+    # Новая нумерация пассажей; у перенесённых — отображение старых номеров в новые
+    ids: T.List[str] = []
+    texts: T.List[bytes] = []
+    doclen = array("I")
+    remap: T.Dict[int, int] = {}
+    fresh: T.List[T.Tuple[int, Counter]] = []
+    for rel, prev, passages in plan:
+        first = len(ids)
+        if prev is not None:
+            for i in range(prev["count"]):
+                old_doc = prev["first"] + i
+                remap[old_doc] = len(ids)
+                ids.append(old.ids[old_doc])
+                texts.append(old.passage(old_doc).encode("utf-8"))
+                doclen.append(old.doclen[old_doc])
+        else:
+            for i, passage in enumerate(passages):
+                tokens = tokenize(passage)
+                fresh.append((len(ids), Counter(tokens)))
+                ids.append(f"{rel}#{i}")
+                texts.append(passage.encode("utf-8"))
+                doclen.append(len(tokens))
+        files[rel].update(first=first, count=len(ids) - first)
+
+    postings: T.Dict[str, T.List[T.Tuple[int, int]]] = {}
+    if remap:
+        for term in old.terms:
+            kept = [(remap[d], tf) for d, tf in old.iter_postings(term) if d in remap]
+            if kept:
+                postings[term] = kept
+    for doc, counts in fresh:
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((doc, tf))
+
+    build = uuid.uuid4().hex[:12]
+    os.makedirs(path, exist_ok=True)
+    data = lambda name: os.path.join(path, name.format(build=build))
+    flat, terms, off = array("I"), {}, 0
+    for term in sorted(postings):
+        plist = sorted(postings[term])
+        terms[term] = [off, len(plist)]
+        for doc, tf in plist:
+            flat.append(doc); flat.append(tf)
+        off += len(plist)
+    textoff, pos = array("Q", [0]), 0
+    for t in texts:
+        pos += len(t)
+        textoff.append(pos)
+    _write_array(data("postings.{build}.u32"), flat)
+    _write_array(data("doclen.{build}.u32"), doclen)
+    _write_array(data("textoff.{build}.u64"), textoff)
+    with open(data("text.{build}.bin"), "wb") as f:
+        f.write(b"".join(texts))
+    _write_header(path, {"version": FORMAT_VERSION, "byteorder": sys.byteorder, "build": build,
+                         "k1": k1, "b": b, "docs_dir": docs_dir, "created": time.time(),
+                         "avgdl": (sum(doclen) / len(doclen)) if doclen else 0.0,
+                         "files": files, "ids": ids, "terms": terms})
+    # Файлы прежних сборок больше не нужны (открытые mmap продолжают работать до закрытия)
+    for name in os.listdir(path):
+        parts = name.split(".")
+        if len(parts) == 3 and parts[1] != build and parts[0] in ("postings", "doclen", "textoff", "text"):
+            os.remove(os.path.join(path, name))
+    stats.update(passages=len(ids), terms=len(terms), seconds=round(time.perf_counter() - t0, 3), changed=True)
+    return stats
+
+def _write_header(path: str, header: dict):
+    tmp = os.path.join(path, f"header.json.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(header, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, os.path.join(path, "header.json"))
+
+def _is_relevant(pid: str, expected: str) -> bool:
+    """Ожидаемый источник — id пассажа (`file.md#3`) или весь файл (`file.md`)."""
+    return pid == expected or ("#" not in expected and pid.startswith(expected + "#"))
+
+def check_recall(index: BM25Index, cases: T.Iterable[dict], k: int = 4) -> dict:
+    """
+    Recall@k и MRR на размеченных запросах `{"query": ..., "relevant": [id или файл, ...]}`.
+    Возвращает метрики, задержку поиска и промахи (запросы без единого релевантного в top‑k).
+    """
+    recalls, rr, lat, misses = [], [], [], []
+    for case in cases:
+        expected = case.get("relevant") or []
+        t0 = time.perf_counter()
+        hits = index.search(case["query"], k=k)
+        lat.append(time.perf_counter() - t0)
+        found = [e for e in expected if any(_is_relevant(pid, e) for pid, _, _ in hits)]
+        recalls.append(len(found) / len(expected) if expected else 1.0)
+        rank = next((i for i, (pid, _, _) in enumerate(hits, 1) if any(_is_relevant(pid, e) for e in expected)), None)
+        rr.append(1 / rank if rank else 0.0)
+        if expected and not found:
+            misses.append({"query": case["query"], "relevant": expected, "got": [pid for pid, _, _ in hits]})
+    lat.sort()
+    n = len(recalls)
+    ms = lambda q: round(lat[min(n - 1, math.ceil(q * n) - 1)] * 1000, 3) if n else None
+    return {"cases": n, "k": k,
+            "recall": round(sum(recalls) / n, 4) if n else None,
+            "mrr": round(sum(rr) / n, 4) if n else None,
+            "latency_ms": {"p50": ms(0.5), "p95": ms(0.95)},
+            "misses": misses}
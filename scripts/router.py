@@ -0,0 +1,256 @@
+"""
+Маршрутизатор провайдеров: несколько бэкендов (OpenAI‑совместимые, GigaChat) за тем же
+интерфейсом `chat` / `stream_chat`, что и у одиночного провайдера.
+
+- Резерв по порядку: ошибка бэкенда — сразу запрос к следующему по списку.
+- Хеджирование: если бэкенд не ответил за p‑й перцентиль своей недавней задержки
+  (для потока — до первого фрагмента), тот же запрос уходит следующему; выигрывает
+  первый ответ, поток проигравшего закрывается — соединение обрывается.
+- Здоровье: окно последних задержек и ошибки подряд на бэкенд. После `failure_threshold`
+  ошибок цепь размыкается на `cooldown` секунд, затем один пробный запрос решает,
+  замкнуть её снова или нет.
+
+`chat` тоже идёт через потоковый запрос: блокирующий POST из другого потока не прервать,
+а поток проигравшего закрывается на ближайшем фрагменте.
+"""
+import contextvars, math, os, threading, time, typing as T
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from instrumentation import current, incr
+
+class Cancelled(Exception):
+    """Попытка отменена: ответ уже дал другой бэкенд."""
+
+class RouterError(RuntimeError):
+    """Ни один бэкенд не ответил; `errors` — [(имя бэкенда, исключение)]."""
+    def __init__(self, errors: T.List[T.Tuple[str, BaseException]]):
+        self.errors = errors
+        detail = "; ".join(f"{name}: {type(e).__name__}: {e}" for name, e in errors)
+        super().__init__(detail or "все бэкенды отключены размыканием цепи")
+
+class BackendHealth:
+    """Задержки и состояние цепи одного бэкенда (closed → open → half_open → …)."""
+    def __init__(self, window: int = 100, failure_threshold: int = 3, cooldown: float = 30.0):
+        self.samples = {"total": deque(maxlen=window), "ttft": deque(maxlen=window)}
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0  # ошибок подряд
+        self.opened_at: T.Optional[float] = None
+        self.probing = False
+        self.ok = self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def acquire(self) -> bool:
+        """Можно ли слать запрос; в half_open пропускает ровно один пробный."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def success(self, kind: str, seconds: float):
+        with self._lock:
+            self.samples[kind].append(seconds)
+            self.ok += 1
+            self.failures, self.opened_at, self.probing = 0, None, False
+
+    def failure(self):
+        with self._lock:
+            self.errors += 1
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release(self):
+        """Попытку отменили — ни успех, ни ошибка; пробный слот освобождается."""
+        with self._lock:
+            self.probing = False
+
+    def percentile(self, kind: str, q: float, min_samples: int = 10) -> T.Optional[float]:
+        with self._lock:
+            data = sorted(self.samples[kind])
+        if len(data) < min_samples:
+            return None
+        return data[max(0, math.ceil(q / 100 * len(data)) - 1)]
+
+    def as_dict(self) -> dict:
+        r3 = lambda v: None if v is None else round(v, 3)
+        return {"state": self.state, "ok": self.ok, "errors": self.errors, "failures_in_row": self.failures,
+                "p50": r3(self.percentile("total", 50, 1)), "p95": r3(self.percentile("total", 95, 1)),
+                "ttft_p95": r3(self.percentile("ttft", 95, 1))}
+
+def _collect(backend, cancel: threading.Event, prompt: str, temperature: float) -> str:
+    if cancel.is_set(): raise Cancelled()
+    chunks = backend.stream_chat(prompt, temperature=temperature)
+    parts = []
+    try:
+        for piece in chunks:
+            if cancel.is_set(): raise Cancelled()
+            parts.append(piece)
+    finally:
+        chunks.close()
+    return "".join(parts)
+
+def _open(backend, cancel: threading.Event, prompt: str, temperature: float):
+    """(первый фрагмент, остаток потока) — ответ «начался»."""
+    if cancel.is_set(): raise Cancelled()
+    chunks = backend.stream_chat(prompt, temperature=temperature)
+    try:
+        first = next(chunks, None)
+        if cancel.is_set(): raise Cancelled()
+    except BaseException:
+        chunks.close()
+        raise
+    return first, chunks
+
+def _relay(first: T.Optional[str], chunks: T.Iterator[str]) -> T.Iterator[str]:
+    try:
+        if first is not None:
+            yield first
+        yield from chunks
+    finally:
+        chunks.close()
+
+class Router:
+    def __init__(self, backends: T.Sequence, hedge_percentile: float = 95.0, hedge_after: float = 5.0,
+                 min_samples: int = 10, max_parallel: int = 2, failure_threshold: int = 3, cooldown: float = 30.0):
+        """
+        `hedge_percentile` — задержка, после которой запрос дублируется следующему бэкенду
+        (0 — без хеджирования); пока замеров меньше `min_samples`, ждём `hedge_after` секунд.
+        `max_parallel` — сколько бэкендов одновременно заняты одним запросом.
+        """
+        if not backends:
+            raise ValueError("Router: пустой список бэкендов")
+        self.backends = list(backends)
+        self.health = [BackendHealth(failure_threshold=failure_threshold, cooldown=cooldown) for _ in self.backends]
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after
+        self.min_samples = min_samples
+        self.max_parallel = max(1, max_parallel)
+        self.name = "router:" + ",".join(b.name for b in self.backends)
+        self.model = ",".join(b.model for b in self.backends)
+        # Проигравшие попытки дочитываются в фоне, поэтому пул с запасом
+        self._pool = ThreadPoolExecutor(max_workers=64, thread_name_prefix="router")
+
+    def _hedge_delay(self, i: int, kind: str) -> T.Optional[float]:
+        if not self.hedge_percentile or self.max_parallel < 2:
+            return None
+        p = self.health[i].percentile(kind, self.hedge_percentile, self.min_samples)
+        return self.hedge_after if p is None else p
+
+    def _race(self, attempt: T.Callable, kind: str, discard: T.Callable = lambda result: None):
+        """
+        Запускает `attempt(backend, cancel)` по порядку бэкендов с резервом и хеджированием.
+        Возвращает результат первой успешной попытки; остальные отменяются, их готовые
+        результаты передаются в `discard`.
+        """
+        running: T.Dict[T.Any, T.Tuple[int, float, threading.Event]] = {}
+        errors: T.List[T.Tuple[str, BaseException]] = []
+        order = iter(range(len(self.backends)))
+
+        def on_done(fut, i: int, t0: float, cancel: threading.Event):
+            health, e = self.health[i], fut.exception()
+            if isinstance(e, Cancelled): health.release()
+            elif e is not None: health.failure()
+            else:
+                health.success(kind, time.perf_counter() - t0)
+                if cancel.is_set(): discard(fut.result())  # опоздавший проигравший
+
+        def launch(counter: T.Optional[str] = None) -> bool:
+            for i in order:
+                if not self.health[i].acquire():
+                    continue
+                cancel, t0 = threading.Event(), time.perf_counter()
+                # спаны и токены попытки попадают в трассу вызывающего потока
+                fut = self._pool.submit(contextvars.copy_context().run, attempt, self.backends[i], cancel)
+                running[fut] = (i, t0, cancel)
+                fut.add_done_callback(lambda f, i=i, t0=t0, c=cancel: on_done(f, i, t0, c))
+                if counter: incr(counter)
+                return True
+            return False
+
+        launch()
+        while running:
+            timeout = None
+            if len(running) < self.max_parallel:
+                i, t0, _ = max(running.values(), key=lambda v: v[1])
+                delay = self._hedge_delay(i, kind)
+                if delay is not None:
+                    timeout = max(0.0, t0 + delay - time.perf_counter())
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                if not launch("hedges"):  # хеджировать некуда — просто ждём
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in done:
+                i, _, _ = running.pop(fut)
+                e = fut.exception()
+                if e is None:
+                    for other, (_, _, cancel) in running.items():
+                        cancel.set()
+                        if other.done() and other.exception() is None:
+                            discard(other.result())
+                    tr = current()
+                    if tr is not None: tr.labels["backend"] = self.backends[i].name
+                    return fut.result()
+                errors.append((self.backends[i].name, e))
+            if done and len(running) < self.max_parallel:
+                launch("fallbacks")
+        raise RouterError(errors)
+
+    def chat(self, prompt: str, temperature: float = 0.0) -> str:
+        return self._race(lambda b, cancel: _collect(b, cancel, prompt, temperature), "total")
+
+    def stream_chat(self, prompt: str, temperature: float = 0.0) -> T.Iterator[str]:
+        """Хеджирование до первого фрагмента; ошибка посреди потока не перезапрашивается."""
+        first, chunks = self._race(lambda b, cancel: _open(b, cancel, prompt, temperature), "ttft",
+                                   discard=lambda result: result[1].close())
+        return _relay(first, chunks)
+
+    def status(self) -> T.List[dict]:
+        return [{"backend": b.name, "model": b.model, **h.as_dict()} for b, h in zip(self.backends, self.health)]
+
+class BackendSpec(T.NamedTuple):
+    provider: str
+    model: T.Optional[str] = None
+    base: T.Optional[str] = None  # свой адрес API вместо OPENAI_API_BASE / GIGACHAT_API_BASE
+
+def parse_backends(spec: str) -> T.List[BackendSpec]:
+    """
+    `провайдер[:модель][@адрес API]` через запятую, например
+    `openai:gpt-4o-mini@https://a.example/v1,openai:llama-3-70b@http://10.0.0.5:8000/v1,gigachat`.
+    """
+    out = []
+    for item in spec.split(","):
+        item = item.strip()
+        if item:
+            head, _, base = item.partition("@")
+            name, _, model = head.partition(":")
+            out.append(BackendSpec(name.strip().lower(), model.strip() or None, base.strip().rstrip("/") or None))
+    return out
+
+def router_from_env(make: T.Callable[[BackendSpec, T.Optional[str]], T.Any],
+                    get: T.Callable[[str], T.Optional[str]] = os.environ.get) -> Router:
+    """
+    Router по переменным: ROUTER_BACKENDS (обязательна), ROUTER_HEDGE_PERCENTILE (95; 0 —
+    без хеджирования), ROUTER_HEDGE_AFTER (5 с — пока мало замеров), ROUTER_FAILURES (3),
+    ROUTER_COOLDOWN (30 с). Ключ n‑го по порядку бэкенда (с 1) — ROUTER_API_KEY_<n>, иначе
+    общий ключ провайдера. `make(бэкенд, ключ или None)` создаёт бэкенд.
+    """
+    spec = get("ROUTER_BACKENDS")
+    if not spec:
+        raise ValueError("PROVIDER=router: задайте ROUTER_BACKENDS, например gigachat,openai:gpt-4o-mini")
+    num = lambda key, default: float(get(key) or default)
+    backends = [make(b, get(f"ROUTER_API_KEY_{i}")) for i, b in enumerate(parse_backends(spec), 1)]
+    return Router(backends,
+                  hedge_percentile=num("ROUTER_HEDGE_PERCENTILE", 95), hedge_after=num("ROUTER_HEDGE_AFTER", 5.0),
+                  failure_threshold=int(num("ROUTER_FAILURES", 3)), cooldown=num("ROUTER_COOLDOWN", 30.0))
@@ -1,106 +1,666 @@
 #!/usr/bin/env python3
-import os, sys, json, time, typing as T
-import typer, requests
+import os, sys, json, time, threading, typing as T
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import typer
 from rich import print
+from rich.markup import escape
 from dotenv import load_dotenv
+from llm_transport import Transport, TokenCache, StreamTimer, iter_chat_deltas, parse_expires_at
+from response_cache import get_cache
+from prompt_templates import load_template
+from schema_validation import IncrementalValidator, load_validator, validate_output
+from self_consistency import make_key_fn, provider_sampler, self_consistency
+from react import default_tools, run_react
+from retrieval import DEFAULT_INDEX, build_index, check_recall, open_index
+from history_store import get_history
+from token_budget import compile_prompt
+from router import Router, router_from_env
+from mapreduce import default_checkpoint, run_extract, schema_from_template
+from instrumentation import incr, metrics, record_usage, span, trace
 
 app = typer.Typer(add_help_option=True)
 
-def load_prompt(path: str) -> str:
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read()
-
-def render_vars(text: str, vars: T.Dict[str,str]) -> str:
-    for k,v in vars.items():
-        text = text.replace("{"+k+"}", str(v))
-    return text
-
 # --- Providers ---
 
 class OpenAICompat:
-    def __init__(self, model: str|None=None):
-        self.base = os.environ.get("OPENAI_API_BASE","https://api.openai.com/v1")
-        self.key = os.environ["OPENAI_API_KEY"]
+    def __init__(self, model: str|None=None, transport: Transport|None=None, base: str|None=None, key: str|None=None):
+        self.base = base or os.environ.get("OPENAI_API_BASE","https://api.openai.com/v1")
+        self.key = key or os.environ["OPENAI_API_KEY"]
         self.model = model or "gpt-4o-mini"
-    def chat(self, prompt: str) -> str:
+        self.name = f"openai:{self.base}"
+        self.transport = transport or Transport()
+    def _post(self, prompt: str, temperature: float, stream: bool=False):
         url = f"{self.base}/chat/completions"
         headers = {"Authorization": f"Bearer {self.key}", "Content-Type":"application/json"}
-        data = {"model": self.model, "messages":[{"role":"user","content":prompt}], "temperature":0}
-        r = requests.post(url, headers=headers, json=data, timeout=120)
+        data = {"model": self.model, "messages":[{"role":"user","content":prompt}], "temperature":temperature}
+        if stream: data.update(stream=True, stream_options={"include_usage": True})  # usage в последнем событии
+        r = self.transport.post(url, headers=headers, json=data, timeout=120, stream=stream)
         r.raise_for_status()
-        return r.json()["choices"][0]["message"]["content"]
+        return r
+    def chat(self, prompt: str, temperature: float=0.0) -> str:
+        body = self._post(prompt, temperature).json()
+        record_usage(body.get("usage"))
+        return body["choices"][0]["message"]["content"]
+    def stream_chat(self, prompt: str, temperature: float=0.0) -> T.Iterator[str]:
+        """Фрагменты ответа по мере генерации (SSE). Закрытие генератора обрывает запрос."""
+        return iter_chat_deltas(self._post(prompt, temperature, stream=True))
 
 class GigaChat:
-    def __init__(self, model: str|None=None):
+    def __init__(self, model: str|None=None, transport: Transport|None=None, base: str|None=None, key: str|None=None):
         self.model = model or "GigaChat-Pro"
         self.scope = os.environ.get("GIGACHAT_SCOPE","GIGACHAT_API_PERS")
         self.client_id = os.environ["GIGACHAT_CLIENT_ID"]
-        self.auth_key = os.environ["GIGACHAT_AUTH_KEY"]
-        self._token = None
+        self.auth_key = key or os.environ["GIGACHAT_AUTH_KEY"]
+        self.oauth_url = os.environ.get("GIGACHAT_OAUTH_URL","https://ngw.devices.sberbank.ru:9443/api/v2/oauth")
+        self.api_base = base or os.environ.get("GIGACHAT_API_BASE","https://gigachat.devices.sberbank.ru/api/v1")
+        self.name = f"gigachat:{self.api_base}"
+        self.transport = transport or Transport()
+        self._tokens = TokenCache(self._fetch_token)
     def _token_headers(self):
         return {"Authorization": f"Basic {self.auth_key}","Content-Type":"application/x-www-form-urlencoded"}
-    def _get_token(self)->str:
-        if self._token: return self._token
-        url = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
+    def _fetch_token(self):
+        url = self.oauth_url
         data = {"scope": self.scope}
-        r = requests.post(url, headers=self._token_headers(), data=data, timeout=60, verify=True)
+        r = self.transport.post(url, headers=self._token_headers(), data=data, timeout=60, verify=True)
         r.raise_for_status()
-        self._token = r.json()["access_token"]
-        return self._token
-    def chat(self, prompt: str) -> str:
-        token = self._get_token()
-        url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
-        headers = {"Authorization": f"Bearer {token}","Content-Type":"application/json"}
-        payload = {"model": self.model, "messages":[{"role":"user","content":prompt}],"temperature":0}
-        r = requests.post(url, headers=headers, json=payload, timeout=120, verify=True)
-        if r.status_code==401:
-            self._token=None
-            return self.chat(prompt)
+        body = r.json()
+        return body["access_token"], parse_expires_at(body.get("expires_at"))
+    def _get_token(self)->str:
+        return self._tokens.get()
+    def _post(self, prompt: str, temperature: float, stream: bool=False):
+        url = f"{self.api_base}/chat/completions"
+        payload = {"model": self.model, "messages":[{"role":"user","content":prompt}],"temperature":temperature}
+        if stream: payload["stream"] = True
+        # Один повтор после 401: токен могли отозвать раньше expires_at
+        for attempt in range(2):
+            token = self._get_token()
+            headers = {"Authorization": f"Bearer {token}","Content-Type":"application/json"}
+            r = self.transport.post(url, headers=headers, json=payload, timeout=120, verify=True, stream=stream)
+            if r.status_code != 401: break
+            r.close()
+            self._tokens.invalidate(token)
         r.raise_for_status()
-        return r.json()["choices"][0]["message"]["content"]
+        return r
+    def chat(self, prompt: str, temperature: float=0.0) -> str:
+        body = self._post(prompt, temperature).json()
+        record_usage(body.get("usage"))
+        return body["choices"][0]["message"]["content"]
+    def stream_chat(self, prompt: str, temperature: float=0.0) -> T.Iterator[str]:
+        """Фрагменты ответа по мере генерации (SSE). Закрытие генератора обрывает запрос."""
+        return iter_chat_deltas(self._post(prompt, temperature, stream=True))
 
-def get_provider(name: str, model: str|None=None):
+def get_provider(name: str, model: str|None=None, transport: Transport|None=None,
+                 base: str|None=None, key: str|None=None):
+    """`base`/`key` — адрес API и ключ вместо переменных окружения (бэкенды роутера)."""
     if name=="openai":
-        return OpenAICompat(model=model)
+        return OpenAICompat(model=model, transport=transport, base=base, key=key)
     elif name=="gigachat":
-        return GigaChat(model=model)
+        return GigaChat(model=model, transport=transport, base=base, key=key)
+    elif name=="router":
+        # Повторы заменяет переход к следующему бэкенду; модели и адреса — из ROUTER_BACKENDS
+        return router_from_env(lambda b, key: get_provider(b.provider, model=b.model, transport=Transport(max_retries=0),
+                                                           base=b.base, key=key))
     raise ValueError("Unknown provider: "+name)
 
 @app.command()
 def chat(prompt_file: str, model: str = typer.Option(None),
          schema: str = typer.Option(None, help='Путь к JSON Schema для валидации ответа'),
-         var: list[str] = typer.Option(None, help="Пара key=value для подстановки")):
+         var: list[str] = typer.Option(None, help="Пара key=value для подстановки"),
+         no_cache: bool = typer.Option(False, "--no-cache", help="Не брать ответ из кеша (свежий ответ всё равно сохраняется)"),
+         stream: bool = typer.Option(False, "--stream", help="Печатать ответ по мере генерации (Ctrl+C — оборвать)"),
+         index: str = typer.Option(DEFAULT_INDEX, help="Индекс BM25 для {passages} (run.py index build)"),
+         top_k: int = typer.Option(4, min=1, help="Сколько пассажей‑кандидатов брать из индекса для {passages}"),
+         query_var: str = typer.Option("question", help="Переменная, по которой ищутся пассажи"),
+         max_prompt_tokens: int = typer.Option(0, envvar="PROMPT_TOKEN_BUDGET", min=0,
+                                               help="Бюджет промпта в токенах (оценка); пассажи сверх него выпадают целиком, 0 — без ограничения")):
     """
     Простой прогон любого markdown‑шаблона промпта.
-    Переменные {var} в файле заменяются значениями из --var key=value
+    Переменные {var} в файле заменяются значениями из --var key=value.
+    Если шаблону нужен {passages}, а он не задан, пассажи берутся из индекса по --query-var
+    и укладываются в --max-prompt-tokens; оценка размера промпта печатается до отправки.
     """
     load_dotenv()
     provider = os.environ.get("PROVIDER","openai")
     p = get_provider(provider, model=model)
-    text = load_prompt(prompt_file)
+    tpl = load_template(prompt_file)
+    kv = parse_vars(var)
+    with trace(template=prompt_file, model=p.model, provider=provider) as tr:
+        hits = find_passages(tpl, kv, index, query_var, top_k)
+        missing, extra = tpl.check(kv if hits is None else {**kv, "passages": ""})
+        if missing: print("[yellow]Не заданы переменные:[/yellow]", ", ".join(missing))
+        if extra: print("[yellow]Лишние переменные (нет в шаблоне):[/yellow]", ", ".join(extra))
+        bp = compile_prompt(tpl, kv, max_prompt_tokens, hits)
+        text = bp.text
+        if hits is not None:
+            print("[dim]Пассажи из индекса:[/dim]", escape(", ".join(bp.passage_ids) or "ничего не найдено"))
+        print("[bold]Промпт:[/bold]\n", escape(text[:1000]), "\n---")
+        print(f"[dim]промпт: {escape(bp.summary())}[/dim]")
+        if bp.over_budget:
+            print("[bold red]Промпт не помещается в бюджет даже без пассажей — запрос не отправлен[/bold red]")
+            raise typer.Exit(1)
+        timer = StreamTimer()
+        if stream:
+            chunks, hit = get_cache().stream_chat(p, text, bypass=no_cache)
+            print("[bold green]Ответ:[/bold green]" + (" [dim](из кеша)[/dim]" if hit else ""))
+            def echo(piece: str):
+                sys.stdout.write(piece)
+                sys.stdout.flush()
+            aborted = None
+            try:
+                out, aborted = consume_stream(timer.wrap(chunks), schema=schema, on_piece=echo)
+            except KeyboardInterrupt:
+                out = ""
+                print("\n[yellow]Генерация прервана[/yellow]")
+            sys.stdout.write("\n")
+            if aborted:
+                print("[bold red]Генерация остановлена — нарушен контракт:[/bold red]", escape(aborted))
+        else:
+            out, hit = get_cache().chat(p, text, bypass=no_cache)
+            timer.ttft = timer.total = time.perf_counter() - timer.started
+            # Печать ответа
+            print("[bold green]Ответ:[/bold green]" + (" [dim](из кеша)[/dim]" if hit else "") + "\n", escape(out))
+        t = timer.as_dict()
+        print(f"[dim]ttft={t['ttft']}s total={t['total']}s[/dim]")
+        # Валидация JSON, если указана схема
+        valid = False if stream and aborted else None
+        if schema and not (stream and aborted):
+            valid, err = check_schema(out, schema)
+            if valid:
+                print("[bold cyan]JSON валиден по схеме[/bold cyan]")
+            else:
+                print("[bold red]Ошибка валидации JSON:[/bold red]", escape(err or ""))
+    timing = tr.as_dict()
+    print(f"[dim]фазы: {format_spans(timing)}[/dim]")
+    log_run("cli", provider, p.model, prompt_file, kv, text, out, schema=schema,
+            valid=valid if schema else None, cached=hit, ttft=t["ttft"], elapsed=t["total"], timing=timing,
+            **bp.as_dict())
+
+def format_spans(timing: dict) -> str:
+    """Строка «фаза=секунды … токены промпт/ответ» для вывода в консоль."""
+    parts = [f"{k}={v:.3f}s" for k, v in sorted(timing["spans"].items(), key=lambda kv: -kv[1])]
+    if timing.get("prompt_tokens") or timing.get("completion_tokens"):
+        parts.append(f"токены {timing.get('prompt_tokens', 0)}/{timing.get('completion_tokens', 0)}")
+    if timing.get("retries"): parts.append(f"повторов {timing['retries']}")
+    return " ".join(parts) or "—"
+
+def log_run(source: str, provider: str, model: str, template: str, kv: T.Dict[str, str],
+            prompt: str, out: T.Optional[str], **fields):
+    """Запись прогона в общую историю (та же, что во вкладке «История» Streamlit)."""
+    get_history().add({"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "provider": provider, "model": model,
+                       "temperature": 0.0, "template": template, "variables": kv,
+                       "compiled": prompt, "response": out, **fields}, source=source)
+
+def find_passages(tpl, kv: T.Dict[str, str], index_path: str, query_var: str,
+                  k: int) -> T.Optional[T.List[T.Tuple[str, float, str]]]:
+    """
+    Top‑k пассажей из индекса по значению `query_var` — если шаблону нужен {passages},
+    а он не задан. None — поиск не выполнялся (нет переменной, запроса или индекса).
+    В промпт их укладывает token_budget.compile_prompt.
+    """
+    if "passages" not in tpl.variables or kv.get("passages") or not kv.get(query_var):
+        return None
+    with span("retrieval"):
+        idx = open_index(index_path)
+        if idx is None:
+            return None
+        return idx.search(kv[query_var], k=k)
+
+def parse_vars(var: T.Optional[T.List[str]]) -> T.Dict[str, str]:
     kv = {}
-    if var:
-        for pair in var:
-            k,v = pair.split("=",1)
-            kv[k]=v
-    text = render_vars(text, kv)
-    print("[bold]Промпт:[/bold]\n", text[:1000], "\n---")
-    out = p.chat(text)
-    # Печать ответа
-    print("[bold green]Ответ:[/bold green]\n", out)
-    # Валидация JSON, если указана схема
-    if schema:
+    for pair in var or ():
+        k,v = pair.split("=",1)
+        kv[k]=v
+    return kv
+
+@app.command()
+def consistency(prompt_file: str, model: str = typer.Option(None),
+                var: list[str] = typer.Option(None, help="Пара key=value для подстановки"),
+                samples: int = typer.Option(5, "--samples", "-n", min=1, help="Число выборок"),
+                temperature: float = typer.Option(0.7, help="Температура выборок"),
+                quorum: int = typer.Option(None, help="Остановиться, когда ответ набрал столько голосов (по умолчанию — большинство)"),
+                concurrency: int = typer.Option(None, "--concurrency", "-c", help="Одновременных выборок (по умолчанию — все)"),
+                schema: str = typer.Option(None, help="JSON Schema: голосуют категориальные поля схемы")):
+    """
+    Self‑consistency: N параллельных выборок и голосование за ответ.
+    Оставшиеся выборки отменяются, как только ответ набрал кворум.
+    """
+    load_dotenv()
+    provider = os.environ.get("PROVIDER","openai")
+    p = get_provider(provider, model=model)
+    kv = parse_vars(var)
+    text = load_template(prompt_file).render(kv)
+    if temperature == 0:
+        print("[yellow]При temperature=0 выборки совпадут — голосование не имеет смысла[/yellow]")
+    validator = load_validator(schema) if schema else None
+    t0 = time.perf_counter()
+    with trace(template=prompt_file, model=p.model, provider=provider) as tr:
+        res = self_consistency(provider_sampler(p, text, temperature), samples, make_key_fn(validator),
+                               quorum=quorum, concurrency=concurrency)
+        valid = None
+        if validator is not None and res.answer is not None:
+            valid = validate_output(res.answer, validator)[1] is None
+        if res.answer is None:
+            tr.error = "no_answer"
+    elapsed = round(time.perf_counter() - t0, 3)
+    log_run("consistency", provider, p.model, prompt_file, kv, text, res.answer, schema=schema,
+            valid=False if schema and res.answer is None else valid, temperature=temperature, elapsed=elapsed,
+            timing=tr.as_dict(), self_consistency={k: v for k, v in res.as_dict().items() if k != "answer"})
+    if res.answer is None:
+        print("[bold red]Ни одного пригодного ответа[/bold red]", res.errors[:1])
+        raise typer.Exit(1)
+    print("[bold green]Ответ большинства:[/bold green]\n", escape(res.answer))
+    print(f"[bold]Согласие:[/bold] {res.votes}/{res.completed} = {res.agreement:.0%} "
+          f"(запрошено {res.requested}, невалидных {res.invalid}, ошибок {len(res.errors)}"
+          + (", остановлено по кворуму" if res.stopped_early else "") + ")"
+          + f" за {elapsed:.2f}s")
+    for key, count in res.tally.most_common():
+        print(f"  {count} × " + escape(repr(key)))
+
+@app.command()
+def react(question: str, model: str = typer.Option(None),
+          prompt_file: str = typer.Option("prompts/patterns/06_react.md", help="Шаблон протокола ReAct с переменной {q}"),
+          corpus: list[str] = typer.Option(["banking"], help="Каталоги с .md/.txt для SEARCH, если индекс не построен"),
+          index: str = typer.Option(DEFAULT_INDEX, help="Индекс BM25 для SEARCH (run.py index build)"),
+          max_steps: int = typer.Option(6, min=1, help="Предел шагов ACTION → OBSERVATION"),
+          max_tokens: int = typer.Option(2000, min=1, help="Предел токенов ответа модели на весь цикл (оценка)")):
+    """
+    Исполняемый ReAct: генерация обрывается на строке ACTION, действие (SEARCH по локальному
+    корпусу, CALC) выполняется, OBSERVATION возвращается модели — до FINAL_ANSWER.
+    """
+    load_dotenv()
+    p = get_provider(os.environ.get("PROVIDER","openai"), model=model)
+    base = load_template(prompt_file).render({"q": question})
+    def echo(piece: str):
+        sys.stdout.write(piece)
+        sys.stdout.flush()
+    t0 = time.perf_counter()
+    res = run_react(p, base, tools=default_tools(corpus, index), max_steps=max_steps,
+                    max_tokens=max_tokens, on_text=echo)
+    sys.stdout.write("\n")
+    cached = sum(1 for s in res.steps if s["cached"])
+    print(f"[dim]шагов={len(res.steps)} (из кеша {cached}) токенов≈{res.completion_tokens} "
+          f"остановка={res.stop_reason} за {time.perf_counter() - t0:.2f}s[/dim]")
+    if res.answer is None:
+        print("[bold red]Итоговый ответ не получен:[/bold red]", res.stop_reason)
+        raise typer.Exit(1)
+    print("[bold green]Ответ:[/bold green]\n", escape(res.answer))
+
+def check_schema(out: str, schema: str) -> T.Tuple[bool, T.Optional[str]]:
+    """Проверяет ответ модели по JSON Schema. Возвращает (валиден, текст ошибки)."""
+    try:
+        _, err = validate_output(out, load_validator(schema))
+    except Exception as e:
+        return False, str(e)
+    return err is None, err
+
+def consume_stream(chunks: T.Iterator[str], schema: str|None=None,
+                   on_piece: T.Callable[[str], None]|None=None) -> T.Tuple[str, T.Optional[str]]:
+    """
+    Дочитывает поток фрагментов. При заданной схеме проверяет ответ на лету и
+    обрывает генерацию при первом нарушении контракта. Возвращает (текст, ошибка_контракта).
+    """
+    iv = IncrementalValidator(load_validator(schema)) if schema else None
+    parts = []
+    try:
+        for piece in chunks:
+            parts.append(piece)
+            if on_piece: on_piece(piece)
+            if iv and iv.feed(piece):
+                return "".join(parts), iv.error
+    finally:
+        close = getattr(chunks, "close", None)
+        if close: close()
+    return "".join(parts), None
+
+# --- Batch ---
+
+class RateLimiter:
+    """Ограничитель частоты: не больше `rpm` запросов в минуту (равномерно, потокобезопасно)."""
+    def __init__(self, rpm: int):
+        self.interval = 60.0/rpm if rpm and rpm > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+    def acquire(self):
+        if not self.interval: return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def iter_jsonl(path: str) -> T.Iterator[T.Tuple[int, dict]]:
+    """Построчно читает JSONL, пропуская пустые строки. Возвращает (номер строки, объект)."""
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if line:
+                yield lineno, json.loads(line)
+
+def read_done_ids(path: str) -> T.Set[str]:
+    """id успешно обработанных строк из выходного JSONL (для возобновления прогона).
+    Строки с ошибкой запроса не учитываются — при повторном запуске они выполнятся снова."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+                if rec.get("ok", True):
+                    done.add(str(rec["id"]))
+            except (ValueError, KeyError, TypeError):
+                continue  # обрезанная последняя строка после прерывания
+    return done
+
+@app.command()
+def batch(prompt_file: str,
+          input: str = typer.Option(..., "--input", "-i", help="JSONL: по одному набору переменных на строку"),
+          output: str = typer.Option(..., "--output", "-o", help="JSONL с результатами (дописывается)"),
+          model: str = typer.Option(None),
+          schema: str = typer.Option(None, help="Путь к JSON Schema для валидации ответов"),
+          concurrency: int = typer.Option(4, "--concurrency", "-c", min=1, help="Число параллельных запросов"),
+          rpm: int = typer.Option(0, help="Лимит запросов в минуту (0 — без лимита)"),
+          id_field: str = typer.Option("id", help="Поле строки с идентификатором (иначе — номер строки)"),
+          no_cache: bool = typer.Option(False, "--no-cache", help="Не брать ответы из кеша"),
+          stream: bool = typer.Option(False, "--stream", help="Потоковые запросы: в результат пишется ttft"),
+          index: str = typer.Option(DEFAULT_INDEX, help="Индекс BM25 для {passages}"),
+          top_k: int = typer.Option(4, min=1, help="Сколько пассажей‑кандидатов брать из индекса для {passages}"),
+          query_var: str = typer.Option("question", help="Переменная, по которой ищутся пассажи"),
+          max_prompt_tokens: int = typer.Option(0, envvar="PROMPT_TOKEN_BUDGET", min=0,
+                                                help="Бюджет промпта в токенах (оценка); строки, не помещающиеся и без пассажей, не отправляются")):
+    """
+    Пакетный прогон шаблона по JSONL‑датасету.
+    Каждая строка --input — объект с переменными шаблона; результаты пишутся в --output
+    по мере готовности. Строки, чьи id уже есть в --output, пропускаются (возобновление).
+    """
+    load_dotenv()
+    provider = os.environ.get("PROVIDER","openai")
+    p = get_provider(provider, model=model)
+    tpl = load_template(prompt_file)
+    limiter = RateLimiter(rpm)
+    cache = get_cache()
+    done = read_done_ids(output)
+    lock = threading.Lock()
+    stats = {"ok": 0, "error": 0, "invalid": 0, "skipped": 0}
+
+    def run_row(row_id: str, row: dict) -> dict:
+        kv = {k: v for k, v in row.items() if k != id_field}
+        with trace(template=prompt_file, model=p.model, provider=provider) as tr:
+            t0 = time.perf_counter()
+            rec = {"id": row_id, "vars": dict(kv)}
+            prompt, budget = None, {}
+            try:
+                hits = find_passages(tpl, kv, index, query_var, top_k)
+                bp = compile_prompt(tpl, kv, max_prompt_tokens, hits)
+                prompt, budget = bp.text, bp.as_dict()
+                if hits is not None: rec["passage_ids"] = bp.passage_ids
+                rec.update(budget)
+                missing, _ = tpl.check(kv if hits is None else {**kv, "passages": ""})
+                if missing: rec["missing_vars"] = missing
+                if bp.over_budget:
+                    raise ValueError(f"промпт ≈{bp.tokens} токенов при бюджете {bp.budget}")
+                with span("cache"):
+                    out = None if no_cache else cache.get(p.name, p.model, 0.0, prompt)
+                rec["cached"] = out is not None
+                if out is not None: incr("cache_hits")
+                if out is None:
+                    limiter.acquire()  # лимит частоты — только для реальных запросов
+                    aborted = None
+                    if stream:
+                        timer = StreamTimer()
+                        out, aborted = consume_stream(timer.wrap(p.stream_chat(prompt)), schema=schema)
+                        rec["ttft"] = round(timer.ttft or timer.total, 3)
+                    else:
+                        out = p.chat(prompt)
+                    if aborted:
+                        rec.update(valid=False, schema_error=aborted, aborted=True)
+                    else:
+                        cache.put(p.name, p.model, 0.0, prompt, out)
+                rec.update(ok=True, response=out)
+                if schema and "valid" not in rec:
+                    rec["valid"], rec["schema_error"] = check_schema(out, schema)
+            except Exception as e:
+                rec.update(ok=False, error=f"{type(e).__name__}: {e}")
+                tr.error = type(e).__name__
+        rec["elapsed"] = round(time.perf_counter() - t0, 3)
         try:
-            import json, re, jsonschema
-            # Наивное извлечение JSON из ответа
-            s = out[out.find('{'): out.rfind('}')+1]
-            obj = json.loads(s)
-            with open(schema, 'r', encoding='utf-8') as sf:
-                sch = json.load(sf)
-            jsonschema.validate(obj, sch)
-            print("[bold cyan]JSON валиден по схеме[/bold cyan]")
+            log_run("batch", provider, p.model, prompt_file, kv, prompt, rec.get("response"),
+                    schema=schema, valid=rec.get("valid"), cached=rec.get("cached"), ttft=rec.get("ttft"),
+                    elapsed=rec["elapsed"], row_id=row_id, timing=tr.as_dict(), **budget,
+                    **({"error": rec["error"]} if not rec["ok"] else {}))
         except Exception as e:
-            print("[bold red]Ошибка валидации JSON:[/bold red]", e)
+            # история — вспомогательная запись: её сбой не должен ронять прогон
+            rec["history_error"] = f"{type(e).__name__}: {e}"
+        return rec
+
+    def write(rec: dict):
+        with lock:
+            fout.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            fout.flush()
+            if not rec["ok"]: stats["error"] += 1
+            else:
+                stats["ok"] += 1
+                if rec.get("valid") is False: stats["invalid"] += 1
+
+    with open(output, "a", encoding="utf-8") as fout, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = set()
+        for lineno, row in iter_jsonl(input):
+            row_id = str(row.get(id_field, lineno))
+            if row_id in done:
+                stats["skipped"] += 1
+                continue
+            done.add(row_id)
+            pending.add(pool.submit(run_row, row_id, row))
+            # Держим ограниченное окно задач, чтобы не читать весь датасет в память
+            if len(pending) >= concurrency * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in finished: write(fut.result())
+        for fut in wait(pending).done:
+            write(fut.result())
+    cs = cache.stats()
+    print(f"[bold]Готово:[/bold] ok={stats['ok']} error={stats['error']} "
+          f"invalid={stats['invalid']} skipped={stats['skipped']} "
+          f"cache_hits={cs['hits']} → {output}")
+    for row in metrics.snapshot():
+        print(f"[dim]{escape(row['template'])} · {row['model']}: токены {row['prompt_tokens']}/{row['completion_tokens']}, "
+              f"повторов {row['retries']}, в среднем {row['avg_seconds']}s; фазы {row['spans_avg']}[/dim]")
+    for b in p.status() if isinstance(p, Router) else ():
+        lat = f" p50={b['p50']}s p95={b['p95']}s" if b["p50"] is not None else ""
+        print(f"[dim]{escape(b['backend'])}: {b['state']}, ok={b['ok']} ошибок={b['errors']}{lat}[/dim]")
+
+@app.command()
+def extract(prompt_file: str,
+            input: str = typer.Option(..., "--input", "-i", help="Большой текстовый файл (выписка, архив жалоб)"),
+            output: str = typer.Option(None, "--output", "-o", help="Куда записать итоговый JSON (иначе — в консоль)"),
+            model: str = typer.Option(None),
+            schema: str = typer.Option(None, help="JSON Schema; по умолчанию — схема, упомянутая в шаблоне"),
+            var: list[str] = typer.Option(None, help="Пара key=value для остальных переменных шаблона"),
+            text_var: str = typer.Option(None, help="Переменная для текста чанка (по умолчанию — единственная незаданная)"),
+            chunk_chars: int = typer.Option(6000, min=500, help="Длина чанка, символов"),
+            overlap: int = typer.Option(600, min=0, help="Перекрытие соседних чанков, символов"),
+            concurrency: int = typer.Option(4, "--concurrency", "-c", min=1, help="Чанков в работе одновременно"),
+            rpm: int = typer.Option(0, help="Лимит запросов в минуту (0 — без лимита)"),
+            checkpoint: str = typer.Option(None, help="JSONL контрольной точки (по умолчанию — в .cache/extract)"),
+            no_cache: bool = typer.Option(False, "--no-cache", help="Не брать ответы из кеша")):
+    """
+    Map‑reduce извлечение по большому файлу: чанки с перекрытием по границам абзацев и
+    предложений, параллельные запросы, проверка частичных результатов по схеме и слияние
+    в один объект. Прерванный прогон продолжается с контрольной точки.
+    """
+    load_dotenv()
+    provider = os.environ.get("PROVIDER","openai")
+    p = get_provider(provider, model=model)
+    tpl = load_template(prompt_file)
+    kv = parse_vars(var)
+    schema = schema or schema_from_template(tpl.text)
+    if not schema:
+        print("[bold red]Схема не указана и не найдена в шаблоне:[/bold red] задайте --schema")
+        raise typer.Exit(2)
+    free = [v for v in tpl.variables if v not in kv]
+    text_var = text_var or (free[0] if len(free) == 1 else None)
+    if text_var not in tpl.variables:
+        print("[bold red]Не ясно, куда подставлять текст чанка:[/bold red] задайте --text-var из", ", ".join(free or tpl.variables))
+        raise typer.Exit(2)
+    with open(schema, "r", encoding="utf-8") as f:
+        schema_obj = json.load(f)
+    limiter, cache = RateLimiter(rpm), get_cache()
+
+    def call(prompt: str) -> str:
+        with trace(template=prompt_file, model=p.model, provider=provider):
+            with span("cache"):
+                out = None if no_cache else cache.get(p.name, p.model, 0.0, prompt)
+            if out is not None:
+                incr("cache_hits")
+                return out
+            limiter.acquire()
+            out = p.chat(prompt)
+            cache.put(p.name, p.model, 0.0, prompt, out)
+            return out
+
+    def progress(stats: dict, frac: float):
+        sys.stderr.write(f"\r{frac:4.0%} · чанков {stats['chunks']} (готово {stats['ok']}, из точки {stats['skipped']}, "
+                         f"ошибок {stats['failed']}, невалидных {stats['invalid']})")
+        sys.stderr.flush()
+
+    t0 = time.perf_counter()
+    res = run_extract(call, tpl, input, text_var, schema_obj, values=kv,
+                      checkpoint=checkpoint or default_checkpoint(input, prompt_file), template_id=prompt_file,
+                      concurrency=concurrency, max_chars=chunk_chars, overlap=overlap, on_progress=progress)
+    sys.stderr.write("\n")
+    st = res.stats
+    print(f"Чанков: {st['chunks']} (из контрольной точки {st['skipped']}), ошибок {st['failed']}, "
+          f"невалидных {st['invalid']}, слито {st['merged']} за {time.perf_counter() - t0:.1f}s")
+    for field, options in res.conflicts.items():
+        print(f"[yellow]Конфликт {field}:[/yellow]", escape(", ".join(f"{o['value']!r}×{o['votes']}" for o in options[:5])))
+    text = json.dumps(res.result, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print("Итог →", output)
+    else:
+        print(escape(text))
+    log_run("extract", provider, p.model, prompt_file, {**kv, text_var: f"<{input}>"}, None, text,
+            schema=schema, valid=res.error is None, conflicts=res.conflicts, chunks=st["chunks"])
+    if st["failed"]:
+        print(f"[yellow]{st['failed']} чанков не обработаны — повторный запуск дообработает только их[/yellow]")
+    if res.error:
+        print("[bold red]Итог не проходит схему:[/bold red]", escape(res.error))
+        raise typer.Exit(1)
+    print("[bold cyan]Итог валиден по схеме[/bold cyan]")
+
+cache_app = typer.Typer(help="Кеш ответов модели")
+app.add_typer(cache_app, name="cache")
+
+@cache_app.command("stats")
+def cache_stats():
+    """Размер и счётчики кеша ответов."""
+    print(get_cache().stats())
+
+@cache_app.command("clear")
+def cache_clear():
+    """Удалить все записи кеша ответов."""
+    get_cache().clear()
+    print("[bold]Кеш очищен[/bold]")
+
+history_app = typer.Typer(help="История прогонов (общая с Streamlit)")
+app.add_typer(history_app, name="history")
+
+@history_app.command("list")
+def history_list(template: str = typer.Option(None), schema: str = typer.Option(None),
+                 valid: bool = typer.Option(None, "--valid/--invalid", help="Только валидные / невалидные"),
+                 source: str = typer.Option(None, help="ui | cli | batch | consistency | extract | import"),
+                 limit: int = typer.Option(20, "--limit", "-n", min=1),
+                 before: int = typer.Option(None, help="Страница: записи с id меньше указанного")):
+    """Последние прогоны с фильтрами."""
+    h = get_history()
+    filters = dict(template=template, schema=schema, valid=valid, source=source)
+    rows = h.page(before=before, limit=limit, **filters)
+    for r in rows:
+        print(f"{r['id']:>7} {r['ts']} {r['source']:<6} {escape(str(r['template']))} "
+              f"valid={r['valid']} cached={r['cached']} elapsed={r['elapsed']}")
+    print(f"[dim]всего по фильтру: {h.count(**filters)}"
+          + (f"; следующая страница: --before {rows[-1]['id']}" if len(rows) == limit else "") + "[/dim]")
+
+@history_app.command("export")
+def history_export(output: str = typer.Option(..., "--output", "-o", help="JSONL"),
+                   template: str = typer.Option(None), schema: str = typer.Option(None),
+                   valid: bool = typer.Option(None, "--valid/--invalid")):
+    """Потоковая выгрузка истории в JSONL (вместе с промптами и ответами)."""
+    n = 0
+    with open(output, "w", encoding="utf-8") as f:
+        for line in get_history().iter_export(template=template, schema=schema, valid=valid):
+            f.write(line)
+            n += 1
+    print(f"[bold]Выгружено:[/bold] {n} → {output}")
+
+@history_app.command("import")
+def history_import(path: str):
+    """Загрузка истории из JSONL (или JSON‑списка, выгруженного прежней версией UI)."""
+    with open(path, "r", encoding="utf-8") as f:
+        n = get_history().import_stream(f)
+    print(f"[bold]Импортировано:[/bold] {n}")
+
+@app.command("metrics")
+def metrics_report(trace_log: str = typer.Argument(..., help="JSONL трасс (пишется при заданном LLM_TRACE_LOG)"),
+                   fmt: str = typer.Option("table", "--format", help="table | jsonl | prom"),
+                   output: str = typer.Option(None, "--output", "-o", help="Файл (по умолчанию — stdout)")):
+    """Сводка трасс по шаблонам и моделям: время по фазам, токены, повторы, попадания в кеш."""
+    for _, rec in iter_jsonl(trace_log):
+        metrics.observe(rec)
+    if fmt == "table":
+        for row in metrics.snapshot():
+            print(row)
+        return
+    text = metrics.to_prometheus() if fmt == "prom" else "".join(metrics.iter_jsonl())
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"[bold]Сохранено:[/bold] {output}")
+    else:
+        sys.stdout.write(text)
+
+index_app = typer.Typer(help="Поисковый индекс BM25 для {passages}")
+app.add_typer(index_app, name="index")
+
+@index_app.command("build")
+def index_build(docs_dir: str = typer.Argument("banking", help="Каталог с документами .md/.txt"),
+                index: str = typer.Option(DEFAULT_INDEX, help="Каталог индекса"),
+                full: bool = typer.Option(False, "--full", help="Пересобрать с нуля (иначе — только изменённые файлы)")):
+    """Построить или обновить индекс."""
+    stats = build_index(docs_dir, index, full=full)
+    print(stats)
+
+@index_app.command("query")
+def index_query(query: str, index: str = typer.Option(DEFAULT_INDEX),
+                top_k: int = typer.Option(4, "--top-k", "-k", min=1)):
+    """Top‑k пассажей по запросу."""
+    idx = open_index(index)
+    if idx is None:
+        print("[bold red]Индекс не построен:[/bold red] python scripts/run.py index build <каталог>")
+        raise typer.Exit(1)
+    t0 = time.perf_counter()
+    hits = idx.search(query, k=top_k)
+    print(f"[dim]{(time.perf_counter() - t0) * 1000:.2f} мс[/dim]")
+    for pid, score, text in hits:
+        print(f"[bold]{escape(pid)}[/bold] [dim]{score}[/dim]\n", escape(text[:500]))
+
+@index_app.command("check")
+def index_check(cases: str = typer.Argument(..., help='JSONL: {"query": ..., "relevant": ["файл.md#N" или "файл.md", ...]}'),
+                index: str = typer.Option(DEFAULT_INDEX),
+                top_k: int = typer.Option(4, "--top-k", "-k", min=1),
+                min_recall: float = typer.Option(0.0, help="Код выхода 1, если recall@k ниже")):
+    """Проверка полноты поиска (recall@k, MRR) на размеченных запросах."""
+    idx = open_index(index)
+    if idx is None:
+        print("[bold red]Индекс не построен[/bold red]")
+        raise typer.Exit(1)
+    report = check_recall(idx, (row for _, row in iter_jsonl(cases)), k=top_k)
+    for miss in report.pop("misses"):
+        print("[yellow]Промах:[/yellow]", escape(miss["query"]), "→", escape(", ".join(miss["got"]) or "—"))
+    print(report)
+    if report["recall"] is not None and report["recall"] < min_recall:
+        raise typer.Exit(1)
 
 if __name__ == "__main__":
     app()
@@ -0,0 +1,273 @@
+"""
+Проверка ответов модели по JSON Schema.
+
+- Валидаторы компилируются один раз и кешируются (файл — по пути и mtime).
+- JSON извлекается сканером сбалансированных скобок с учётом строк и экранирования,
+  поэтому проза со скобками вокруг ответа не мешает. Проверяется первый объект с полями
+  схемы: пример без них перед ответом пропускается — и в обычном ответе, и на потоке.
+- IncrementalValidator проверяет ответ по мере стрима: как только поле верхнего
+  уровня нарушает контракт (например, `category` вне enum), генерацию можно остановить.
+
+jsonschema — необязательная зависимость: импортируется при первой компиляции валидатора.
+"""
+import functools, json, os, threading, time, typing as T
+from instrumentation import add_span
+
+_file_validators: T.Dict[str, T.Tuple[float, T.Any]] = {}
+_file_lock = threading.Lock()
+
+def _compile(schema: dict):
+    import jsonschema
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+@functools.lru_cache(maxsize=64)
+def _compile_text(schema_text: str):
+    return _compile(json.loads(schema_text))
+
+def compile_validator(schema: dict):
+    """Валидатор для схемы‑объекта (например, загруженной в UI); кешируется по содержимому."""
+    return _compile_text(json.dumps(schema, sort_keys=True, ensure_ascii=False))
+
+def load_validator(path: str):
+    """Валидатор для файла схемы; пересобирается только при изменении файла."""
+    key = os.path.abspath(path)
+    mtime = os.stat(key).st_mtime
+    item = _file_validators.get(key)
+    if item is not None and item[0] == mtime:
+        return item[1]
+    with open(key, "r", encoding="utf-8") as f:
+        validator = _compile(json.load(f))
+    with _file_lock:
+        _file_validators[key] = (mtime, validator)
+    return validator
+
+def _balanced_end(text: str, start: int) -> int:
+    """Индекс за закрывающей скобкой для объекта/массива с позиции `start`, либо -1."""
+    depth, in_str, esc = 0, False, False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_str:
+            if esc: esc = False
+            elif ch == "\\": esc = True
+            elif ch == '"': in_str = False
+        elif ch == '"': in_str = True
+        elif ch in "{[": depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return -1
+
+def iter_json_objects(text: str) -> T.Iterator[T.Any]:
+    """Все JSON‑объекты верхнего уровня, встреченные в тексте, по порядку."""
+    pos = text.find("{")
+    while pos != -1:
+        end = _balanced_end(text, pos)
+        if end == -1:
+            pos = text.find("{", pos + 1)
+            continue
+        try:
+            yield json.loads(text[pos:end])
+            pos = text.find("{", end)
+        except ValueError:
+            pos = text.find("{", pos + 1)
+
+def extract_json(text: str) -> T.Optional[T.Any]:
+    """Первый корректный JSON‑объект в тексте или None."""
+    return next(iter_json_objects(text), None)
+
+def error_message(validator, obj) -> T.Optional[str]:
+    import jsonschema
+    err = jsonschema.exceptions.best_match(validator.iter_errors(obj))
+    if err is None:
+        return None
+    where = "/".join(str(p) for p in err.absolute_path)
+    return f"{where}: {err.message}" if where else err.message
+
+def _properties(validator) -> T.Dict[str, dict]:
+    schema = validator.schema if isinstance(validator.schema, dict) else {}
+    return schema.get("properties") or {}
+
+def _unrelated(obj: T.Any, props: T.Mapping[str, dict]) -> bool:
+    """Объект без единого поля схемы — пример или посторонний JSON перед ответом."""
+    return bool(props) and isinstance(obj, dict) and not obj.keys() & props.keys()
+
+def validate_output(text: str, validator) -> T.Tuple[T.Optional[T.Any], T.Optional[str]]:
+    """
+    (объект, ошибка) для первого JSON‑объекта в ответе, у которого есть хотя бы одно поле
+    схемы; объекты без таких полей (пример в прозе) пропускаются. Правило то же, что у
+    IncrementalValidator на потоке: если этот объект нарушает схему, ответ невалиден,
+    даже когда дальше идёт подходящий, — иначе потоковая и обычная проверки расходились бы.
+    Если подходящих объектов нет, проверяется первый найденный.
+    """
+    props = _properties(validator)
+    t0 = time.perf_counter()
+    obj = first = None
+    for candidate in iter_json_objects(text):
+        if first is None: first = candidate
+        if not _unrelated(candidate, props):
+            obj = candidate
+            break
+    obj = first if obj is None else obj
+    t1 = time.perf_counter()
+    err = "JSON не найден в ответе" if obj is None else error_message(validator, obj)
+    add_span("extract_json", t1 - t0)
+    add_span("validate", time.perf_counter() - t1)
+    return obj, err
+
+_NOTHING = object()
+
+class IncrementalValidator:
+    """
+    Проверка JSON‑объекта по мере поступления фрагментов.
+    Каждое поле верхнего уровня проверяется, как только его значение закончилось;
+    строковое значение поля с enum — уже по префиксу. Проверяется тот же объект, что и в
+    `validate_output`: '{' в прозе и объекты без полей схемы перед ним пропускаются, поэтому
+    ошибка в постороннем объекте не обрывает генерацию, пока в нём не встретилось поле схемы.
+    `feed()` возвращает текст первой ошибки (после неё фрагменты игнорируются) или None.
+    """
+    def __init__(self, validator):
+        self.validator = validator
+        schema = validator.schema if isinstance(validator.schema, dict) else {}
+        self.props: T.Dict[str, dict] = schema.get("properties") or {}
+        self.closed = schema.get("additionalProperties") is False
+        self.error: T.Optional[str] = None
+        self.done = False
+        self._skipped: T.Any = _NOTHING  # ошибка первого пропущенного объекта (None — он валиден)
+        self._reset()  # _s — текст, начиная с первой '{'
+
+    def feed(self, chunk: str) -> T.Optional[str]:
+        while chunk and not (self.error or self.done):
+            if self._expect == "start":
+                pos = chunk.find("{")
+                if pos == -1:
+                    return None
+                chunk = chunk[pos:]
+            base = len(self._s)
+            self._s += chunk
+            chunk = ""
+            for i in range(base, len(self._s)):
+                restart = self._step(self._s[i], i)
+                if restart is not None:
+                    # '{' не начало JSON (проза в скобках) или объект без полей схемы — ищем дальше
+                    chunk = self._s[restart:]
+                    self._reset()
+                    break
+                if self.error or self.done:
+                    break
+        return self.error
+
+    def _reset(self):
+        self._s, self._depth, self._in_str, self._esc = "", 0, False, False
+        self._expect, self._key, self._mark = "start", None, 0
+        self._relevant, self._pending = False, None
+
+    def finish(self) -> T.Optional[str]:
+        """Итог после конца потока: ошибка, если объект так и не был закрыт."""
+        if self.error is None and not self.done:
+            if self._skipped is not _NOTHING:
+                self.error = self._skipped  # как validate_output: подходящих нет — первый найденный
+                self.done = self.error is None
+            else:
+                self.error = "JSON не найден в ответе" if self._expect == "start" else "JSON оборван"
+        return self.error
+
+    def _fail(self, msg: str):
+        """Ошибку в объекте без полей схемы откладываем: он может оказаться примером."""
+        if self._relevant or not self.props:
+            self.error = msg
+        elif self._pending is None:
+            self._pending = msg
+
+    def _check_field(self, raw: str):
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            self._fail(f"{self._key}: некорректное значение {raw[:40]!r}")
+            return
+        sub = self.props.get(self._key)
+        if sub is None:
+            if self.closed:
+                self._fail(f"лишнее поле {self._key!r}")
+            return
+        msg = error_message(self.validator.evolve(schema=sub), value)
+        if msg:
+            self._fail(f"{self._key}: {msg}")
+
+    def _check_enum_prefix(self, i: int):
+        sub = self.props.get(self._key) or {}
+        enum = sub.get("enum")
+        partial = self._s[self._mark + 1:i + 1]
+        if not enum or "\\" in partial:
+            return
+        if not any(isinstance(e, str) and e.startswith(partial) for e in enum):
+            self._fail(f"{self._key}: {partial!r}… не входит в {enum}")
+
+    def _step(self, ch: str, i: int) -> T.Optional[int]:
+        """Обработка символа; число — с какой позиции `_s` искать следующий объект."""
+        if self._in_str:
+            if self._esc: self._esc = False
+            elif ch == "\\": self._esc = True
+            elif ch == '"':
+                self._in_str = False
+                if self._depth == 1 and self._expect == "key_str":
+                    self._key = json.loads(self._s[self._mark:i + 1])
+                    self._expect = "colon"
+                    if self._key in self.props and not self._relevant:
+                        self._relevant = True
+                        if self._pending: self.error = self._pending
+                    elif self.closed and self._key not in self.props:
+                        self._fail(f"лишнее поле {self._key!r}")
+                elif self._depth == 1 and self._expect == "value_str":
+                    self._check_field(self._s[self._mark:i + 1])
+                    self._expect = "comma"
+            elif self._depth == 1 and self._expect == "value_str":
+                self._check_enum_prefix(i)
+            return None
+        if self._expect == "start":
+            if ch == "{":
+                self._depth, self._expect = 1, "key"
+            return None
+        if ch == '"':
+            self._in_str = True
+            if self._depth == 1 and self._expect == "key":
+                self._mark, self._expect = i, "key_str"
+            elif self._depth == 1 and self._expect == "value":
+                self._mark, self._expect = i, "value_str"
+        elif ch in "{[":
+            if self._depth == 1 and self._expect == "value":
+                self._mark, self._expect = i, "value_nested"
+            self._depth += 1
+        elif ch in "}]":
+            self._depth -= 1
+            if self._depth == 1 and self._expect == "value_nested":
+                self._check_field(self._s[self._mark:i + 1])
+                self._expect = "comma"
+            elif self._depth == 0:
+                try:
+                    obj = json.loads(self._s[:i + 1])
+                except ValueError:
+                    return 1
+                if self._expect == "value_scalar":
+                    self._check_field(self._s[self._mark:i])
+                if _unrelated(obj, self.props):
+                    if self._skipped is _NOTHING:
+                        self._skipped = error_message(self.validator, obj)
+                    return i + 1
+                if self.error is None:
+                    self.error = error_message(self.validator, obj)
+                self.done = True
+        elif self._depth == 1 and not ch.isspace():
+            if ch == ":" and self._expect == "colon":
+                self._expect = "value"
+            elif ch == ",":
+                if self._expect == "value_scalar":
+                    self._check_field(self._s[self._mark:i])
+                self._expect = "key"
+            elif self._expect == "value":
+                self._mark, self._expect = i, "value_scalar"
+            elif self._expect in ("key", "colon"):
+                return 1
+        return None
@@ -0,0 +1,128 @@
+"""
+Self‑consistency: N параллельных выборок при temperature > 0 и голосование.
+
+Для ответов по JSON‑схеме голосуют нормализованные категориальные поля схемы
+(enum, boolean, числа); если таких нет — обязательные поля. Свободный текст
+голосует точным совпадением после нормализации пробелов и регистра.
+Как только лидер набрал кворум, невыполненные выборки отменяются, а начатые
+обрываются (потоковые запросы закрываются при следующем фрагменте).
+"""
+import contextvars, threading, typing as T
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from schema_validation import validate_output
+
+class SampleCancelled(Exception):
+    """Выборка прервана: кворум уже набран."""
+
+def vote_fields(schema: dict) -> T.List[str]:
+    props = schema.get("properties") or {}
+    fields = [k for k, sub in props.items()
+              if "enum" in sub or sub.get("type") in ("boolean", "integer", "number")]
+    return fields or list(schema.get("required") or props)
+
+def normalize(value) -> T.Hashable:
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    if isinstance(value, list):
+        return tuple(sorted((normalize(v) for v in value), key=repr))
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalize(v)) for k, v in value.items()))
+    return value
+
+def make_key_fn(validator=None) -> T.Callable[[str], T.Optional[T.Hashable]]:
+    """Функция «ответ → голос». Невалидный по схеме ответ не голосует (None)."""
+    if validator is None:
+        return lambda text: normalize(text) or None
+    fields = vote_fields(validator.schema)
+    def key(text: str):
+        obj, err = validate_output(text, validator)
+        if err is not None:
+            return None
+        return tuple((f, normalize(obj.get(f))) for f in fields)
+    return key
+
+def provider_sampler(provider, prompt: str, temperature: float) -> T.Callable[[threading.Event], str]:
+    """Выборка через потоковый вызов: при установленном `stop` запрос обрывается."""
+    def sample(stop: threading.Event) -> str:
+        if stop.is_set():
+            raise SampleCancelled()
+        chunks = provider.stream_chat(prompt, temperature=temperature)
+        parts = []
+        try:
+            for piece in chunks:
+                if stop.is_set():
+                    raise SampleCancelled()
+                parts.append(piece)
+        finally:
+            chunks.close()
+        return "".join(parts)
+    return sample
+
+class VoteResult:
+    def __init__(self, answer: T.Optional[str], key, votes: int, completed: int, requested: int,
+                 tally: Counter, invalid: int, errors: T.List[str], stopped_early: bool):
+        self.answer = answer          # первый ответ с победившим голосом
+        self.key = key
+        self.votes = votes
+        self.completed = completed    # завершённые выборки (включая невалидные)
+        self.requested = requested
+        self.tally = tally
+        self.invalid = invalid
+        self.errors = errors
+        self.stopped_early = stopped_early
+
+    @property
+    def agreement(self) -> float:
+        return self.votes / self.completed if self.completed else 0.0
+
+    def as_dict(self) -> dict:
+        return {"answer": self.answer, "votes": self.votes, "completed": self.completed,
+                "requested": self.requested, "agreement": round(self.agreement, 3),
+                "invalid": self.invalid, "errors": len(self.errors),
+                "stopped_early": self.stopped_early,
+                "tally": [[repr(k), c] for k, c in self.tally.most_common()]}
+
+def self_consistency(sample: T.Callable[[threading.Event], str], n: int,
+                     key_fn: T.Callable[[str], T.Optional[T.Hashable]],
+                     quorum: T.Optional[int] = None, concurrency: T.Optional[int] = None) -> VoteResult:
+    """
+    Запускает до `n` выборок (не более `concurrency` одновременно) и голосует.
+    `quorum` по умолчанию — строгое большинство от n.
+    """
+    quorum = quorum or n // 2 + 1
+    stop = threading.Event()
+    tally: Counter = Counter()
+    first_answer: T.Dict[T.Hashable, str] = {}
+    errors: T.List[str] = []
+    invalid = completed = 0
+    with ThreadPoolExecutor(max_workers=min(n, concurrency or n)) as pool:
+        # спаны и токены выборок попадают в трассу вызывающего потока
+        pending = {pool.submit(contextvars.copy_context().run, sample, stop) for _ in range(n)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.cancelled():
+                    continue
+                try:
+                    text = fut.result()
+                except SampleCancelled:
+                    continue
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+                    continue
+                completed += 1
+                key = key_fn(text)
+                if key is None:
+                    invalid += 1
+                    continue
+                tally[key] += 1
+                first_answer.setdefault(key, text)
+            if tally and tally.most_common(1)[0][1] >= quorum and pending:
+                stop.set()
+                for fut in pending:
+                    fut.cancel()
+    if not tally:
+        return VoteResult(None, None, 0, completed, n, tally, invalid, errors, stop.is_set())
+    key, votes = tally.most_common(1)[0]
+    return VoteResult(first_answer[key], key, votes, completed, n, tally, invalid, errors, stop.is_set())
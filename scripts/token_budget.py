@@ -0,0 +1,122 @@
+"""
+Сборка промпта под бюджет токенов.
+
+Токены оцениваются локально, без токенизатора модели: текст режется регулярным выражением
+на слова, числа и знаки, слово стоит ~1 токен на 4 латинских или 3 кириллических буквы.
+Оценка аддитивна по пробельным границам, поэтому стоимость шаблона и каждого пассажа
+считается отдельно.
+
+Пассажи для `{passages}` (из индекса или вставленные вручную блоками `[id] текст`) идут
+в порядке ранга: почти одинаковые отбрасываются (сходство Жаккара по триграммам слов),
+остальные берутся целиком, пока помещаются в бюджет, — пассаж не обрезается, а выпадает
+вместе со своим id, чтобы цитаты в ответе ссылались только на то, что модель видела.
+"""
+import math, re, typing as T
+
+_PIECE_RE = re.compile(r"[^\W\d_]+|\d+|\S", re.U)
+_LATIN_RE = re.compile(r"[a-zA-Z]+")
+_BLOCK_RE = re.compile(r"\[([^\]\n]+)\]\s*(.*)", re.S)
+
+Passage = T.Tuple[str, T.Optional[float], str]  # (id, оценка поиска, текст) — как у BM25Index.search
+
+def estimate_tokens(text: str) -> int:
+    """Приближённое число токенов (с небольшим запасом для BPE‑токенизаторов GPT/GigaChat)."""
+    n = 0
+    for piece in _PIECE_RE.findall(text):
+        if piece.isdigit():
+            n += math.ceil(len(piece) / 3)
+        elif len(piece) == 1:
+            n += 1
+        else:
+            n += math.ceil(len(piece) / (4 if _LATIN_RE.fullmatch(piece) else 3))
+    return n
+
+def split_blocks(text: str) -> T.List[Passage]:
+    """Вставленные вручную пассажи: блоки через пустую строку, id — из префикса `[id]`, если есть."""
+    out = []
+    for i, block in enumerate(b.strip() for b in re.split(r"\n\s*\n", text)):
+        if not block:
+            continue
+        m = _BLOCK_RE.fullmatch(block)
+        out.append((m.group(1), None, m.group(2)) if m else (f"#{i + 1}", None, block))
+    return out
+
+def _block(pid: str, text: str) -> str:
+    return text if pid.startswith("#") else f"[{pid}] {text}"
+
+def _shingles(text: str, n: int = 3) -> T.Set[T.Tuple[str, ...]]:
+    words = re.findall(r"\w+", text.lower())
+    return {tuple(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+
+def dedup(passages: T.Sequence[Passage], threshold: float = 0.8) -> T.Tuple[T.List[Passage], T.List[str]]:
+    """(оставленные, id дублей). Из почти одинаковых остаётся пассаж с более высоким рангом."""
+    kept: T.List[Passage] = []
+    seen: T.List[T.Set[T.Tuple[str, ...]]] = []
+    dropped: T.List[str] = []
+    for p in passages:
+        sh = _shingles(p[2])
+        if any(len(sh & s) / (len(sh | s) or 1) >= threshold for s in seen):
+            dropped.append(p[0])
+            continue
+        kept.append(p)
+        seen.append(sh)
+    return kept, dropped
+
+class BudgetedPrompt:
+    """Результат сборки: текст, оценка токенов и что стало с пассажами."""
+    def __init__(self, text: str, tokens: int, budget: T.Optional[int]):
+        self.text = text
+        self.tokens = tokens
+        self.budget = budget
+        self.passage_ids: T.Optional[T.List[str]] = None  # None — шаблон без пассажей
+        self.dropped: T.List[str] = []
+        self.duplicates: T.List[str] = []
+
+    @property
+    def over_budget(self) -> bool:
+        return self.budget is not None and self.tokens > self.budget
+
+    def summary(self) -> str:
+        parts = [f"≈{self.tokens} токенов" + (f" из {self.budget}" if self.budget else "")]
+        if self.passage_ids is not None: parts.append(f"пассажей {len(self.passage_ids)}")
+        if self.dropped: parts.append("не вошли: " + ", ".join(self.dropped))
+        if self.duplicates: parts.append("дубли: " + ", ".join(self.duplicates))
+        return " · ".join(parts)
+
+    def as_dict(self) -> dict:
+        d = {"prompt_tokens_est": self.tokens, "token_budget": self.budget}
+        if self.dropped: d["dropped_passages"] = self.dropped
+        if self.duplicates: d["duplicate_passages"] = self.duplicates
+        return d
+
+def compile_prompt(tpl, values: T.Mapping[str, str], budget: T.Optional[int] = None,
+                   passages: T.Optional[T.Sequence[Passage]] = None,
+                   dedup_threshold: float = 0.8) -> BudgetedPrompt:
+    """
+    Рендер шаблона с упаковкой `{passages}` в бюджет. Пассажи берутся из `passages`
+    (уже ранжированные) или разбором `values["passages"]`. Бюджет 0/None — без ограничения
+    (дубли всё равно убираются). Если не помещается даже шаблон без пассажей, результат
+    помечается `over_budget` — переменные, кроме пассажей, не режутся.
+    """
+    values = dict(values)
+    budget = budget or None
+    if "passages" not in tpl.variables or (passages is None and not values.get("passages")):
+        text = tpl.render(values)
+        return BudgetedPrompt(text, estimate_tokens(text), budget)
+    candidates, duplicates = dedup(passages if passages is not None else split_blocks(values["passages"]),
+                                   dedup_threshold)
+    room = None if budget is None else budget - estimate_tokens(tpl.render({**values, "passages": ""}))
+    kept, dropped = [], []
+    for pid, _, text in candidates:
+        cost = estimate_tokens(_block(pid, text))
+        if room is None or cost <= room:
+            kept.append((pid, text))
+            if room is not None: room -= cost
+        else:
+            dropped.append(pid)  # следующий, более короткий пассаж ещё может поместиться
+    values["passages"] = "\n\n".join(_block(pid, text) for pid, text in kept)
+    text = tpl.render(values)
+    res = BudgetedPrompt(text, estimate_tokens(text), budget)
+    res.passage_ids = [pid for pid, _ in kept]
+    res.dropped, res.duplicates = dropped, duplicates
+    return res
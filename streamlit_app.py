@@ -1,7 +1,23 @@
 
-import os, re, json, glob, requests, time, base64, io
+import os, sys, json, glob, time, base64, io, tempfile
 import streamlit as st
 
+# Общие модули CLI (scripts/) — транспорт и пр.
+_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts")
+if _SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, _SCRIPTS_DIR)
+from llm_transport import Transport, TokenCache, StreamTimer, iter_chat_deltas, parse_expires_at
+from response_cache import get_cache
+from prompt_templates import load_template, compile_text
+from schema_validation import IncrementalValidator, compile_validator, load_validator, validate_output
+from self_consistency import make_key_fn, provider_sampler, self_consistency
+from react import default_tools, run_react
+from retrieval import open_index
+from token_budget import compile_prompt
+from router import Router, router_from_env
+from history_store import get_history
+from instrumentation import metrics, record_usage, trace
+
 # Optional: jsonschema for validation
 try:
     import jsonschema
@@ -14,7 +30,7 @@ st.set_page_config(page_title="Prompt Engineering — Lab", page_icon="🧠", la
 # ---------------- Session helpers ----------------
 def _init_state():
     ss = st.session_state
-    ss.setdefault("history", [])  # list of dicts
+    ss.setdefault("history_cursors", [None])  # стек курсоров страниц истории (id « до »)
     ss.setdefault("custom_prompts", {})  # name -> text
     ss.setdefault("cot_builder", {"system":"Ты — аккуратный аналитик.",
                                   "role":"Исследователь в банковском домене РФ.",
@@ -27,39 +43,64 @@ def now_iso():
     return time.strftime("%Y-%m-%dT%H:%M:%S")
 
 def add_history(entry: dict):
-    st.session_state.history.insert(0, entry)
+    # Общая постоянная история (SQLite): переживает сессию, туда же пишут CLI chat/batch
+    get_history().add(entry, source="ui")
 
-def download_bytes(name: str, data: bytes, label: str):
+def download_bytes(name: str, data, label: str):
+    """`data` — байты или функция без аргументов, вызываемая при нажатии."""
     st.download_button(label, data=data, file_name=name, mime="application/octet-stream")
 
 # ---------------- Providers ----------------
+def _raise_for_status(r):
+    """
+    Ошибка HTTP с началом тела ответа. Только исключение, без st.*: провайдер вызывают и из
+    потоков (самосогласованность, маршрутизатор) — показывает ошибку вызывающий код вкладки.
+    """
+    if r.status_code >= 400:
+        import textwrap as _tw
+        body = _tw.shorten(r.text, width=240, placeholder="...")
+        r.close()
+        raise RuntimeError(f"HTTP {r.status_code} от {r.url}: {body}")
+
 class OpenAICompat:
-    def __init__(self, model: str|None=None, base: str|None=None, key: str|None=None):
+    def __init__(self, model: str|None=None, base: str|None=None, key: str|None=None, transport: Transport|None=None):
         self.base = base or os.environ.get("OPENAI_API_BASE") or st.secrets.get("OPENAI_API_BASE", "https://api.openai.com/v1")
         self.key  = key  or os.environ.get("OPENAI_API_KEY")  or st.secrets.get("OPENAI_API_KEY")
         self.model = model or st.secrets.get("OPENAI_MODEL", "gpt-4o-mini")
+        self.name = f"openai:{self.base}"
+        self.transport = transport or Transport()
         if not self.key:
             st.warning("OPENAI_API_KEY не задан (Secrets). Запросы не будут выполняться.")
-    def chat(self, prompt: str, temperature: float=0.0) -> str:
+    def _post(self, prompt: str, temperature: float, stream: bool=False):
         url = f"{self.base}/chat/completions"
         headers = {"Authorization": f"Bearer {self.key}", "Content-Type":"application/json"}
         data = {"model": self.model, "messages":[{"role":"user","content":prompt}], "temperature": temperature}
-        r = requests.post(url, headers=headers, json=data, timeout=120)
-        import textwrap as _tw
-        (
-            r.raise_for_status()
-        ) if r.status_code < 400 else (_ := st.error("OAuth error: " + _tw.shorten(r.text, width=240, placeholder="...")) or r.raise_for_status())
-        return r.json()["choices"][0]["message"]["content"]
+        if stream: data.update(stream=True, stream_options={"include_usage": True})
+        r = self.transport.post(url, headers=headers, json=data, timeout=120, stream=stream)
+        _raise_for_status(r)
+        return r
+    def chat(self, prompt: str, temperature: float=0.0) -> str:
+        body = self._post(prompt, temperature).json()
+        record_usage(body.get("usage"))
+        return body["choices"][0]["message"]["content"]
+    def stream_chat(self, prompt: str, temperature: float=0.0):
+        return iter_chat_deltas(self._post(prompt, temperature, stream=True))
 
 class GigaChat:
-    def __init__(self, model: str|None=None):
+    def __init__(self, model: str|None=None, base: str|None=None, key: str|None=None, transport: Transport|None=None):
         self.model = model or st.secrets.get("GIGACHAT_MODEL","GigaChat-Pro")
         self.scope = os.environ.get("GIGACHAT_SCOPE") or st.secrets.get("GIGACHAT_SCOPE","GIGACHAT_API_PERS")
-        self.auth_key = (os.environ.get("GIGACHAT_AUTH_KEY") or st.secrets.get("GIGACHAT_AUTH_KEY") 
+        self.auth_key = (key or os.environ.get("GIGACHAT_AUTH_KEY") or st.secrets.get("GIGACHAT_AUTH_KEY") 
                          or os.environ.get("GIGACHAT_AUTH") or st.secrets.get("GIGACHAT_AUTH"))
         verify_raw = (os.environ.get("GIGACHAT_VERIFY") or str(st.secrets.get("GIGACHAT_VERIFY","true"))).strip().lower()
         self.verify = False if verify_raw in ("0","false","no","off") else True
-        self._token = None
+        self.oauth_url = (os.environ.get("GIGACHAT_OAUTH_URL")
+                          or st.secrets.get("GIGACHAT_OAUTH_URL","https://ngw.devices.sberbank.ru:9443/api/v2/oauth"))
+        self.api_base = (base or os.environ.get("GIGACHAT_API_BASE")
+                         or st.secrets.get("GIGACHAT_API_BASE","https://gigachat.devices.sberbank.ru/api/v1"))
+        self.name = f"gigachat:{self.api_base}"
+        self.transport = transport or Transport()
+        self._tokens = TokenCache(self._fetch_token)
         if not self.auth_key:
             st.warning("GIGACHAT_AUTH_KEY не задан (Secrets). Запросы не будут выполняться.")
     def _token_headers(self):
@@ -68,46 +109,114 @@ class GigaChat:
                 "Content-Type":"application/x-www-form-urlencoded",
                 "Accept":"application/json",
                 "RqUID": str(uuid.uuid4())}
-    def _get_token(self)->str:
-        if self._token: return self._token
-        url = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
+    def _fetch_token(self):
+        url = self.oauth_url
         data = {"scope": self.scope}
-        r = requests.post(url, headers=self._token_headers(), data=data, timeout=60, verify=self.verify)
-        import textwrap as _tw
-        (
-            r.raise_for_status()
-        ) if r.status_code < 400 else (_ := st.error("OAuth error: " + _tw.shorten(r.text, width=240, placeholder="...")) or r.raise_for_status())
-        self._token = r.json()["access_token"]
-        return self._token
-    def chat(self, prompt: str, temperature: float=0.0) -> str:
-        token = self._get_token()
-        url = "https://gigachat.devices.sberbank.ru/api/v1/chat/completions"
-        headers = {"Authorization": f"Bearer {token}","Content-Type":"application/json"}
+        r = self.transport.post(url, headers=self._token_headers(), data=data, timeout=60, verify=self.verify)
+        _raise_for_status(r)
+        body = r.json()
+        return body["access_token"], parse_expires_at(body.get("expires_at"))
+    def _get_token(self)->str:
+        return self._tokens.get()
+    def _post(self, prompt: str, temperature: float, stream: bool=False):
+        url = f"{self.api_base}/chat/completions"
         payload = {"model": self.model, "messages":[{"role":"user","content":prompt}],"temperature":temperature}
-        r = requests.post(url, headers=headers, json=payload, timeout=120, verify=self.verify)
-        if r.status_code==401:
-            self._token=None
-            return self.chat(prompt, temperature=temperature)
-        import textwrap as _tw
-        (
-            r.raise_for_status()
-        ) if r.status_code < 400 else (_ := st.error("OAuth error: " + _tw.shorten(r.text, width=240, placeholder="...")) or r.raise_for_status())
-        return r.json()["choices"][0]["message"]["content"]
+        if stream: payload["stream"] = True
+        # Один повтор после 401: токен могли отозвать раньше expires_at
+        for attempt in range(2):
+            token = self._get_token()
+            headers = {"Authorization": f"Bearer {token}","Content-Type":"application/json"}
+            r = self.transport.post(url, headers=headers, json=payload, timeout=120, verify=self.verify, stream=stream)
+            if r.status_code != 401: break
+            r.close()
+            self._tokens.invalidate(token)
+        _raise_for_status(r)
+        return r
+    def chat(self, prompt: str, temperature: float=0.0) -> str:
+        body = self._post(prompt, temperature).json()
+        record_usage(body.get("usage"))
+        return body["choices"][0]["message"]["content"]
+    def stream_chat(self, prompt: str, temperature: float=0.0):
+        return iter_chat_deltas(self._post(prompt, temperature, stream=True))
+
+def _setting(key: str):
+    return os.environ.get(key) or st.secrets.get(key)
+
+def get_provider(name, model=None, transport=None, base=None, key=None):
+    if name == "openai":
+        return OpenAICompat(model=model, base=base, key=key, transport=transport)
+    if name == "router":
+        # Повторы заменяет переход к следующему бэкенду; модели и адреса — из ROUTER_BACKENDS
+        return router_from_env(lambda b, key: get_provider(b.provider, model=b.model, transport=Transport(max_retries=0),
+                                                           base=b.base, key=key), get=_setting)
+    return GigaChat(model=model, base=base, key=key, transport=transport)
 
-def get_provider(name, model=None):
-    return GigaChat(model=model)
+# ---------------- Кеширование между перезапусками скрипта ----------------
+# Streamlit выполняет файл целиком на каждое действие пользователя. Провайдер (с OAuth‑токеном
+# и пулом соединений) живёт на процесс и общий для всех сессий; списки файлов пересчитываются
+# только при изменении каталогов. Шаблоны и валидаторы схем кешируются по mtime в scripts/.
+@st.cache_resource(show_spinner=False)
+def cached_provider(name: str, model: str):
+    return get_provider(name, model=model)
+
+def _dirs_stamp(root: str) -> tuple:
+    """mtime всех подкаталогов: меняется при добавлении, удалении и переименовании файлов."""
+    return tuple((d, os.stat(d).st_mtime) for d, _, _ in os.walk(root))
+
+@st.cache_data(show_spinner=False)
+def _glob_sorted(pattern: str, stamp: tuple) -> list:
+    return sorted(glob.glob(pattern, recursive=True))
+
+def list_files(pattern: str, root: str) -> list:
+    return _glob_sorted(pattern, _dirs_stamp(root))
 
 # --------------- Sidebar: provider & params --------------
 st.sidebar.header("Провайдер и параметры")
-st.sidebar.text_input("Провайдер", value="GigaChat", disabled=True)
-model = st.sidebar.text_input("Модель", value="GigaChat-Pro", disabled=True)
+PROVIDERS = {"GigaChat": "gigachat", "OpenAI‑совместимый": "openai", "Роутер (резерв и хеджирование)": "router"}
+_names = list(PROVIDERS.values())
+provider_label = st.sidebar.selectbox("Провайдер", list(PROVIDERS),
+                                      index=_names.index(_setting("PROVIDER")) if _setting("PROVIDER") in _names else 0)
+provider_name = PROVIDERS[provider_label]
+if provider_name == "router":
+    model = ""
+    st.sidebar.caption(f"Бэкенды (ROUTER_BACKENDS): {_setting('ROUTER_BACKENDS') or 'не заданы'}")
+else:
+    model = st.sidebar.text_input("Модель", key=f"model_{provider_name}",
+                                  value=_setting("GIGACHAT_MODEL" if provider_name == "gigachat" else "OPENAI_MODEL")
+                                  or ("GigaChat-Pro" if provider_name == "gigachat" else "gpt-4o-mini"))
 temperature = st.sidebar.slider("Температура", 0.0, 1.2, 0.0, 0.1)
-p = GigaChat(model=model)
+stream_mode = st.sidebar.checkbox("Потоковый вывод", value=True, help="Показывать ответ по мере генерации")
+token_budget = st.sidebar.number_input("Бюджет промпта, токенов", min_value=0, max_value=200_000, value=0, step=500,
+                                       help="Оценка без токенизатора модели; пассажи сверх бюджета выпадают целиком. 0 — без ограничения")
+try:
+    p = cached_provider(provider_name, model)
+except ValueError as e:
+    st.sidebar.error(str(e))
+    st.stop()
+if isinstance(p, Router):
+    for b in p.status():
+        st.sidebar.caption(f"{'🟢' if b['state'] == 'closed' else '🟡' if b['state'] == 'half_open' else '🔴'} "
+                           f"{b['backend']} · {b['model']} · ok {b['ok']} / ошибок {b['errors']} · p95 {b['p95'] or '—'} с")
+response_cache = get_cache()
+no_cache = st.sidebar.checkbox("Не брать ответ из кеша", value=False,
+                               help="Кешируются только ответы при температуре 0")
+_cs = response_cache.stats()
+st.sidebar.caption(f"Кеш ответов: {_cs['entries']} записей · попаданий {_cs['hits']} / промахов {_cs['misses']}")
+with st.sidebar.expander("Метрики", expanded=False):
+    _rows = metrics.snapshot()
+    if not _rows:
+        st.caption("Прогонов в этой сессии сервера ещё не было")
+    else:
+        st.table([{"шаблон": r["template"], "запросов": r["requests"], "ошибок": r["errors"],
+                  "кеш": r["cache_hits"], "повторов": r["retries"],
+                  "токенов": r["prompt_tokens"] + r["completion_tokens"],
+                  "ср. с": r["avg_seconds"], "макс. с": r["max_seconds"]} for r in _rows])
+        download_bytes("metrics.jsonl", lambda: "".join(metrics.iter_jsonl()).encode("utf-8"), "Скачать JSONL")
+        download_bytes("metrics.prom", lambda: metrics.to_prometheus().encode("utf-8"), "Скачать для Prometheus")
 
 st.sidebar.markdown("---")
 st.sidebar.subheader("JSON Schema (опционально)")
-import glob as _glob
-schemas = sorted(_glob.glob("banking/schemas/*.json"))
+schemas = list_files("banking/schemas/*.json", "banking/schemas")
 schema_choice = st.sidebar.selectbox("Схема из репо", ["(нет)"]+schemas, index=0)
 schema_upload = st.sidebar.file_uploader("Или загрузить .json", type=["json"])
 schema_obj = None
@@ -129,7 +238,7 @@ tab_run, tab_builder, tab_history, tab_custom = st.tabs(["▶️ Запуск",
 # ---------------- RUN TAB ----------------
 with tab_run:
     st.subheader("Шаблон промпта")
-    all_prompts = sorted(_glob.glob("prompts/**/*.md", recursive=True))
+    all_prompts = list(list_files("prompts/**/*.md", "prompts"))
     # include custom prompts
     if st.session_state.custom_prompts:
         for name in st.session_state.custom_prompts.keys():
@@ -140,17 +249,13 @@ with tab_run:
     # select source text
     if prompt_file.startswith("custom://"):
         pname = prompt_file.replace("custom://","")
-        prompt_text = st.session_state.custom_prompts.get(pname,"")
+        tpl = compile_text(st.session_state.custom_prompts.get(pname,""))
     else:
-        prompt_text = ""
-        if prompt_file:
-            with open(prompt_file, "r", encoding="utf-8") as f:
-                prompt_text = f.read()
+        tpl = load_template(prompt_file) if prompt_file else compile_text("")
+    prompt_text = tpl.text
 
     # detect variables
-    def find_vars(txt: str):
-        return sorted(set(m.group(1) for m in re.finditer(r"(?<!\{)\{([a-zA-Z_][a-zA-Z0-9_]*)\}(?!\})", txt)))
-    vars_found = find_vars(prompt_text)
+    vars_found = sorted(tpl.variables)
 
     with st.expander("Показать шаблон", expanded=False):
         st.code(prompt_text, language="markdown")
@@ -161,62 +266,200 @@ with tab_run:
     for i, var in enumerate(vars_found):
         with cols[i % len(cols)]:
             values[var] = st.text_area(var, height=80, value="")
+    hits = None
+    if "passages" in vars_found and not values["passages"].strip():
+        # {passages} не вставлен вручную — берём top‑k из индекса (run.py index build)
+        query_var = "question" if "question" in values else next((v for v in vars_found if v != "passages"), None)
+        index = open_index()
+        if index is None:
+            st.caption("Индекс пассажей не построен: `python scripts/run.py index build <каталог>`")
+        elif query_var and values[query_var].strip():
+            hits = index.search(values[query_var], k=8 if token_budget else 4)  # с бюджетом — больше кандидатов на упаковку
+    empty_vars = [v for v in vars_found if not values[v].strip() and not (v == "passages" and hits)]
+    if empty_vars:
+        st.caption("Не заполнены: " + ", ".join(empty_vars))
 
-    def render_vars(text: str, vars: dict) -> str:
-        for k,v in vars.items():
-            text = text.replace("{"+k+"}", str(v))
-        return text
-
-    compiled = render_vars(prompt_text, values) if prompt_text else ""
+    bp = compile_prompt(tpl, values, int(token_budget), hits) if prompt_text else None
+    compiled = bp.text if bp else ""
+    if hits is not None:
+        scores = {pid: score for pid, score, _ in hits}
+        st.caption("Пассажи из индекса: " + (", ".join(f"{pid} ({scores[pid]})" for pid in bp.passage_ids) or "ничего не найдено"))
     st.subheader("Скомпилированный промпт")
     st.code(compiled[:5000] if compiled else "", language="markdown")
+    if bp:
+        st.caption("Промпт: " + bp.summary())
+        if bp.over_budget:
+            st.error("Промпт не помещается в бюджет даже без пассажей — сократите переменные или увеличьте бюджет")
 
     run = st.button("Запустить", type="primary")
-    if run and compiled:
+    if run and compiled and not bp.over_budget:
         try:
-            with st.spinner("Запрос к модели..."):
-                out = p.chat(compiled, temperature=temperature)
-            st.success("Готово")
-            st.subheader("Ответ")
-            st.code(out, language="json" if out.strip().startswith("{") else "markdown")
-
-            valid_status = None
-            if (schema_choice != "(нет)" or schema_obj is not None):
-                if not HAS_JSONSCHEMA:
-                    st.info("Модуль jsonschema не установлен в окружении.")
+            with trace(template=prompt_file, model=p.model, provider=provider_name) as tr:
+                use_schema = schema_choice != "(нет)" or schema_obj is not None
+                validator = None
+                if use_schema and HAS_JSONSCHEMA:
+                    validator = compile_validator(schema_obj) if schema_obj is not None else load_validator(schema_choice)
+                timer = StreamTimer()
+                aborted = None
+                if stream_mode:
+                    st.subheader("Ответ")
+                    live = st.empty()
+                    chunks, cache_hit = response_cache.stream_chat(p, compiled, temperature=temperature, bypass=no_cache)
+                    iv = IncrementalValidator(validator) if validator is not None else None
+                    parts = []
+                    stream = timer.wrap(chunks)
+                    for piece in stream:
+                        parts.append(piece)
+                        live.markdown("".join(parts) + " ▌")
+                        if iv and iv.feed(piece):
+                            aborted = iv.error
+                            stream.close()  # обрываем генерацию: ответ уже нарушил контракт
+                            break
+                    out = "".join(parts)
+                    live.code(out, language="json" if out.strip().startswith("{") else "markdown")
+                    if aborted:
+                        st.error(f"Генерация остановлена — нарушен контракт: {aborted}")
+                    else:
+                        st.success("Готово (из кеша)" if cache_hit else "Готово")
                 else:
-                    try:
-                        s = out[out.find("{"): out.rfind("}")+1]
-                        obj = json.loads(s)
-                        if schema_obj is None:
-                            with open(schema_choice, "r", encoding="utf-8") as f:
-                                schema_obj_local = json.load(f)
-                        else:
-                            schema_obj_local = schema_obj
-                        jsonschema.validate(obj, schema_obj_local)
-                        st.success("JSON валиден по схеме ✅")
-                        valid_status = True
-                    except Exception as e:
-                        st.error(f"Ошибка валидации JSON: {e}")
+                    with st.spinner("Запрос к модели..."):
+                        out, cache_hit = response_cache.chat(p, compiled, temperature=temperature, bypass=no_cache)
+                    timer.ttft = timer.total = time.perf_counter() - timer.started
+                    st.success("Готово (из кеша)" if cache_hit else "Готово")
+                    st.subheader("Ответ")
+                    st.code(out, language="json" if out.strip().startswith("{") else "markdown")
+                timing = timer.as_dict()
+                st.caption(f"Время до первого токена: {timing['ttft']} с · всего: {timing['total']} с")
+
+                valid_status = None
+                if use_schema:
+                    if not HAS_JSONSCHEMA:
+                        st.info("Модуль jsonschema не установлен в окружении.")
+                    elif aborted:
                         valid_status = False
+                    else:
+                        _, err = validate_output(out, validator)
+                        if err is None:
+                            st.success("JSON валиден по схеме ✅")
+                            valid_status = True
+                        else:
+                            st.error(f"Ошибка валидации JSON: {err}")
+                            valid_status = False
+
+            spans = tr.as_dict()["spans"]
+            st.caption("Фазы: " + " · ".join(f"{k} {v:.3f} с" for k, v in sorted(spans.items(), key=lambda kv: -kv[1])))
 
             # push to history
             add_history({
                 "ts": now_iso(),
-                "provider": 'GigaChat',
-                "model": model,
+                "provider": provider_label,
+                "model": p.model,
                 "temperature": temperature,
                 "template": prompt_file,
                 "variables": values,
                 "compiled": compiled,
                 "response": out,
                 "schema": schema_name,
-                "valid": valid_status
+                "valid": valid_status,
+                "cached": cache_hit,
+                "ttft": timing["ttft"],
+                "elapsed": timing["total"],
+                "timing": tr.as_dict(),
+                **bp.as_dict()
             })
             st.session_state.last_response = out
         except Exception as e:
             st.error(f"Ошибка при запросе: {e}")
 
+    with st.expander("Self‑consistency: несколько выборок и голосование", expanded=False):
+        sc1, sc2, sc3 = st.columns(3)
+        with sc1:
+            sc_n = st.number_input("Выборок", min_value=2, max_value=20, value=5, step=1)
+        with sc2:
+            sc_temp = st.slider("Температура выборок", 0.1, 1.2, 0.7, 0.1)
+        with sc3:
+            sc_quorum = st.number_input("Кворум", min_value=1, max_value=int(sc_n), value=int(sc_n)//2 + 1, step=1,
+                                        help="Оставшиеся выборки отменяются, когда ответ набрал столько голосов")
+        if st.button("Запустить выборки") and compiled:
+            try:
+                sc_validator = None
+                if (schema_choice != "(нет)" or schema_obj is not None) and HAS_JSONSCHEMA:
+                    sc_validator = compile_validator(schema_obj) if schema_obj is not None else load_validator(schema_choice)
+                t0 = time.perf_counter()
+                with st.spinner(f"{int(sc_n)} параллельных выборок..."), \
+                        trace(template=prompt_file, model=p.model, provider=provider_name) as sc_tr:
+                    res = self_consistency(provider_sampler(p, compiled, sc_temp), int(sc_n),
+                                           make_key_fn(sc_validator), quorum=int(sc_quorum))
+                    if res.answer is None: sc_tr.error = "no_answer"
+                sc_elapsed = round(time.perf_counter() - t0, 3)
+                if res.answer is None:
+                    st.error("Ни одного пригодного ответа" + (f": {res.errors[0]}" if res.errors else ""))
+                else:
+                    st.metric("Согласие", f"{res.agreement:.0%}", help=f"{res.votes} из {res.completed} завершённых выборок")
+                    st.caption(f"Запрошено {res.requested} · невалидных {res.invalid} · ошибок {len(res.errors)}"
+                               + (" · остановлено по кворуму" if res.stopped_early else "") + f" · {sc_elapsed} с")
+                    st.code(res.answer, language="json" if res.answer.strip().startswith("{") else "markdown")
+                    st.table([{"голосов": c, "вариант": repr(k)} for k, c in res.tally.most_common()])
+                    add_history({
+                        "ts": now_iso(),
+                        "provider": provider_label,
+                        "model": p.model,
+                        "temperature": sc_temp,
+                        "template": prompt_file,
+                        "variables": values,
+                        "compiled": compiled,
+                        "response": res.answer,
+                        "schema": schema_name,
+                        "valid": validate_output(res.answer, sc_validator)[1] is None if sc_validator is not None else None,
+                        "self_consistency": {k: v for k, v in res.as_dict().items() if k != "answer"},
+                        "elapsed": sc_elapsed,
+                        "timing": sc_tr.as_dict()
+                    })
+            except Exception as e:
+                st.error(f"Ошибка при запросе: {e}")
+
+    if "FINAL_ANSWER" in prompt_text:
+        with st.expander("ReAct: выполнить цикл с инструментами SEARCH и CALC", expanded=True):
+            rc1, rc2 = st.columns(2)
+            with rc1:
+                react_steps = st.number_input("Предел шагов", min_value=1, max_value=20, value=6, step=1)
+            with rc2:
+                react_tokens = st.number_input("Предел токенов ответа", min_value=100, max_value=20000, value=2000, step=100)
+            if st.button("Выполнить ReAct") and compiled:
+                try:
+                    live = st.empty()
+                    parts = []
+                    def _show(piece: str):
+                        parts.append(piece)
+                        live.code("".join(parts) + " ▌", language="markdown")
+                    t0 = time.perf_counter()
+                    res = run_react(p, compiled, tools=default_tools(), max_steps=int(react_steps),
+                                    max_tokens=int(react_tokens), temperature=temperature, on_text=_show)
+                    react_elapsed = round(time.perf_counter() - t0, 3)
+                    live.code(res.transcript, language="markdown")
+                    if res.answer is None:
+                        st.error(f"Итоговый ответ не получен: {res.stop_reason}")
+                    else:
+                        st.success(res.answer)
+                    st.caption(f"Шагов {len(res.steps)} · из кеша {sum(1 for s in res.steps if s['cached'])} · "
+                               f"токенов ≈ {res.completion_tokens} · остановка: {res.stop_reason} · {react_elapsed} с")
+                    add_history({
+                        "ts": now_iso(),
+                        "provider": provider_label,
+                        "model": p.model,
+                        "temperature": temperature,
+                        "template": prompt_file,
+                        "variables": values,
+                        "compiled": compiled,
+                        "response": res.transcript,
+                        "schema": None,
+                        "valid": None,
+                        "react": {k: v for k, v in res.as_dict().items() if k != "steps"} | {"steps": len(res.steps)},
+                        "elapsed": react_elapsed
+                    })
+                except Exception as e:
+                    st.error(f"Ошибка при запросе: {e}")
+
 # ---------------- BUILDER TAB ----------------
 with tab_builder:
     st.subheader("CoT/Step‑back Builder — конструктор промптов")
@@ -253,33 +496,77 @@ with tab_builder:
 
 # ---------------- HISTORY TAB ----------------
 with tab_history:
-    st.subheader("История сессии")
-    if not st.session_state.history:
-        st.info("История пуста — запустите хотя бы один промпт.")
-    else:
-        for i, item in enumerate(st.session_state.history):
-            with st.expander(f"{item['ts']} · {item['provider']}:{item['model']} · {item['template']} (val={item['valid']})", expanded=False):
-                st.markdown("**Vars:** " + json.dumps(item['variables'], ensure_ascii=False))
+    st.subheader("История прогонов")
+    history = get_history()
+    hf1, hf2, hf3, hf4 = st.columns(4)
+    with hf1:
+        h_template = st.selectbox("Шаблон", ["(все)"] + history.distinct("template"))
+    with hf2:
+        h_schema = st.selectbox("Схема", ["(все)"] + history.distinct("schema"))
+    with hf3:
+        h_valid = st.selectbox("Валидность", ["(все)", "валидные", "невалидные", "без проверки"])
+    with hf4:
+        h_size = st.selectbox("На странице", [10, 20, 50, 100], index=1)
+    filters = {"template": None if h_template == "(все)" else h_template,
+               "schema": None if h_schema == "(все)" else h_schema,
+               "valid": {"валидные": True, "невалидные": False, "без проверки": "unknown"}.get(h_valid)}
+    # При смене фильтров — снова с первой страницы
+    if st.session_state.get("history_filters") != filters:
+        st.session_state.history_filters = filters
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+    rows = history.page(before=cursors[-1], limit=h_size, **filters)
+    total = history.count(**filters)
+    if not rows:
+        st.info("История пуста — запустите хотя бы один промпт." if not total else "Больше записей нет.")
+    for item in rows:
+        with st.expander(f"{item['ts']} · {item['source']} · {item['provider']}:{item['model']} · "
+                         f"{item['template']} (val={item['valid']})", expanded=False):
+            st.caption(f"id {item['id']} · из кеша: {item['cached']} · ttft {item['ttft']} с · всего {item['elapsed']} с")
+            # Промпт и ответ читаются из базы, только когда их попросили показать
+            if st.checkbox("Показать промпт и ответ", key=f"history_show_{item['id']}"):
+                payload = history.payload(item["id"])
+                st.markdown("**Vars:** " + json.dumps(payload['variables'], ensure_ascii=False))
                 st.markdown("**Prompt:**")
-                st.code(item['compiled'], language="markdown")
+                st.code(payload['compiled'] or "", language="markdown")
                 st.markdown("**Response:**")
-                st.code(item['response'], language="json" if str(item['response']).strip().startswith("{") else "markdown")
-        # Export/Import
-        st.markdown("---")
-        export = json.dumps(st.session_state.history, ensure_ascii=False, indent=2).encode("utf-8")
-        download_bytes("history.json", export, "Скачать историю (JSON)")
-        imported = st.file_uploader("Импорт истории (JSON)", type=["json"])
-        if imported is not None:
-            try:
-                data = json.loads(imported.read().decode("utf-8"))
-                if isinstance(data, list):
-                    st.session_state.history = data + st.session_state.history
-                    st.success("История импортирована")
-            except Exception as e:
-                st.error(f"Импорт не удался: {e}")
+                st.code(payload['response'] or "", language="json" if str(payload['response']).strip().startswith("{") else "markdown")
+    hp1, hp2, hp3 = st.columns([1, 1, 3])
+    with hp1:
+        if st.button("← Новее", disabled=len(cursors) == 1):
+            cursors.pop()
+            st.rerun()
+    with hp2:
+        if st.button("Старее →", disabled=len(rows) < h_size):
+            cursors.append(rows[-1]["id"])
+            st.rerun()
+    with hp3:
+        st.caption(f"Страница {len(cursors)} · записей по фильтру: {total}")
+
+    # Export/Import
+    st.markdown("---")
+    def _export():
+        # Построчно во временный файл: история целиком в памяти не собирается
+        buf = tempfile.SpooledTemporaryFile(max_size=8 << 20)
+        for line in history.iter_export(**filters):
+            buf.write(line.encode("utf-8"))
+        buf.seek(0)
+        return buf
+    download_bytes("history.jsonl", _export, "Скачать историю по фильтру (JSONL)")
+    imported = st.file_uploader("Импорт истории (JSONL или JSON)", type=["jsonl", "json"])
+    # Виджет хранит файл между перезапусками — импортируем каждый файл один раз
+    if imported is not None and st.session_state.get("history_imported") != imported.file_id:
+        try:
+            n = history.import_stream(io.TextIOWrapper(imported, encoding="utf-8"))
+            st.session_state.history_imported = imported.file_id
+            st.success(f"История импортирована: {n} записей")
+        except Exception as e:
+            st.error(f"Импорт не удался: {e}")
+    if st.checkbox("Разрешить очистку истории", help="История общая для всех пользователей и CLI"):
         if st.button("Очистить историю"):
-            st.session_state.history.clear()
-            st.experimental_rerun()
+            history.clear()
+            st.session_state.history_cursors = [None]
+            st.rerun()
 
 # ---------------- CUSTOM TEMPLATES TAB ----------------
 with tab_custom:
@@ -0,0 +1,20 @@
+import os, sys, tempfile
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+# общие кеши — во временный каталог, чтобы тесты не трогали .cache репозитория
+_tmp = tempfile.mkdtemp(prefix="pe-guide-tests-")
+os.environ.setdefault("RESPONSE_CACHE_PATH", os.path.join(_tmp, "responses.sqlite"))
+os.environ.setdefault("HISTORY_DB_PATH", os.path.join(_tmp, "history.sqlite"))
+os.environ.setdefault("RETRIEVAL_INDEX_PATH", os.path.join(_tmp, "index"))
+
+@pytest.fixture
+def mock_openai(monkeypatch):
+    """Локальный OpenAI‑совместимый сервер (scripts/mock_server.py) как PROVIDER=openai."""
+    from mock_server import MockConfig, start_server
+    server, base = start_server(MockConfig(latency="fixed:1", token_delay_ms=0))
+    monkeypatch.setenv("PROVIDER", "openai")
+    monkeypatch.setenv("OPENAI_API_BASE", base + "/v1")
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    yield base
+    server.shutdown()
@@ -0,0 +1,42 @@
+import json, os
+import pytest
+from typer.testing import CliRunner
+import run
+from mock_server import MockConfig, start_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE = os.path.join(ROOT, "prompts", "banking", "complaint_triage.md")
+
+@pytest.fixture
+def batch(tmp_path, monkeypatch):
+    server, base = start_server(MockConfig(latency="fixed:1", token_delay_ms=0))
+    monkeypatch.setenv("PROVIDER", "openai")
+    monkeypatch.setenv("OPENAI_API_BASE", base + "/v1")
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    src, out = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    src.write_text("".join(json.dumps({"id": f"c{i}", "complaint": f"жалоба {i}"}, ensure_ascii=False) + "\n"
+                           for i in range(3)), encoding="utf-8")
+    def invoke():
+        res = CliRunner().invoke(run.app, ["batch", TEMPLATE, "-i", str(src), "-o", str(out), "--no-cache", "-c", "2"])
+        rows = [json.loads(line) for line in out.read_text(encoding="utf-8").splitlines()] if out.exists() else []
+        return res, rows
+    yield invoke
+    server.shutdown()
+
+def test_history_failure_does_not_fail_rows(batch, monkeypatch):
+    def broken(*args, **kwargs):
+        raise OSError("database is locked")
+    monkeypatch.setattr(run, "log_run", broken)
+    res, rows = batch()
+    assert res.exit_code == 0, res.output
+    assert len(rows) == 3
+    assert all(r["ok"] and r["history_error"] == "OSError: database is locked" for r in rows)
+
+def test_prompt_assembly_failure_is_a_row_error(batch, monkeypatch):
+    def broken(*args, **kwargs):
+        raise ValueError("индекс повреждён")
+    monkeypatch.setattr(run, "compile_prompt", broken)
+    res, rows = batch()
+    assert res.exit_code == 0, res.output
+    assert len(rows) == 3
+    assert all(not r["ok"] and r["error"] == "ValueError: индекс повреждён" for r in rows)
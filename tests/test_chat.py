@@ -0,0 +1,15 @@
+import os
+import pytest
+from typer.testing import CliRunner
+import run
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_citations_survive_console_output(mock_openai, tmp_path, stream):
+    tpl = tmp_path / "q.md"
+    tpl.write_text("Ответь на вопрос: {question}", encoding="utf-8")
+    args = ["chat", str(tpl), "--var", "question=тарифы", "--no-cache"] + (["--stream"] if stream else [])
+    res = CliRunner().invoke(run.app, args)
+    assert res.exit_code == 0, res.output
+    assert "Источник: [doc-1]." in res.output
@@ -0,0 +1,21 @@
+import sys, threading
+from instrumentation import Trace
+
+def test_concurrent_updates_are_not_lost():
+    # частое переключение потоков — как у попыток маршрутизатора, пишущих в одну трассу
+    old = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    tr = Trace(template="t")
+    def work():
+        for _ in range(20000):
+            tr.incr("retries")
+            tr.add_span("http", 0.001)
+    try:
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+    finally:
+        sys.setswitchinterval(old)
+    d = tr.as_dict()
+    assert d["retries"] == 160000
+    assert abs(d["spans"]["http"] - 160.0) < 1e-6
@@ -0,0 +1,87 @@
+import json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+import llm_transport
+from llm_transport import RetryAfterTooLong, Transport, _iter_body, iter_chat_deltas
+
+def sse(pieces):
+    events = [f"data: {json.dumps({'choices': [{'delta': {'content': p}}]}, ensure_ascii=False)}\r\n\r\n"
+              for p in pieces]
+    return [e.encode("utf-8") for e in events] + [b"data: [DONE]\n\n"]
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"  # без chunked: тело до закрытия соединения или по Content-Length
+    events = sse(["При", "вет", ", мир"])
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        if self.path == "/length":
+            body = b"".join(self.events)
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        for i, event in enumerate(self.events):
+            self.wfile.write(event)
+            self.wfile.flush()
+            if self.path == "/slow" and i == 0:
+                time.sleep(0.5)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture(scope="module")
+def base():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+@pytest.mark.parametrize("path", ["/close", "/length"])
+def test_deltas_without_chunked_encoding(base, path):
+    assert list(iter_chat_deltas(requests.get(base + path, stream=True))) == ["При", "вет", ", мир"]
+
+def test_first_event_is_not_held_until_body_ends(base):
+    t0 = time.perf_counter()
+    deltas = iter_chat_deltas(requests.get(base + "/slow", stream=True))
+    assert next(deltas) == "При"
+    assert time.perf_counter() - t0 < 0.4
+    assert list(deltas) == ["вет", ", мир"]
+
+def test_body_is_read_in_blocks_not_bytes(base):
+    r = requests.get(base + "/length", stream=True)
+    size = int(r.headers["Content-Length"])
+    assert len(list(_iter_body(r))) < size // 10
+
+def response(status, retry_after=None):
+    r = requests.Response()
+    r.status_code, r._content, r._content_consumed = status, b"{}", True
+    if retry_after is not None: r.headers["Retry-After"] = retry_after
+    return r
+
+class FakeSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def post(self, url, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    out = []
+    monkeypatch.setattr(llm_transport.time, "sleep", out.append)
+    return out
+
+def test_retry_after_is_honoured_exactly(sleeps):
+    session = FakeSession(response(503, "15"), response(200))
+    assert Transport(backoff_cap=20.0, session=session).post("http://x").status_code == 200
+    assert sleeps == [15.0]
+
+def test_retry_after_beyond_cap_raises_without_retry(sleeps):
+    session = FakeSession(response(429, "60"), response(200))
+    with pytest.raises(RetryAfterTooLong) as e:
+        Transport(backoff_cap=20.0, session=session).post("http://x")
+    assert e.value.retry_after == 60.0 and e.value.response.status_code == 429
+    assert session.calls == 1 and sleeps == []
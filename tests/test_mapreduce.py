@@ -0,0 +1,79 @@
+import json, random, threading, time
+import pytest
+from mapreduce import iter_chunks, run_extract
+from prompt_templates import compile_text
+
+pytest.importorskip("jsonschema")
+
+SCHEMA = {"type": "object", "properties": {"amounts": {"type": "array", "items": {"type": "string"}}}}
+
+def write_doc(tmp_path, paragraphs=60, newline="\n"):
+    path = tmp_path / "doc.txt"
+    text = "\n\n".join(f"Абзац {i}. Сумма {i * 100} ₽ списана со счёта." for i in range(paragraphs))
+    path.write_bytes(text.replace("\n", newline).encode("utf-8"))
+    return str(path)
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_chunk_ends_cover_file(tmp_path, newline):
+    path = write_doc(tmp_path, newline=newline)
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        chunks = list(iter_chunks(f, max_chars=400, overlap=60))
+    assert len(chunks) > 3
+    assert [c.end_byte for c in chunks] == sorted(c.end_byte for c in chunks)
+    assert chunks[-1].end_byte == len(open(path, "rb").read())
+    assert all(c.text.endswith(newline * 2) for c in chunks[:-1])  # рез по абзацам и в CRLF
+
+def test_progress_reaches_end_on_crlf_file(tmp_path):
+    path = write_doc(tmp_path, newline="\r\n")
+    seen = []
+    run_extract(lambda prompt: json.dumps({"amounts": []}), compile_text("Суммы из текста: {text}"), path, "text",
+                SCHEMA, checkpoint=str(tmp_path / "ckpt.jsonl"), max_chars=400, overlap=60,
+                on_progress=lambda stats, frac: seen.append(frac))
+    assert seen[-1] == 1.0
+
+def test_progress_is_monotonic_with_out_of_order_completion(tmp_path):
+    path = write_doc(tmp_path, paragraphs=3000)  # больше блока чтения — чанки из разных блоков
+    rnd, lock = random.Random(7), threading.Lock()
+    def call(prompt):
+        with lock:
+            delay = rnd.random() * 0.02
+        time.sleep(delay)
+        return json.dumps({"amounts": []})
+    seen = []
+    run_extract(call, compile_text("Суммы из текста: {text}"), path, "text", SCHEMA,
+                checkpoint=str(tmp_path / "ckpt.jsonl"), concurrency=4, max_chars=2000, overlap=200,
+                on_progress=lambda stats, frac: seen.append(frac))
+    assert seen == sorted(seen)
+    assert seen[-1] == 1.0
+
+def test_checkpoint_is_reused_until_template_text_changes(tmp_path):
+    path, ckpt = write_doc(tmp_path), str(tmp_path / "ckpt.jsonl")
+    calls = []
+    def call(prompt):
+        calls.append(prompt)
+        return json.dumps({"amounts": []})
+    def run(text):
+        return run_extract(call, compile_text(text), path, "text", SCHEMA, checkpoint=ckpt,
+                           template_id="prompts/extract.md", max_chars=400, overlap=60).stats
+    first = run("Суммы из текста: {text}")
+    assert run("Суммы из текста: {text}")["skipped"] == first["chunks"]
+    calls.clear()
+    assert run("Все суммы в рублях из текста: {text}")["skipped"] == 0
+    assert len(calls) == first["chunks"]
+
+def test_overlap_does_not_double_count_votes():
+    from mapreduce import Reducer
+    schema = {"type": "object", "properties": {"inn": {"type": "string"}}}
+    r = Reducer(schema)
+    # ИНН на стыке чанков 3 и 4 виден обоим — один голос, как и у ИНН из тела чанка 1
+    for chunk, inn in [(3, "7707083893"), (4, "7707083893"), (1, "5001012345")]:
+        r.add(chunk, {"inn": inn})
+    assert r.result() == {"inn": "5001012345"}
+    assert [o["votes"] for o in r.conflicts()["inn"]] == [1, 1]
+    r.add(5, {"inn": "7707083893"})  # серия 3‑4‑5: два голоса
+    assert r.result() == {"inn": "7707083893"}
+    # без перекрытия каждый чанк — отдельный голос; при равенстве — более ранний чанк
+    plain = Reducer(schema, overlapping=False)
+    for chunk, inn in [(3, "7707083893"), (4, "7707083893"), (5, "5001012345")]:
+        plain.add(chunk, {"inn": inn})
+    assert plain.result() == {"inn": "7707083893"}
@@ -0,0 +1,46 @@
+import pytest
+from react import find_action, run_react, safe_calc
+
+class ScriptedProvider:
+    """Потоковый провайдер: по ответу на шаг, фрагментами по несколько символов."""
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.prompts = []
+
+    def stream_chat(self, prompt, temperature=0.0):
+        self.prompts.append(prompt)
+        text = self.replies[len(self.prompts) - 1]
+        return (text[i:i + 5] for i in range(0, len(text), 5))
+
+def test_apostrophe_inside_args_closes_action():
+    assert find_action("ACTION: SEARCH(Sberbank's card fee)\nOBSERVATION: 999") == \
+        ("SEARCH", "Sberbank's card fee", 35)
+
+def test_quoted_args_keep_inner_parens_and_apostrophes():
+    assert find_action("ACTION: SEARCH('Sberbank's fee (card)')")[1] == "Sberbank's fee (card)"
+    assert find_action('ACTION(SEARCH, "a (b)")')[1] == "a (b)"
+
+def test_only_matching_outer_quotes_are_stripped():
+    assert find_action("ACTION: SEARCH(тариф «Премиум»)")[1] == "тариф «Премиум»"
+    assert find_action("ACTION: SEARCH(«Премиум»)")[1] == "Премиум"
+
+def test_apostrophe_action_runs_tool_instead_of_invented_observation():
+    provider = ScriptedProvider([
+        "THOUGHT: ищу.\nACTION: SEARCH(Sberbank's card fee)\nOBSERVATION: 999\nFINAL_ANSWER: 999",
+        "FINAL_ANSWER: 500 ₽",
+    ])
+    seen = []
+    def search(query):
+        seen.append(query)
+        return "[tariffs.md#1] перевыпуск — 500 ₽"
+    res = run_react(provider, "Q", tools={"SEARCH": search})
+    assert seen == ["Sberbank's card fee"]
+    assert [s["action"] for s in res.steps] == ["SEARCH"]
+    assert "999" not in res.transcript
+    assert (res.stop_reason, res.answer) == ("final_answer", "500 ₽")
+
+@pytest.mark.parametrize("expr, expected", [
+    ("17 % 5", "2"), ("7 % (3)", "1"), ("1000 * 5%", "50"), ("10%", "0.1"), ("1 500 * 3", "4500"),
+])
+def test_safe_calc_percent_and_modulo(expr, expected):
+    assert safe_calc(expr) == expected
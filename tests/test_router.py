@@ -0,0 +1,28 @@
+import pytest
+import run
+from mock_server import MockConfig, start_server
+from router import BackendSpec, Router, parse_backends
+
+def test_parse_backends_with_endpoints():
+    assert parse_backends("gigachat, openai:gpt-4o-mini@https://a.example/v1/ ,openai@http://10.0.0.5:8000/v1") == [
+        BackendSpec("gigachat"),
+        BackendSpec("openai", "gpt-4o-mini", "https://a.example/v1"),
+        BackendSpec("openai", None, "http://10.0.0.5:8000/v1"),
+    ]
+
+def test_fallback_between_two_openai_compatible_endpoints(monkeypatch):
+    down, down_base = start_server(MockConfig(latency="fixed:1", error_rate=1.0))
+    up, up_base = start_server(MockConfig(latency="fixed:1", token_delay_ms=0))
+    try:
+        monkeypatch.delenv("OPENAI_API_BASE", raising=False)
+        monkeypatch.setenv("OPENAI_API_KEY", "shared")
+        monkeypatch.setenv("ROUTER_API_KEY_2", "second")
+        monkeypatch.setenv("ROUTER_BACKENDS", f"openai:m1@{down_base}/v1,openai:m2@{up_base}/v1")
+        p = run.get_provider("router")
+        assert isinstance(p, Router)
+        assert [(b.base, b.key, b.model) for b in p.backends] == [
+            (down_base + "/v1", "shared", "m1"), (up_base + "/v1", "second", "m2")]
+        assert "Источник" in p.chat("вопрос")
+        assert [s["errors"] for s in p.status()] == [1, 0]
+    finally:
+        down.shutdown(); up.shutdown()
@@ -0,0 +1,76 @@
+import os
+import pytest
+from schema_validation import IncrementalValidator, load_validator, validate_output
+
+pytest.importorskip("jsonschema")
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "banking", "schemas", "complaint_schema.json")
+VALID = '{"category": "card", "severity": "high", "summary": "Списали дважды", "actions": ["вернуть"]}'
+
+def stream(text, size=3):
+    """(ошибка feed, ошибка finish, сколько символов прочитано до остановки)."""
+    iv = IncrementalValidator(load_validator(SCHEMA))
+    for i in range(0, len(text), size):
+        err = iv.feed(text[i:i + size])
+        if err:
+            return err, iv.finish(), i + size
+    return None, iv.finish(), len(text)
+
+@pytest.mark.parametrize("text, valid", [
+    (VALID, True),
+    ("Ответ:\n```json\n" + VALID + "\n```", True),
+    ("Поля {category} и {severity} ниже: " + VALID, True),
+    ('{"category": "loan", "severity": "high", "summary": "x"}', False),
+    ('{"category": "card", "severity": "high"}', False),
+    ('{"category": "card", "severity": "high", "summary": "x", "extra": 1}', False),
+    ('Пример: {"поле": "значение"} а теперь ответ ' + VALID, True),
+    ('Схема ответа: {"type": "object", "required": ["category"]}\nОтвет: ' + VALID, True),
+    ('Пример: {"category": "x"} а теперь ответ ' + VALID, False),
+    ('{"note": "без полей схемы"}', False),
+    (VALID + " и ещё " + '{"category": "x"}', True),
+    ("без JSON", False),
+    ('{"category": "card", "summary": "оборв', False),
+])
+def test_stream_and_full_validation_agree(text, valid):
+    _, full_err = validate_output(text, load_validator(SCHEMA))
+    _, stream_err, _ = stream(text)
+    assert (full_err is None) == valid
+    assert (stream_err is None) == valid
+
+def test_enum_violation_aborts_by_prefix():
+    text = '{"category": "loan_overdue", "severity": "high", "summary": "' + "x" * 500 + '"}'
+    err, _, read = stream(text)
+    assert err.startswith("category:")
+    assert read < 30
+
+def test_first_object_error_is_reported():
+    text = 'Пример: {"category": "x"} а теперь ответ ' + VALID
+    _, full_err = validate_output(text, load_validator(SCHEMA))
+    stream_err, _, _ = stream(text)
+    assert full_err and stream_err and "category" in stream_err
+
+def test_braces_inside_strings_do_not_end_object():
+    text = '{"category": "card", "severity": "low", "summary": "скобки } и { в тексте"}'
+    assert stream(text) == (None, None, len(text))
+    assert validate_output(text, load_validator(SCHEMA))[1] is None
+
+def test_truncated_object():
+    assert stream('{"category": "card", "summary": "оборв')[1] == "JSON оборван"
+    assert stream("только текст")[1] == "JSON не найден в ответе"
+
+def test_unrelated_object_errors_do_not_abort_stream():
+    # у схемы additionalProperties: false — лишнее поле примера не должно обрывать генерацию
+    text = 'Пример: {"foo": 1, "bar": {"category": "x"}} ответ: ' + VALID
+    assert stream(text) == (None, None, len(text))
+
+def test_pending_error_counts_once_schema_field_appears():
+    err, _, _ = stream('{"foo": 1, "category": "card", "severity": "low", "summary": "x"}')
+    assert err == "лишнее поле 'foo'"
+
+def test_only_unrelated_object_with_open_schema_is_valid():
+    from schema_validation import compile_validator
+    v = compile_validator({"type": "object", "properties": {"inn": {"type": "string"}}})
+    iv = IncrementalValidator(v)
+    assert iv.feed("Ничего не нашёл: {}") is None
+    assert iv.finish() is None
+    assert validate_output("Ничего не нашёл: {}", v) == ({}, None)
@@ -0,0 +1,21 @@
+import os
+from typer.testing import CliRunner
+import run
+from history_store import get_history
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE = os.path.join(ROOT, "prompts", "banking", "complaint_triage.md")
+SCHEMA = os.path.join(ROOT, "banking", "schemas", "complaint_schema.json")
+
+def last_run(source):
+    return get_history().page(limit=1, source=source)[0]
+
+def test_consistency_run_is_logged_with_validated_answer(mock_openai):
+    res = CliRunner().invoke(run.app, ["consistency", TEMPLATE, "--var", "complaint=списали дважды",
+                                       "-n", "3", "--schema", SCHEMA])
+    assert res.exit_code == 0, res.output
+    rec = last_run("consistency")
+    assert rec["valid"] is True and rec["schema"] == SCHEMA
+    assert rec["self_consistency"]["votes"] >= 2
+    assert '"category": "card"' in get_history().payload(rec["id"])["response"]
+    assert rec["timing"]["spans"]["http"] > 0  # спаны выборок из потоков пула — в трассе прогона